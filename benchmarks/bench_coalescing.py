@@ -0,0 +1,89 @@
+# UDPのデータグラムのまとめ送信(coalescing)のベンチマーク
+# 1つのルームのメンバー全員が一定のレートでチャットを送信し、まとめ送信の有無で
+# サーバーの送信システムコール数(=送信データグラム数)と、受信側に届いたデータグラム数、メッセージ数を比較する。
+# サーバーはUDPServerとOutboundSenderをこのプロセス内で使い、受信者は実際のUDPソケットで受信する。
+#
+# 実行方法：python3 benchmarks/bench_coalescing.py --members 20 --rate 2000 --seconds 3 --window-ms 5
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import UDPProtocolHandler
+from log_pipeline import LogPipeline, log
+from server import ChatServer, OutboundSender, UDPServer
+
+
+# 役割：受信者のソケットで受信したデータグラム数とメッセージ数を数える
+# 戻り値：無し
+def receive(sock, counts, stop_event):
+   while not stop_event.is_set():
+      try:
+         data = sock.recv(4096)
+      except socket.timeout:
+         continue
+      counts[0] += 1
+      counts[1] += len(UDPProtocolHandler.split_batch(data))
+
+
+# 役割：1つの設定でのベンチマークの実行
+# 戻り値：(送信データグラム数/秒, 受信データグラム数/秒, 受信メッセージ数/秒)
+def run(member_count, rate, seconds, window):
+   chat_server = ChatServer()
+   sender = OutboundSender(1, 1024, OutboundSender.DROP_OLDEST, window)
+   udp_server = UDPServer("127.0.0.1", 0, chat_server, sender)
+   udp_server.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   udp_server.sock.bind(("127.0.0.1", 0))
+   sender.start(udp_server.sock, udp_server.meter)
+
+   stop_event = threading.Event()
+   members = []
+   receive_counts = []
+   for index in range(member_count):
+      sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      sock.bind(("127.0.0.1", 0))
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+      sock.settimeout(0.1)
+      token = chat_server.generate_token()
+      chat_server.register_client("room", token, sock.getsockname(), index == 0)
+      sender.register(sock.getsockname(), token, True)
+      message = UDPProtocolHandler.make_chat_message("room", token, f"user{index}", "こんにちは。よろしくお願いします。", UDPProtocolHandler.CONTENT_FORMAT_BINARY)
+      members.append((message, sock.getsockname()))
+      counts = [0, 0]
+      receive_counts.append(counts)
+      threading.Thread(target=receive, args=(sock, counts, stop_event), daemon=True).start()
+
+   start = time.monotonic()
+   sent = 0
+   while time.monotonic() - start < seconds:
+      # 一定のレートになるよう、経過時間までの分を送信する
+      due = int((time.monotonic() - start) * rate)
+      while sent < due:
+         message, address = members[sent % member_count]
+         udp_server.handle_message(message, address)
+         sent += 1
+      time.sleep(0.0005)
+   time.sleep(0.2)
+   stop_event.set()
+
+   packets_received = sum(counts[0] for counts in receive_counts)
+   messages_received = sum(counts[1] for counts in receive_counts)
+   return udp_server.meter.packets_out / seconds, packets_received / seconds, messages_received / seconds
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--members", type=int, default=20, help="ルームのメンバー数")
+   parser.add_argument("--rate", type=int, default=2000, help="ルーム全体のチャットの送信レート(msg/s)")
+   parser.add_argument("--seconds", type=float, default=3, help="計測時間(秒)")
+   parser.add_argument("--window-ms", type=float, default=5, help="まとめ送信で待つ時間(ミリ秒)")
+   args = parser.parse_args()
+
+   # サーバーのメッセージ受信時のログを抑える
+   log.configure(LogPipeline.ERROR, message_sample_rate=0)
+   for name, window in (("no coalescing", 0), (f"coalescing {args.window_ms:g}ms", args.window_ms / 1000)):
+      packets_out, packets_in, messages_in = run(args.members, args.rate, args.seconds, window)
+      sys.stdout.write(f"{name:>16}: sendmsg {packets_out:,.0f}/s, 受信 {packets_in:,.0f} pkt/s, {messages_in:,.0f} msg/s\n")
@@ -0,0 +1,219 @@
+# TCPProtocolHandler、UDPProtocolHandlerのエンコード・デコードのマイクロベンチマーク
+# make_tcp_data/parse_data、make_udp_data(make_chat_message)/parse_messageについて、
+# 小さい・一般的・最大サイズのペイロード、10〜100,000件のルーム一覧、ASCIIとマルチバイト(日本語)の文字列の組み合わせで
+# 1秒あたりの処理回数と1回あたりのメモリ確保を計測し、保存したベースラインと比較する。
+#
+# メモリ確保はtracemallocで計測する。
+# - alloc_blocks: 1回の呼び出しで確保され、戻り値として残るメモリブロック数
+# - alloc_peak_bytes: 1回の呼び出し中に一時的に確保された最大のバイト数
+# 入力は固定の文字列から作成するため、同じ環境であれば毎回同じ入力で計測される。
+# alloc_blocksは実行毎にほぼ変わらない(オブジェクトのフリーリストの状態により±1程度変わる)が、
+# ops_per_secは同じマシンでも負荷により変動するため、
+# ベースラインとの比較は同じマシンで行い、遅くなったケースは--filterで絞って再計測して確認する。
+#
+# 実行方法：python3 benchmarks/bench_codecs.py                     (ベースラインと比較)
+#           python3 benchmarks/bench_codecs.py --save-baseline     (ベースラインを更新)
+#           python3 benchmarks/bench_codecs.py --filter udp --output codecs.json
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import TCPProtocolHandler, UDPProtocolHandler
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "codecs.json")
+ROOM_LIST_SIZES = (10, 1000, 100000)
+
+# 文字列の種類(1文字あたりのUTF-8のバイト数が異なる)
+TEXTS = {
+   "ascii": "Hello, how is everyone doing today? ",
+   "ja": "こんにちは、今日はいい天気ですね。よろしくお願いします。",
+}
+TOKEN = "3f2a9c1e7b5d4068a1c2e3f405162738"
+SESSION_HANDLE = bytes(range(8))
+
+
+# 役割：指定した文字数になるまで文字列を繰り返す
+# 戻り値：文字列
+def repeat_text(text, length):
+   return (text * (length // len(text) + 1))[:length]
+
+
+# 役割：分割せずに送信できる最大のchat_dataの作成(二分探索)
+# 分割しないチャットは従来の受信バッファ(LEGACY_RECEIVE_BUFFER_SIZE)に収まるサイズまで送信するため、それに収まる最大にする
+# 戻り値：chat_data
+def make_max_chat_data(text, user_name, content_format):
+   max_size = UDPProtocolHandler.LEGACY_RECEIVE_BUFFER_SIZE
+   low, high = 0, max_size
+   while low < high:
+      middle = (low + high + 1) // 2
+      message = UDPProtocolHandler.make_chat_message("", SESSION_HANDLE, user_name, repeat_text(text, middle), content_format)
+      if message is not None and len(message) <= max_size:
+         low = middle
+      else:
+         high = middle - 1
+   return repeat_text(text, low)
+
+
+# 役割：計測するケースの作成
+# 戻り値：[(名前, 関数, 引数のタプル, 入力のバイト数), ...]
+def make_cases():
+   cases = []
+   for text_name, text in TEXTS.items():
+      # TCP: リクエスト(小)、トークンレスポンス(一般的)、最大長のルーム名
+      room_name = repeat_text(text, 20)
+      # ルーム名のサイズはヘッダーの1バイトで表せる255バイトまで
+      max_room_name = repeat_text(text, 255)
+      while len(max_room_name.encode("utf-8")) > 255:
+         max_room_name = max_room_name[:-1]
+      tcp_data = {
+         "join_request": dict(room_name=room_name, operation=2, state=0, type="JOIN", password=repeat_text(text, 12)),
+         "token_response": dict(room_name="", operation=10, state=2, token=TOKEN, request_id=12345),
+         "max_room_name": dict(room_name=max_room_name, operation=2, state=0, type="JOIN", password=repeat_text(text, 12)),
+      }
+      for size in ROOM_LIST_SIZES:
+         room_list = [f"{repeat_text(text, 12)}{index:06d}" for index in range(size)]
+         tcp_data[f"room_list_{size}"] = dict(room_name="", operation=10, state=2, room_list=room_list, options={"version": 1700000000000000})
+      for data_name, kwargs in tcp_data.items():
+         encoded = TCPProtocolHandler.make_tcp_data(**kwargs)
+         cases.append((f"tcp.encode.{data_name}.{text_name}", lambda kwargs=kwargs: TCPProtocolHandler.make_tcp_data(**kwargs), (), len(encoded)))
+         cases.append((f"tcp.decode.{data_name}.{text_name}", TCPProtocolHandler.parse_data, (encoded,), len(encoded)))
+
+      # UDP: チャット(小、一般的、分割せずに送信できる最大)をJSON形式とバイナリ形式で
+      user_name = "ユーザー" if text_name == "ja" else "user"
+      for format_name, content_format in (("json", UDPProtocolHandler.CONTENT_FORMAT_JSON), ("binary", UDPProtocolHandler.CONTENT_FORMAT_BINARY)):
+         chat_data = {
+            "small": repeat_text(text, 10),
+            "typical": repeat_text(text, 100),
+            "max": make_max_chat_data(text, user_name, content_format),
+         }
+         for size_name, data in chat_data.items():
+            # 一般的なケースはトークン、その他はセッションハンドルで送信する
+            routing = (room_name, TOKEN) if size_name == "typical" else ("", SESSION_HANDLE)
+            args = (*routing, user_name, data, content_format)
+            encoded = UDPProtocolHandler.make_chat_message(*args)
+            cases.append((f"udp.encode.{format_name}.{size_name}.{text_name}", UDPProtocolHandler.make_chat_message, args, len(encoded)))
+            cases.append((f"udp.decode.{format_name}.{size_name}.{text_name}", UDPProtocolHandler.parse_message, (encoded,), len(encoded)))
+   return cases
+
+
+# 役割：1秒あたりの処理回数の計測(min_time秒以上かかる回数を求めてから、repeat回計測して最速の値を使う)
+# 戻り値：1秒あたりの処理回数
+def measure_ops(function, args, min_time, repeat):
+   count = 1
+   while True:
+      start = time.perf_counter()
+      for _ in range(count):
+         function(*args)
+      elapsed = time.perf_counter() - start
+      if elapsed >= min_time:
+         break
+      count *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed * 1.2)))
+
+   best = elapsed
+   for _ in range(repeat - 1):
+      start = time.perf_counter()
+      for _ in range(count):
+         function(*args)
+      best = min(best, time.perf_counter() - start)
+   return count / best
+
+
+# 役割：1回の呼び出しでのメモリ確保の計測(tracemalloc自体の初回の確保が混ざらないよう、repeat回計測して最小の値を使う)
+# 戻り値：(戻り値として残るメモリブロック数, 一時的に確保された最大のバイト数)
+def measure_allocations(function, args, repeat):
+   # スナップショット自体の確保は除く
+   exclude = [tracemalloc.Filter(False, tracemalloc.__file__)]
+   measurements = []
+   for _ in range(repeat):
+      tracemalloc.start()
+      try:
+         before = tracemalloc.take_snapshot().filter_traces(exclude)
+         tracemalloc.reset_peak()
+         base, _ = tracemalloc.get_traced_memory()
+         result = function(*args)
+         _, peak = tracemalloc.get_traced_memory()
+         after = tracemalloc.take_snapshot().filter_traces(exclude)
+      finally:
+         tracemalloc.stop()
+      blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+      del result
+      measurements.append((blocks, peak - base))
+   return min(measurements)
+
+
+# 役割：ベースラインとの比較結果の出力
+# 戻り値：許容範囲を超えて遅くなったケースの名前のリスト
+def compare_with_baseline(results, baseline, tolerance):
+   baseline_results = baseline["results"]
+   regressions = []
+   sys.stdout.write(f"\nベースライン({baseline['python']}, {baseline['machine']})との比較\n")
+   for name, result in results.items():
+      if name not in baseline_results:
+         continue
+      ratio = result["ops_per_sec"] / baseline_results[name]["ops_per_sec"]
+      block_diff = result["alloc_blocks"] - baseline_results[name]["alloc_blocks"]
+      mark = ""
+      if ratio < 1 - tolerance:
+         mark = "  <- 遅くなりました"
+         regressions.append(name)
+      sys.stdout.write(f"{name:<40} {ratio:6.2f}x  blocks {block_diff:+d}{mark}\n")
+   return regressions
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--filter", default="", help="名前にこの文字列を含むケースのみ計測する")
+   parser.add_argument("--min-time", type=float, default=0.2, help="1回の計測の最小時間(秒)")
+   parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数(最速の値を使う)")
+   parser.add_argument("--baseline", default=BASELINE_PATH, help="比較するベースラインのJSONファイル")
+   parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインとして保存する")
+   parser.add_argument("--tolerance", type=float, default=0.2, help="処理回数がベースラインからこの割合を超えて減った場合に遅くなったとみなす")
+   parser.add_argument("--fail-on-regression", action="store_true", help="遅くなったケースがある場合は終了コード1で終了する")
+   parser.add_argument("--output", default=None, help="結果を保存するJSONファイル")
+   args = parser.parse_args()
+
+   results = {}
+   for name, function, function_args, size in make_cases():
+      if args.filter not in name:
+         continue
+      ops_per_sec = measure_ops(function, function_args, args.min_time, args.repeat)
+      blocks, peak_bytes = measure_allocations(function, function_args, args.repeat)
+      results[name] = {"ops_per_sec": ops_per_sec, "alloc_blocks": blocks, "alloc_peak_bytes": peak_bytes, "bytes": size}
+      sys.stdout.write(f"{name:<40} {ops_per_sec:14,.0f} ops/s  {blocks:7d} blocks  {peak_bytes:12,d} peak bytes  ({size:,} bytes)\n")
+
+   report = {
+      "python": platform.python_version(),
+      "machine": f"{platform.system()} {platform.machine()}",
+      "timestamp": time.time(),
+      "results": results,
+   }
+   if args.output:
+      with open(args.output, "w") as file:
+         json.dump(report, file, indent=2, ensure_ascii=False)
+
+   if args.save_baseline:
+      # 一部のケースのみ計測した場合は、既存のベースラインのそのケースのみ更新する
+      if args.filter and os.path.exists(args.baseline):
+         with open(args.baseline) as file:
+            baseline = json.load(file)
+         baseline["results"].update(results)
+         results = baseline["results"]
+      report["results"] = dict(sorted(results.items()))
+      os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+      with open(args.baseline, "w") as file:
+         json.dump(report, file, indent=2, ensure_ascii=False)
+         file.write("\n")
+      sys.stdout.write(f"ベースラインを保存しました: {args.baseline}\n")
+   elif os.path.exists(args.baseline):
+      with open(args.baseline) as file:
+         baseline = json.load(file)
+      regressions = compare_with_baseline(results, baseline, args.tolerance)
+      if regressions and args.fail_on_regression:
+         sys.exit(1)
+   else:
+      sys.stdout.write("ベースラインがありません(--save-baselineで保存できます)。\n")
@@ -0,0 +1,78 @@
+# チャットの履歴(シーケンス番号付きのリングバッファ)のベンチマーク
+# 1. 履歴の有無でのチャット1件のリレーの処理時間(UDPServer.handle_message。送信はダミーのソケットで行う)
+# 2. 履歴が埋まった状態での欠落の補完(数件の範囲の取得)と、履歴全体の取得にかかる時間
+#
+# 実行方法：python3 benchmarks/bench_history.py --messages 50000 --history-size 256 --gap 3
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import UDPProtocolHandler
+from log_pipeline import LogPipeline, log
+from server import ChatServer, UDPServer
+
+
+# 送信せずに破棄するソケット
+class NullSocket:
+   def sendto(self, *args):
+      pass
+
+   def sendmsg(self, *args):
+      pass
+
+
+# 役割：ルームに8人のクライアントを登録したUDPServerの作成
+# 戻り値：(UDPServer, 送信者のトークン)
+def make_server(history_size, history_bytes):
+   chat_server = ChatServer(history_size=history_size, history_bytes=history_bytes)
+   tokens = []
+   for index in range(8):
+      token = chat_server.generate_token()
+      chat_server.register_client("room", token, ("127.0.0.1", 10000 + index), index == 0)
+      tokens.append(token)
+   udp_server = UDPServer("127.0.0.1", 0, chat_server)
+   udp_server.sock = NullSocket()
+   return udp_server, tokens[0]
+
+
+# 役割：チャットのリレーの処理時間の計測
+# 戻り値：1件あたりのマイクロ秒
+def measure_relay(udp_server, token, message_count):
+   message = UDPProtocolHandler.make_chat_message("room", token, "ユーザー", "今日はいい天気ですね。よろしくお願いします。", UDPProtocolHandler.CONTENT_FORMAT_BINARY)
+   start = time.perf_counter()
+   for _ in range(message_count):
+      udp_server.handle_message(message, ("127.0.0.1", 10000))
+   return (time.perf_counter() - start) / message_count * 1000000
+
+
+# 役割：履歴の取得時間の計測
+# 戻り値：(1回あたりのマイクロ秒, 取得した件数)
+def measure_history(chat_server, count, repeat):
+   start = time.perf_counter()
+   for _ in range(repeat):
+      history = chat_server.get_history("room", count=count)
+   return (time.perf_counter() - start) / repeat * 1000000, len(history)
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--messages", type=int, default=50000, help="リレーするチャットの件数")
+   parser.add_argument("--history-size", type=int, default=ChatServer.HISTORY_SIZE, help="ルーム毎の履歴の最大件数")
+   parser.add_argument("--history-bytes", type=int, default=ChatServer.HISTORY_BYTES, help="ルーム毎の履歴の最大バイト数")
+   parser.add_argument("--gap", type=int, default=3, help="欠落の補完で取得する件数")
+   args = parser.parse_args()
+
+   # サーバーのログを抑える
+   log.configure(LogPipeline.ERROR, message_sample_rate=0)
+   for name, history_size in (("no history", 0), (f"history {args.history_size}", args.history_size)):
+      udp_server, token = make_server(history_size, args.history_bytes)
+      microseconds = measure_relay(udp_server, token, args.messages)
+      sys.stdout.write(f"{name:>14}: リレー {microseconds:6.2f} us/msg\n")
+
+   room = udp_server.chat_server.rooms_info["room"]
+   sys.stdout.write(f"履歴: {room.history.next_sequence - room.history.first_sequence}件, {room.history.size_bytes:,} bytes\n")
+   for name, count in (("gap repair", args.gap), ("full history", args.history_size)):
+      microseconds, history_count = measure_history(udp_server.chat_server, count, 10000)
+      sys.stdout.write(f"{name:>14}: {history_count}件の取得 {microseconds:6.2f} us\n")
@@ -0,0 +1,81 @@
+# ジャーナル(追記専用のログとスナップショット)からの復元のベンチマーク
+# ChatServerにセッションを登録してINITIAL(セッションハンドルの発行)まで行い、
+# 1. 登録時のジャーナルへの記録を含む1セッションあたりの登録時間
+# 2. ログのみからの復元時間(コンパクション前に停止した場合)
+# 3. スナップショットからの復元時間(コンパクション後に停止した場合)
+# を計測する。復元後に全てのトークンとセッションハンドルが使えることも確認する。
+#
+# 実行方法：python3 benchmarks/bench_journal_recovery.py --sessions 100000 --room-size 10
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from journal import StateJournal
+from modules import UDPProtocolHandler
+from log_pipeline import LogPipeline, log
+from server import ChatServer
+
+
+# 役割：ジャーナルを記録するChatServerへのセッションの登録
+# 戻り値：(登録にかかった秒数, [(トークン, セッションハンドル), ...])
+def populate(journal_dir, session_count, room_size):
+   chat_server = ChatServer(journal=StateJournal(journal_dir, compact_records=session_count * 10))
+   chat_server.recover()
+   tokens = [chat_server.generate_token() for _ in range(session_count)]
+
+   start = time.perf_counter()
+   for index, token in enumerate(tokens):
+      room_index, member_index = divmod(index, room_size)
+      room_name = f"room{room_index}"
+      address = ("127.0.0.1", 10000 + index % 50000)
+      chat_server.register_client(room_name, token, address, member_index == 0)
+      chat_server.initial({"room_name": room_name, "token": token, "content": {"capabilities": UDPProtocolHandler.CAPABILITIES}}, address)
+   elapsed = time.perf_counter() - start
+
+   sessions = [(token, chat_server.get_session_handle(token)) for token in tokens]
+   return chat_server, elapsed, sessions
+
+
+# 役割：ジャーナルからの復元時間の計測と、復元したセッションの確認
+# 戻り値：復元にかかった秒数
+def measure_recovery(journal_dir, sessions):
+   chat_server = ChatServer(journal=StateJournal(journal_dir))
+   start = time.perf_counter()
+   chat_server.recover()
+   elapsed = time.perf_counter() - start
+   chat_server.journal.close()
+
+   for token, handle in sessions:
+      assert token in chat_server.tokens_info
+      assert chat_server.resolve_session_handle(handle)[1] == token
+   return elapsed
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--sessions", type=int, default=100000, help="登録するセッション数")
+   parser.add_argument("--room-size", type=int, default=10, help="1ルームあたりのセッション数")
+   args = parser.parse_args()
+
+   log.configure(LogPipeline.ERROR, message_sample_rate=0)
+   journal_dir = tempfile.mkdtemp(prefix="chat-journal-")
+   try:
+      chat_server, elapsed, sessions = populate(journal_dir, args.sessions, args.room_size)
+      sys.stdout.write(f"登録(ジャーナル記録込み): {elapsed / args.sessions * 1000000:.2f} us/session ({elapsed:.2f}秒)\n")
+
+      # コンパクション前に停止した場合(起動時の空のスナップショット + 全レコードのログ)
+      chat_server.journal.close()
+      log_size = sum(os.path.getsize(os.path.join(journal_dir, name)) for name in os.listdir(journal_dir) if name.endswith(".log"))
+      elapsed = measure_recovery(journal_dir, sessions)
+      sys.stdout.write(f"ログからの復元: {args.sessions}セッション {elapsed:.2f}秒 (ログ {log_size / 1024 / 1024:.1f} MiB)\n")
+
+      # 復元時にスナップショットを書いているため、次の起動はスナップショットのみから復元する
+      snapshot_size = os.path.getsize(os.path.join(journal_dir, StateJournal.SNAPSHOT_NAME))
+      elapsed = measure_recovery(journal_dir, sessions)
+      sys.stdout.write(f"スナップショットからの復元: {args.sessions}セッション {elapsed:.2f}秒 (スナップショット {snapshot_size / 1024 / 1024:.1f} MiB)\n")
+   finally:
+      shutil.rmtree(journal_dir, ignore_errors=True)
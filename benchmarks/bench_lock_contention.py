@@ -0,0 +1,197 @@
+# ChatServerのロックの競合のベンチマーク
+# ルーム毎のロック(現在の実装)と、全ての更新を1つのロックで行う従来の実装(BaselineChatServer)を比較する。
+# 各スレッドは別々のルームで 参加→INITIAL→最終接続時刻の更新×N→メンバー取得→削除 を繰り返し、
+# 別のスレッドがUDPのリレーと同様に最終接続時刻の更新を続ける。
+#
+# 実行方法：python3 benchmarks/bench_lock_contention.py --threads 8 --seconds 3
+import argparse
+import base64
+import heapq
+import os
+import secrets
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import UDPProtocolHandler
+from server import ChatServer
+
+
+# 従来の実装のChatServer(ルーム毎のロックに置き換える前のコミットのserver.pyから、ベンチマークで使うメソッドのみ写したもの)
+# 全ての更新をモジュール全体で共有する1つのロックで行い、ルームとクライアントの情報はdictで持つ。
+# 当時のコードと比較するため、内容は変更しない。
+lock = threading.Lock()
+
+
+class BaselineChatServer:
+   def __init__(self):
+      self.rooms_info = {}
+      self.tokens_info = {}
+      self.TIMEOUT = 15 # 最終接続からTIMEOUT秒経つとクライアントは自動的に削除される。
+      self.expiry_heap = [] # (期限, トークン)の最小ヒープ。期限は作成時または前回確認時の最終接続時刻+TIMEOUT
+      self.credential_cache = None
+
+   # 役割：ルームの作成
+   # 戻り値：成功=(トークン,None)、失敗=(None、エラーメッセージ)
+   def create_room(self, parsed_request, client_address):
+      room_name = parsed_request["room_name"]
+
+      with lock:
+         if room_name in self.rooms_info:
+            return None, "ルームは既に存在します。"
+         else:
+            token = self.generate_token()
+            now = time.monotonic()
+            self.rooms_info[room_name] = {
+               "members": {token: client_address},
+               "password": parsed_request["operation_payload"]["password"]
+            }
+            self.tokens_info[token] = {
+               "room_name": room_name,
+               "last_access": now,
+               "is_host": True,
+               "content_format": UDPProtocolHandler.CONTENT_FORMAT_JSON
+            }
+            heapq.heappush(self.expiry_heap, (now + self.TIMEOUT, token))
+         return token, None
+      
+
+   # 役割：ルームにクライアントを追加（ルームへの参加）
+   # 戻り値：成功=(トークン、None), 失敗=(None、エラーメッセージ)
+   def join_room(self, parsed_request, client_address):
+      room_name = parsed_request["room_name"]
+      with lock:
+         if room_name not in self.rooms_info:
+            return None, "ルームが存在しません。"
+         else:
+            token = self.generate_token()
+            now = time.monotonic()
+            self.rooms_info[room_name]["members"][token] = client_address
+            self.tokens_info[token] = {
+               "room_name": room_name,
+               "last_access": now,
+               "is_host": False,
+               "content_format": UDPProtocolHandler.CONTENT_FORMAT_JSON
+            }
+            heapq.heappush(self.expiry_heap, (now + self.TIMEOUT, token))
+      return token, None
+
+   # 役割：トークンの生成
+   # 戻り値：トークン
+   def generate_token(self):
+       # トークンの生成
+        token_bytes = secrets.token_bytes(UDPProtocolHandler.TOKEN_MAX_BYTE_SIZE // 2)
+        # Base64エンコードして文字列として返す
+        token = base64.urlsafe_b64encode(token_bytes).decode("utf-8")
+        # トークンサイズを超えないようにトリミング
+        return token[:UDPProtocolHandler.TOKEN_MAX_BYTE_SIZE]
+
+   # 役割：アドレスの更新(TCP接続とUDP接続でポートが異なるためチャット開始時に更新)と機能のネゴシエーション
+   # 戻り値：機能が通知された場合は同意した機能のリスト、通知されていない場合はNone
+   def initial(self, parsed_message, client_address):
+      capabilities = parsed_message["content"].get("capabilities")
+      with lock:
+         room_name = parsed_message["room_name"]
+         token = parsed_message["token"]
+         self.rooms_info[room_name]["members"][token] = client_address
+
+         if capabilities is None:
+            return None
+         accepted_capabilities = [capability for capability in capabilities if capability in UDPProtocolHandler.CAPABILITIES]
+         if UDPProtocolHandler.CAPABILITY_BINARY in accepted_capabilities:
+            self.tokens_info[token]["content_format"] = UDPProtocolHandler.CONTENT_FORMAT_BINARY
+      return accepted_capabilities
+
+   # 役割：ルーム名からルームメンバー情報を取得
+   # 戻り値：ルームメンバーのトークンとアドレスのタプルのリスト
+   def get_members_list(self, room_name):
+      members_list = []
+
+      for token, address in self.rooms_info[room_name]["members"].items():
+         members_list.append((token, address))
+      
+      return members_list
+   
+
+   # 役割：最終接続時刻の更新(期限のヒープは更新せず、期限切れの確認時に反映する)
+   # 戻り値：無し
+   def update_last_access(self, parsed_message):
+      token = parsed_message["token"]
+      with lock:
+         self.tokens_info[token]["last_access"] = time.monotonic()
+
+   # 役割：ユーザーの削除
+   # 戻り値：無し
+   def delete_client(self, token):
+      room_name = self.tokens_info[token]["room_name"]
+      with lock:
+         del self.tokens_info[token]
+         del self.rooms_info[room_name]["members"][token]
+
+         if not self.rooms_info[room_name]["members"]:
+            del self.rooms_info[room_name]
+            if self.credential_cache:
+               self.credential_cache.invalidate_room(room_name)
+
+
+# UDPワーカープロセスが担当するルームの情報の管理
+# クライアントの削除はメインプロセスのChatServerにも反映させる。
+
+
+# 役割：1つの実装でのベンチマークの実行
+# 戻り値：(ルーム操作数/秒, 最終接続時刻の更新数/秒)
+def run(chat_server, thread_count, seconds, updates_per_join):
+   # 各スレッド用のルームと、ルームが削除されないようにするホスト
+   hosts = []
+   for index in range(thread_count + 1):
+      room_name = f"room{index}"
+      token, _ = chat_server.create_room({"room_name": room_name, "operation_payload": {"password": ""}}, ("127.0.0.1", index))
+      hosts.append((room_name, token))
+
+   stop_event = threading.Event()
+   room_operation_counts = [0] * thread_count
+   update_counts = [0]
+
+   def room_worker(index):
+      room_name, _ = hosts[index]
+      port = 10000 + index
+      while not stop_event.is_set():
+         token, _ = chat_server.join_room({"room_name": room_name}, ("127.0.0.1", port))
+         message = {"room_name": room_name, "token": token, "content": {}}
+         chat_server.initial(message, ("127.0.0.1", port))
+         for _ in range(updates_per_join):
+            chat_server.update_last_access(message)
+         chat_server.get_members_list(room_name)
+         chat_server.delete_client(token)
+         room_operation_counts[index] += 1
+
+   def relay_worker():
+      room_name, token = hosts[thread_count]
+      message = {"room_name": room_name, "token": token}
+      while not stop_event.is_set():
+         chat_server.update_last_access(message)
+         update_counts[0] += 1
+
+   threads = [threading.Thread(target=room_worker, args=(index,)) for index in range(thread_count)]
+   threads.append(threading.Thread(target=relay_worker))
+   for thread in threads:
+      thread.start()
+   time.sleep(seconds)
+   stop_event.set()
+   for thread in threads:
+      thread.join()
+
+   return sum(room_operation_counts) / seconds, update_counts[0] / seconds
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--threads", type=int, default=8, help="ルーム操作を行うスレッド数")
+   parser.add_argument("--seconds", type=float, default=3, help="計測時間(秒)")
+   parser.add_argument("--updates-per-join", type=int, default=10, help="参加1回あたりの最終接続時刻の更新回数")
+   args = parser.parse_args()
+
+   for name, chat_server in (("global lock", BaselineChatServer()), ("per-room locks", ChatServer())):
+      room_operations, updates = run(chat_server, args.threads, args.seconds, args.updates_per_join)
+      print(f"{name:>15}: ルーム操作 {room_operations:,.0f} ops/s, リレー側の最終接続時刻の更新 {updates:,.0f} ops/s")
@@ -0,0 +1,70 @@
+# ルーム一覧取得のベンチマーク
+# ルームを作成したChatServerに対して、ルーム一覧取得リクエストの処理(TCPServer.process_request)にかかる時間と
+# レスポンスのバイト数を、従来の処理(毎回一覧を作成してエンコード)、キャッシュしたレスポンス、
+# 変更が無い場合(not_modified)、1ルームだけ変更があった場合の差分、ページ指定(先頭、末尾付近、前方一致)で比較する。
+#
+# 実行方法：python3 benchmarks/bench_room_list.py --rooms 50000 --requests 2000 --page-size 20
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import TCPProtocolHandler
+from log_pipeline import LogPipeline, log
+from server import ChatServer, TCPServer
+
+
+# 役割：1つの方式でのリクエストの処理時間の計測
+# 戻り値：(1リクエストあたりのマイクロ秒, レスポンスのバイト数)
+def measure(handle, request_count):
+   start = time.perf_counter()
+   for _ in range(request_count):
+      response = handle()
+   elapsed = time.perf_counter() - start
+   return elapsed / request_count * 1000000, len(response)
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--rooms", type=int, default=1000, help="ルーム数")
+   parser.add_argument("--requests", type=int, default=20000, help="リクエスト数")
+   parser.add_argument("--page-size", type=int, default=20, help="ページ指定の場合の1ページの件数")
+   args = parser.parse_args()
+
+   # サーバーのログを抑える
+   log.configure(LogPipeline.ERROR, message_sample_rate=0)
+   chat_server = ChatServer()
+   for index in range(args.rooms):
+      chat_server.register_client(f"room{index:06d}", chat_server.generate_token(), ("127.0.0.1", 10000), True)
+   tcp_server = TCPServer("127.0.0.1", 0, chat_server)
+
+   # 従来の処理(毎回一覧を作成してエンコードする)
+   def legacy():
+      return TCPProtocolHandler.make_room_list_response(*chat_server.get_room_list())
+
+   full_request = TCPProtocolHandler.parse_data(TCPProtocolHandler.make_get_room_list_request())
+   current_request = TCPProtocolHandler.parse_data(TCPProtocolHandler.make_get_room_list_request(chat_server.directory_version))
+   # 1ルームだけ作成された後の差分
+   chat_server.register_client("new room", chat_server.generate_token(), ("127.0.0.1", 10000), True)
+
+   results = (
+      ("legacy", legacy),
+      ("cached", lambda: tcp_server.process_request(full_request, ("127.0.0.1", 0))),
+      ("delta (1 room)", lambda: tcp_server.process_request(current_request, ("127.0.0.1", 0))),
+   )
+   for name, handle in results:
+      microseconds, size = measure(handle, args.requests)
+      sys.stdout.write(f"{name:>15}: {microseconds:8.2f} us/req, {size:,} bytes\n")
+
+   # 変更が無い場合と、ページ指定(先頭のページ、末尾付近のページ、ルーム名の前方一致)
+   requests = (
+      ("not_modified", TCPProtocolHandler.make_get_room_list_request(chat_server.directory_version)),
+      ("first page", TCPProtocolHandler.make_get_room_list_page_request(0, args.page_size)),
+      ("last page", TCPProtocolHandler.make_get_room_list_page_request(args.rooms - args.page_size, args.page_size)),
+      ("prefix page", TCPProtocolHandler.make_get_room_list_page_request(0, args.page_size, f"room{args.rooms // 2:06d}"[:-2])),
+   )
+   for name, request in requests:
+      parsed_request = TCPProtocolHandler.parse_data(request)
+      microseconds, size = measure(lambda: tcp_server.process_request(parsed_request, ("127.0.0.1", 0)), args.requests)
+      sys.stdout.write(f"{name:>15}: {microseconds:8.2f} us/req, {size:,} bytes\n")
@@ -0,0 +1,84 @@
+# セッション情報のメモリ使用量のベンチマーク
+# ChatServerにクライアントを登録し、tracemallocで計測した1セッションあたりのメモリ使用量を表示する。
+# 比較として、従来のネストした辞書(rooms_info/tokens_info)での保持をエミュレートした場合も計測する。
+# トークンとアドレスは両方で共通のため、計測前に生成しておき計測には含めない。
+#
+# 実行方法：python3 benchmarks/bench_session_memory.py --sessions 100000 --room-size 10
+import argparse
+import heapq
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import UDPProtocolHandler
+from server import ChatServer
+
+
+# 役割：従来の辞書での保持をエミュレートしてクライアントを登録
+# 戻り値：(rooms_info, tokens_info, expiry_heap)
+def register_dicts(clients):
+   timeout = 15 # ChatServer.TIMEOUTと同じ値
+   rooms_info = {}
+   tokens_info = {}
+   expiry_heap = []
+   for room_name, token, client_address, is_host in clients:
+      room_info = rooms_info.get(room_name)
+      if room_info is None:
+         room_info = rooms_info[room_name] = {
+            "members": {},
+            "password": "",
+            "lock": threading.Lock(),
+            "is_closed": False
+         }
+      room_info["members"][token] = client_address
+      now = time.monotonic()
+      tokens_info[token] = {
+         "room_name": room_name,
+         "last_access": now,
+         "is_host": is_host,
+         "content_format": UDPProtocolHandler.CONTENT_FORMAT_JSON
+      }
+      heapq.heappush(expiry_heap, (now + timeout, token))
+   return rooms_info, tokens_info, expiry_heap
+
+
+# 役割：ChatServer(Room/Session)にクライアントを登録
+# 戻り値：ChatServer
+def register_slots(clients):
+   chat_server = ChatServer()
+   for room_name, token, client_address, is_host in clients:
+      chat_server.register_client(room_name, token, client_address, is_host)
+   return chat_server
+
+
+# 役割：登録処理で確保されたメモリの計測
+# 戻り値：確保されたバイト数
+def measure(register, clients):
+   tracemalloc.start()
+   before = tracemalloc.take_snapshot()
+   result = register(clients)
+   after = tracemalloc.take_snapshot()
+   tracemalloc.stop()
+   allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+   del result
+   return allocated
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--sessions", type=int, default=100000, help="登録するセッション数")
+   parser.add_argument("--room-size", type=int, default=10, help="1ルームあたりのセッション数")
+   args = parser.parse_args()
+
+   chat_server = ChatServer()
+   clients = []
+   for index in range(args.sessions):
+      room_index, member_index = divmod(index, args.room_size)
+      clients.append((f"room{room_index}", chat_server.generate_token(), ("127.0.0.1", 10000 + index % 50000), member_index == 0))
+
+   for name, register in (("nested dicts", register_dicts), ("Room/Session", register_slots)):
+      allocated = measure(register, clients)
+      print(f"{name:>13}: {allocated / args.sessions:,.1f} bytes/session ({allocated / 1024 / 1024:,.1f} MiB)")
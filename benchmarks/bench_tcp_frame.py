@@ -0,0 +1,66 @@
+# TCPのフレーム受信のベンチマーク
+# 従来の受信(recvの結果をbytesの連結で組み立てる)とTCPFrameReader(bytearrayを確保してrecv_intoで書き込む)で、
+# 大きなoperation_payloadのフレームの受信と解析にかかる時間を比較する。
+# 送信側はsocketpairの別スレッドからフレームを送信する。
+#
+# 実行方法：python3 benchmarks/bench_tcp_frame.py --payload-mib 8 16 32
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import TCPFrameReader, TCPProtocolHandler
+
+
+# 役割：従来の実装と同様に、bytesの連結でフレームを受信
+# 戻り値：フレーム
+def recieve_concat(sock):
+   recieved_header_data = b""
+   while len(recieved_header_data) < 32:
+      recieved_header_data += sock.recv(32 - len(recieved_header_data))
+
+   room_name_size = recieved_header_data[0]
+   operation_payload_size = int.from_bytes(recieved_header_data[3:], "big")
+   total_body_size = room_name_size + operation_payload_size
+
+   recieved_body_data = b""
+   while len(recieved_body_data) < total_body_size:
+      recieved_body_data += sock.recv(total_body_size - len(recieved_body_data))
+   return recieved_header_data + recieved_body_data
+
+
+# 役割：TCPFrameReaderでフレームを受信
+# 戻り値：フレーム
+def recieve_reader(sock):
+   return TCPFrameReader(sock).read_frame()
+
+
+# 役割：1つの実装での受信と解析の時間の計測
+# 戻り値：秒
+def measure(recieve, frame):
+   reader_sock, writer_sock = socket.socketpair()
+   sender = threading.Thread(target=writer_sock.sendall, args=(frame,))
+   start = time.perf_counter()
+   sender.start()
+   TCPProtocolHandler.parse_data(recieve(reader_sock))
+   elapsed = time.perf_counter() - start
+   sender.join()
+   reader_sock.close()
+   writer_sock.close()
+   return elapsed
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--payload-mib", type=int, nargs="+", default=[8, 16, 32], help="operation_payloadのサイズ(MiB)")
+   args = parser.parse_args()
+
+   for payload_mib in args.payload_mib:
+      room_list = ["r" * 1022] * (payload_mib * 1024)
+      frame = TCPProtocolHandler.make_room_list_response(room_list)
+      concat = measure(recieve_concat, frame)
+      reader = measure(recieve_reader, frame)
+      print(f"{len(frame) / 1024 / 1024:6.1f} MiB: bytes連結 {concat * 1000:8.1f} ms, TCPFrameReader {reader * 1000:8.1f} ms")
@@ -0,0 +1,65 @@
+# TCPリクエストのパイプライン化のベンチマーク
+# 1つの接続でルーム一覧の取得をN回行い、1件ずつ応答を待つ従来の方式(TCPClient.send_request)と、
+# request_idを付けて全て送信してから応答を待つ方式(MultiplexedTCPClient)の所要時間を比較する。
+# サーバーはこのプロセス内で起動する(ポートは空いているものを使う)。
+#
+# 実行方法：python3 benchmarks/bench_tcp_pipeline.py --requests 2000 --tcp-mode asyncio
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from log_pipeline import LogPipeline, log
+import server
+from client import MultiplexedTCPClient, TCPClient
+from modules import TCPProtocolHandler
+
+
+# 役割：サーバーの起動
+# 戻り値：TCPのポート番号
+def start_server(tcp_mode):
+   # 空いているポートを取得する
+   with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+      sock.bind(("127.0.0.1", 0))
+      tcp_port = sock.getsockname()[1]
+
+   chat_server = server.ChatServer()
+   chat_server.create_room({"room_name": "room", "operation_payload": {"password": ""}}, ("127.0.0.1", 0))
+   server_class = server.AsyncTCPServer if tcp_mode == "asyncio" else server.TCPServer
+   tcp_server = server_class(server_ip="127.0.0.1", tcp_port=tcp_port, chat_server=chat_server)
+   threading.Thread(target=tcp_server.run, daemon=True).start()
+   time.sleep(0.5)
+   return tcp_port
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--requests", type=int, default=2000, help="リクエスト数")
+   parser.add_argument("--tcp-mode", choices=["thread", "asyncio"], default="asyncio", help="TCPサーバーの実行モード")
+   args = parser.parse_args()
+
+   # サーバーのログを抑える
+   log.configure(LogPipeline.ERROR, message_sample_rate=0)
+   tcp_port = start_server(args.tcp_mode)
+
+   tcp_client = TCPClient("127.0.0.1", tcp_port)
+   tcp_client.connect()
+   start = time.perf_counter()
+   for _ in range(args.requests):
+      tcp_client.send_request(TCPProtocolHandler.make_get_room_list_request())
+   serial = time.perf_counter() - start
+   tcp_client.disconnect()
+
+   multiplexed_client = MultiplexedTCPClient("127.0.0.1", tcp_port)
+   multiplexed_client.connect()
+   start = time.perf_counter()
+   futures = [multiplexed_client.get_room_list() for _ in range(args.requests)]
+   for future in futures:
+      future.result()
+   pipelined = time.perf_counter() - start
+   multiplexed_client.disconnect()
+
+   sys.stdout.write(f"{args.requests}件 ({args.tcp_mode}): 1件ずつ {args.requests / serial:,.0f} req/s, パイプライン {args.requests / pipelined:,.0f} req/s\n")
@@ -0,0 +1,311 @@
+# UDPリレーの負荷生成とレイテンシのベンチマーク
+# サーバー(server.py)を別プロセスとしてループバックで起動し、実際のTCPのルーム作成・参加の流れで
+# R個のルームにM人ずつクライアント(UDPClient)を参加させる。各クライアントが指定したレートでチャットを送信し、
+# 送信から同じルームの他のクライアントが受信するまでのレイテンシ(p50/p99/p999)、スループット、損失率を計測する。
+# 結果はJSONで出力する(--outputでファイルに1行追記できるため、サーバーのモード間や変更前後の比較に使う)。
+#
+# チャットのchat_dataに送信予定時刻と実際の送信時刻(time.perf_counter_ns)を入れ、受信側で差を取る。
+# latency_usは送信予定時刻からのレイテンシで、送信側が遅れた間の待ち時間も含む(coordinated omissionを避ける)。
+# send_latency_usは実際の送信時刻からのレイテンシで、サーバーとネットワークでかかった時間のみを表す。
+# 送信と受信はこのプロセスの1スレッドずつで行うため、高いレートではこのプロセス自体が先に飽和する(sent_rateが目標のレートに届かない)。
+# 損失にはクライアント側の受信バッファのあふれも含まれる。
+#
+# 実行方法：python3 benchmarks/bench_udp_relay.py --rooms 10 --clients-per-room 8 --rate 10 --duration 10 --udp-mode thread --output results.jsonl
+import argparse
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from client import MultiplexedTCPClient, UDPClient
+from modules import UDPProtocolHandler
+
+PASSWORD = "bench-password"
+SOCKET_BUFFER_SIZE = 1024 * 1024 # クライアントのソケットの受信バッファ(リレーの集中時に取りこぼさないよう大きくする)
+JOIN_WINDOW = 32 # 同時に送信する参加リクエストの上限(パスワード検証の混雑による拒否を避ける)
+
+
+# 役割：空いているポート番号の取得
+# 戻り値：ポート番号
+def get_free_port(sock_type):
+   with socket.socket(socket.AF_INET, sock_type) as sock:
+      sock.bind(("127.0.0.1", 0))
+      return sock.getsockname()[1]
+
+
+# 役割：サーバーの起動(TCPポートに接続できるまで待つ)
+# 戻り値：(サーバーのプロセス, TCPのポート番号, UDPのポート番号)
+def start_server(args):
+   tcp_port = get_free_port(socket.SOCK_STREAM)
+   udp_port = get_free_port(socket.SOCK_DGRAM)
+   command = [
+      sys.executable, os.path.join(ROOT, "server.py"),
+      "--host", "127.0.0.1", "--tcp-port", str(tcp_port), "--udp-port", str(udp_port),
+      "--tcp-mode", args.tcp_mode, "--udp-mode", args.udp_mode,
+   ]
+   if args.udp_workers:
+      command += ["--udp-workers", str(args.udp_workers)]
+   command += args.server_args
+   process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+   deadline = time.monotonic() + 10
+   while time.monotonic() < deadline:
+      if process.poll() is not None:
+         raise RuntimeError("サーバーの起動に失敗しました。")
+      try:
+         socket.create_connection(("127.0.0.1", tcp_port), timeout=1).close()
+         # UDPサーバーはTCPサーバーの後に起動するため少し待つ
+         time.sleep(0.5)
+         return process, tcp_port, udp_port
+      except OSError:
+         time.sleep(0.1)
+   process.kill()
+   raise RuntimeError("サーバーに接続できませんでした。")
+
+
+# 役割：サーバーの停止(SIGINTで停止し、停止しなければ強制終了する)
+# 戻り値：無し
+def stop_server(process):
+   process.send_signal(signal.SIGINT)
+   try:
+      process.wait(timeout=10)
+   except subprocess.TimeoutExpired:
+      process.kill()
+      process.wait()
+
+
+# 役割：TCPでルームを作成し、残りのクライアントを参加させる
+# 戻り値：ルーム毎のトークンのリスト [[ホストのトークン, ゲストのトークン, ...], ...]
+def join_rooms(tcp_port, room_count, clients_per_room):
+   tcp_client = MultiplexedTCPClient("127.0.0.1", tcp_port)
+   if not tcp_client.connect():
+      raise RuntimeError("TCP接続に失敗しました。")
+   try:
+      room_names = [f"bench-room-{index}" for index in range(room_count)]
+      room_tokens = []
+      for room_name in room_names:
+         response = tcp_client.create_room(room_name, PASSWORD).result(timeout=30)
+         if response["error_message"]:
+            raise RuntimeError(response["error_message"])
+         room_tokens.append([response["token"]])
+
+      joins = [(room_index, room_name) for room_index, room_name in enumerate(room_names) for _ in range(clients_per_room - 1)]
+      while joins:
+         window, joins = joins[:JOIN_WINDOW], joins[JOIN_WINDOW:]
+         futures = [(room_index, room_name, tcp_client.join_room(room_name, PASSWORD)) for room_index, room_name in window]
+         for room_index, room_name, future in futures:
+            response = future.result(timeout=30)
+            if response["error_message"]:
+               # 混雑で拒否された場合はやり直す
+               joins.append((room_index, room_name))
+            else:
+               room_tokens[room_index].append(response["token"])
+      return room_names, room_tokens
+   finally:
+      tcp_client.disconnect()
+
+
+# 負荷をかけるクライアントの集合(送信スレッドと受信スレッド)
+class LoadGenerator:
+   def __init__(self, udp_port, room_names, room_tokens, capabilities, payload_size):
+      self.payload_size = payload_size
+      self.capabilities = capabilities
+      # クライアント毎の(UDPClient, ルーム名, トークン, ルームのインデックス)
+      self.clients = []
+      for room_index, (room_name, tokens) in enumerate(zip(room_names, room_tokens)):
+         for token in tokens:
+            udp_client = UDPClient("127.0.0.1", udp_port)
+            udp_client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            udp_client.sock.setblocking(False)
+            self.clients.append((udp_client, room_name, token, room_index))
+      self.room_sizes = [len(tokens) for tokens in room_tokens]
+      self.acked = 0 # INITIAL_ACKを受信したクライアント数
+      self.latencies = [] # 送信予定時刻からのレイテンシ(ナノ秒)
+      self.send_latencies = [] # 実際の送信時刻からのレイテンシ(ナノ秒)
+      self.received = 0 # 受信したチャット数
+      self.is_stopped = threading.Event()
+      self.selector = selectors.DefaultSelector()
+      for index, (udp_client, _, _, _) in enumerate(self.clients):
+         self.selector.register(udp_client.sock, selectors.EVENT_READ, index)
+
+   # 役割：全クライアントのINITIALの送信とINITIAL_ACKの待機(機能を指定しない場合は待たない)
+   # 戻り値：無し
+   def initialize(self):
+      for udp_client, room_name, token, _ in self.clients:
+         udp_client.send_message(UDPProtocolHandler.make_initial_message(room_name, token, "bench", capabilities=self.capabilities))
+      if not self.capabilities:
+         time.sleep(0.5)
+         return
+      deadline = time.monotonic() + 10
+      while self.acked < len(self.clients) and time.monotonic() < deadline:
+         time.sleep(0.05)
+      if self.acked < len(self.clients):
+         raise RuntimeError(f"INITIAL_ACKを受信できませんでした({self.acked}/{len(self.clients)})。")
+
+   # 役割：受信したデータグラムの処理(受信スレッド)
+   # 戻り値：無し
+   def recieve(self):
+      while not self.is_stopped.is_set():
+         for key, _ in self.selector.select(timeout=0.1):
+            udp_client = self.clients[key.data][0]
+            while True:
+               try:
+                  data = udp_client.sock.recv(65535)
+               except BlockingIOError:
+                  break
+               now = time.perf_counter_ns()
+               for message in UDPProtocolHandler.split_batch(data):
+                  parsed_message = UDPProtocolHandler.parse_message(message)
+                  if parsed_message is None:
+                     continue
+                  content = parsed_message["content"]
+                  if content["type"] == "CHAT":
+                     scheduled_time, send_time, is_measured = content["chat_data"].split(" ", 3)[:3]
+                     if is_measured == "1":
+                        self.latencies.append(now - int(scheduled_time))
+                        self.send_latencies.append(now - int(send_time))
+                        self.received += 1
+                  elif content["type"] == "INITIAL_ACK":
+                     udp_client.handle_message(message)
+                     self.acked += 1
+
+   # 役割：全クライアントからの合計rate×クライアント数/秒でのチャットの送信(送信スレッド)
+   # 予定時刻から遅れても送信間隔を詰めて追い付く(送信が遅れた分は送信予定時刻からのレイテンシに含まれる)
+   # 戻り値：(計測期間中に送信したチャット数, 受信されるべきチャット数)
+   def send(self, rate, warmup, duration):
+      padding = "x" * self.payload_size
+      interval = 1000000000 / (rate * len(self.clients)) # ナノ秒
+      start = time.perf_counter_ns()
+      end = start + int((warmup + duration) * 1000000000)
+      measure_start = start + int(warmup * 1000000000)
+      sent = 0
+      expected = 0
+      index = 0
+      while True:
+         scheduled = start + int(index * interval)
+         now = time.perf_counter_ns()
+         if scheduled >= end:
+            break
+         if scheduled > now:
+            time.sleep((scheduled - now) / 1000000000)
+         is_measured = scheduled >= measure_start
+         udp_client, room_name, token, room_index = self.clients[index % len(self.clients)]
+         chat_data = f"{scheduled} {time.perf_counter_ns()} {int(is_measured)} {padding}"
+         if udp_client.session_handle:
+            room_name, token = "", udp_client.session_handle
+         udp_client.send_message(UDPProtocolHandler.make_chat_message(room_name, token, "bench", chat_data, udp_client.content_format))
+         if is_measured:
+            sent += 1
+            expected += self.room_sizes[room_index] - 1
+         index += 1
+      return sent, expected
+
+   # 役割：退出メッセージの送信とソケットの解放(受信スレッドの停止後に呼ぶ)
+   # 戻り値：無し
+   def close(self):
+      for udp_client, room_name, token, _ in self.clients:
+         if udp_client.session_handle:
+            room_name, token = "", udp_client.session_handle
+         udp_client.send_message(UDPProtocolHandler.make_leave_message(room_name, token, "bench"))
+         udp_client.close()
+
+
+# 役割：レイテンシのパーセンタイル(マイクロ秒)の計算
+# 戻り値：{"p50": ..., "p99": ..., "p999": ..., "max": ..., "mean": ...}
+def summarize_latencies(latencies):
+   if not latencies:
+      return None
+   latencies = sorted(latencies)
+   def percentile(ratio):
+      return latencies[min(len(latencies) - 1, int(len(latencies) * ratio))] / 1000
+   return {
+      "p50": percentile(0.5),
+      "p99": percentile(0.99),
+      "p999": percentile(0.999),
+      "max": latencies[-1] / 1000,
+      "mean": sum(latencies) / len(latencies) / 1000,
+   }
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--rooms", type=int, default=10, help="ルーム数(R)")
+   parser.add_argument("--clients-per-room", type=int, default=8, help="1ルームあたりのクライアント数(M)")
+   parser.add_argument("--rate", type=float, default=10, help="1クライアントあたりの送信レート(メッセージ/秒)")
+   parser.add_argument("--duration", type=float, default=10, help="計測時間(秒)")
+   parser.add_argument("--warmup", type=float, default=1, help="計測前に送信する時間(秒)")
+   parser.add_argument("--drain", type=float, default=1, help="送信終了後に受信を待つ時間(秒)")
+   parser.add_argument("--payload-size", type=int, default=64, help="chat_dataに追加するバイト数")
+   parser.add_argument("--legacy-clients", action="store_true", help="INITIALで機能を通知しない(JSON形式、トークンで送信する)")
+   parser.add_argument("--tcp-mode", choices=["thread", "asyncio"], default="asyncio", help="サーバーのTCPの実行モード")
+   parser.add_argument("--udp-mode", choices=["thread", "asyncio", "multiprocess"], default="thread", help="サーバーのUDPの実行モード")
+   parser.add_argument("--udp-workers", type=int, default=None, help="multiprocessモードのワーカープロセス数")
+   parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[], help="サーバーにそのまま渡す引数(最後に指定する)")
+   parser.add_argument("--output", default="-", help="結果のJSONを1行追記するファイル(-の場合は標準出力)")
+   args = parser.parse_args()
+   if args.clients_per_room < 2:
+      parser.error("--clients-per-roomは2以上で指定してください。")
+
+   process, tcp_port, udp_port = start_server(args)
+   try:
+      room_names, room_tokens = join_rooms(tcp_port, args.rooms, args.clients_per_room)
+      capabilities = None if args.legacy_clients else UDPProtocolHandler.CAPABILITIES
+      generator = LoadGenerator(udp_port, room_names, room_tokens, capabilities, args.payload_size)
+      recieve_thread = threading.Thread(target=generator.recieve, daemon=True)
+      recieve_thread.start()
+      generator.initialize()
+
+      start = time.perf_counter()
+      sent, expected = generator.send(args.rate, args.warmup, args.duration)
+      elapsed = time.perf_counter() - start - args.warmup
+      time.sleep(args.drain)
+      generator.is_stopped.set()
+      recieve_thread.join()
+      generator.close()
+   finally:
+      stop_server(process)
+
+   result = {
+      "config": {
+         "tcp_mode": args.tcp_mode,
+         "udp_mode": args.udp_mode,
+         "udp_workers": args.udp_workers,
+         "server_args": args.server_args,
+         "rooms": args.rooms,
+         "clients_per_room": args.clients_per_room,
+         "rate": args.rate,
+         "duration": args.duration,
+         "payload_size": args.payload_size,
+         "legacy_clients": args.legacy_clients,
+      },
+      "timestamp": time.time(),
+      "sent": sent,
+      "expected": expected,
+      "received": generator.received,
+      "loss_rate": 1 - generator.received / expected if expected else 0,
+      "sent_rate": sent / elapsed,
+      "target_rate": args.rate * len(generator.clients),
+      "delivery_rate": generator.received / elapsed,
+      "latency_us": summarize_latencies(generator.latencies),
+      "send_latency_us": summarize_latencies(generator.send_latencies),
+   }
+   line = json.dumps(result, ensure_ascii=False)
+   if args.output == "-":
+      sys.stdout.write(line + "\n")
+   else:
+      with open(args.output, "a") as file:
+         file.write(line + "\n")
+      latency = result["latency_us"] or {}
+      send_latency = result["send_latency_us"] or {}
+      sys.stdout.write(
+         f"送信 {result['sent_rate']:.0f} msg/s (目標 {result['target_rate']:.0f}), 受信 {result['delivery_rate']:.0f} msg/s, 損失 {result['loss_rate']:.2%}, "
+         f"p50 {latency.get('p50', 0):.0f} us, p99 {latency.get('p99', 0):.0f} us, p999 {latency.get('p999', 0):.0f} us "
+         f"(送信時刻から p50 {send_latency.get('p50', 0):.0f} us, p99 {send_latency.get('p99', 0):.0f} us)\n"
+      )
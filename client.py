@@ -1,6 +1,11 @@
 import socket
 import threading
-from modules import TCPProtocolHandler,UDPProtocolHandler
+import struct
+import itertools
+import random
+import time
+import concurrent.futures
+from modules import TCPProtocolHandler,TCPFrameReader,UDPProtocolHandler,FragmentReassembler
 
 # ★クラス毎の役割と連携
 # 【役割】
@@ -8,6 +13,7 @@ from modules import TCPProtocolHandler,UDPProtocolHandler
 # UDPProtocolHandler:UDPデータの作成、パース
 # ChatClient:ユーザーインターフェースを提供し、ルームの作成、参加、チャット開始などの操作を処理
 # TCPClient:TCP通信でのデータの送受信
+# MultiplexedTCPClient:1つのTCP接続で複数のリクエストを並行して送受信(bot、管理ツール用)
 # UDPClient:UDP通信でのデータの送受信
 # 【連携】
 # ChatClientでユーザーの要求を受信→TCP/UDPProtocolHandlerで送信データの作成→TCP/UDPClientでデータの送信と受信→TCP/UDPProtocolHandlerで受信データの解析→ChatClientでユーザーにデータ表示
@@ -34,29 +40,16 @@ class TCPClient:
       return False
     
   # 役割：サーバーからのレスポンスを取得
-  # 戻り値：レスポンスデータ
+  # 戻り値：レスポンスデータ(bytearray)。接続が閉じられた場合やエラーの場合はNone
   def recieve_response(self):
       try:
-        recieved_header_data = b""
-        while len(recieved_header_data) < 32:
-          chunk = self.sock.recv(32 - len(recieved_header_data))
-          recieved_header_data += chunk
-
-        room_name_size = recieved_header_data[0]
-        operation_payload_size = int.from_bytes(recieved_header_data[3:], "big")
-        total_body_size = room_name_size + operation_payload_size
-        
-        recieved_body_data = b""
-        while len(recieved_body_data) < total_body_size:
-          chunk = self.sock.recv(total_body_size - len(recieved_body_data))
-          recieved_body_data += chunk
-        
-        response = recieved_header_data + recieved_body_data
-        return response
+        return TCPFrameReader(self.sock).read_frame()
       except socket.timeout as e:
         print(e)
       except socket.error as e:
         print(e)
+      except ValueError as e:
+        print(e)
     
   # 役割：サーバーへリクエストを送信
   # 戻り値：レスポンスデータ
@@ -65,11 +58,15 @@ class TCPClient:
       self.sock.sendall(request)
 
       response = self.recieve_response()
+      if response is None:
+        return None
       parsed_response = TCPProtocolHandler.parse_data(response)["operation_payload"]
       if parsed_response["error_message"]:
         return parsed_response
 
       response = self.recieve_response()
+      if response is None:
+        return None
       parsed_response = TCPProtocolHandler.parse_data(response)["operation_payload"]
       return parsed_response
     except socket.timeout as e:
@@ -86,12 +83,148 @@ class TCPClient:
     self.sock = None
     print("TCP接続を解除しました。")
 
+# 1つのTCP接続で複数のリクエストを並行して送受信する(bot、管理ツール用)
+# リクエストにrequest_idを付けて送信し、受信スレッドがレスポンスのrequest_idに対応するFutureを完了させる。
+# Futureの結果はTCPClient.send_requestと同じoperation_payload(dict)。
+class MultiplexedTCPClient:
+  def __init__(self, server_ip, tcp_port):
+    self.server_address = (server_ip, tcp_port)
+    self.sock = None
+    self.request_ids = itertools.count(1)
+    self.futures = {} # request_id -> レスポンス待ちのFuture
+    self.lock = threading.Lock() # futures用のロック
+    self.send_lock = threading.Lock() # 送信用のロック
+    self.recieve_thread = None
+
+  # 役割：サーバーへの接続とレスポンスの受信スレッドの起動
+  # 戻り値：真偽値
+  def connect(self):
+    if self.sock:
+      return True
+
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.settimeout(2)
+    try:
+      self.sock.connect(self.server_address)
+    except socket.error as e:
+      print(e)
+      self.sock = None
+      return False
+    # 接続後は受信スレッドがレスポンスを待ち続けるためタイムアウトを解除する
+    self.sock.settimeout(None)
+    self.recieve_thread = threading.Thread(target=self.recieve_responses, daemon=True)
+    self.recieve_thread.start()
+    return True
+
+  # 役割：request_idを付けたリクエストの送信
+  # 戻り値：レスポンス(operation_payload)を結果とするFuture
+  def submit(self, make_request, *args):
+    future = concurrent.futures.Future()
+    request_id = next(self.request_ids)
+    request = make_request(*args, request_id=request_id)
+    if not request:
+      future.set_exception(ValueError("送信できるデータサイズを超過しています。"))
+      return future
+
+    with self.lock:
+      self.futures[request_id] = future
+    try:
+      with self.send_lock:
+        self.sock.sendall(request)
+    except socket.error as e:
+      with self.lock:
+        self.futures.pop(request_id, None)
+      future.set_exception(e)
+    return future
+
+  # 役割：ルーム作成
+  # 戻り値：Future
+  def create_room(self, room_name, password):
+    return self.submit(TCPProtocolHandler.make_create_room_request, room_name, password)
+
+  # 役割：ルーム一覧取得(versionを指定した場合は差分を取得)
+  # 戻り値：Future
+  def get_room_list(self, version=None):
+    return self.submit(TCPProtocolHandler.make_get_room_list_request, version)
+
+  # 役割：ページ指定、前方一致でのルーム一覧取得
+  # 戻り値：Future
+  def get_room_list_page(self, offset=0, limit=20, prefix=""):
+    return self.submit(TCPProtocolHandler.make_get_room_list_page_request, offset, limit, prefix)
+
+  # 役割：ルーム参加
+  # 戻り値：Future
+  def join_room(self, room_name, password):
+    return self.submit(TCPProtocolHandler.make_join_room_request, room_name, password)
+
+  # 役割：メトリクスの取得(サーバーと同じホストからのみ)
+  # 戻り値：Future
+  def get_metrics(self, format="json"):
+    return self.submit(TCPProtocolHandler.make_metrics_request, format)
+
+  # 役割：レスポンスの受信(受信スレッド)
+  # バリデートに失敗した場合はバリデートレスポンス、成功した場合は完了レスポンスでFutureを完了させる
+  # 戻り値：無し
+  def recieve_responses(self):
+    reader = TCPFrameReader(self.sock)
+    try:
+      while True:
+        response = reader.read_frame()
+        if response is None:
+          break
+        parsed_response = TCPProtocolHandler.parse_data(response)
+        operation_payload = parsed_response["operation_payload"]
+        if parsed_response["state"] == 1 and not operation_payload["error_message"]:
+          continue
+
+        with self.lock:
+          future = self.futures.pop(operation_payload.get("request_id"), None)
+        if future:
+          future.set_result(operation_payload)
+    except (socket.error, ValueError) as e:
+      print(e)
+    finally:
+      # 接続が閉じられた場合はレスポンス待ちのFutureを全てエラーにする
+      with self.lock:
+        futures = list(self.futures.values())
+        self.futures.clear()
+      for future in futures:
+        future.set_exception(ConnectionError("TCP接続が閉じられました。"))
+
+  # 役割：サーバーとの接続を解除する
+  # 戻り値：無し
+  def disconnect(self):
+    if not self.sock:
+      return
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.recieve_thread.join()
+    self.sock.close()
+    self.sock = None
+    print("TCP接続を解除しました。")
+
 # UDP通信でのデータの送受信
 class UDPClient:
-  def __init__(self, server_ip, udp_port):
+  MISSING_SEQUENCES_MAX_SIZE = 1024 # 欠落として補完を待つシーケンス番号の最大件数
+  FRAGMENT_BURST_SIZE = 8 # 続けて送信する断片の数(サーバーの受信バッファ、送信キュー、multiprocessモードのワーカー間の転送があふれないよう、この数毎に待つ)
+  FRAGMENT_BURST_INTERVAL = 0.002 # 断片をFRAGMENT_BURST_SIZE件送信する毎に待つ時間(秒)
+
+  def __init__(self, server_ip, udp_port, max_datagram_size=UDPProtocolHandler.DATAGRAM_MAX_BYTE_SIZE):
     self.server_address = (server_ip, udp_port)
+    self.max_datagram_size = max_datagram_size # 分割して送信する場合の断片のデータグラムの最大バイト数
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.sock.settimeout(1)
+    self.content_format = UDPProtocolHandler.CONTENT_FORMAT_JSON # 送信するcontentの形式(サーバーがINITIAL_ACKでバイナリ形式に同意したら切り替える)
+    self.session_handle = None # トークンの代わりに送信するセッションハンドル(サーバーがINITIAL_ACKで発行する)
+    self.last_sequence = None # 受信したチャットの最新のシーケンス番号
+    self.sent_count = 0 # last_sequenceの受信以降に送信したチャットの件数(自分のチャットはリレーされないため番号が飛ぶ)
+    self.missing_sequences = set() # 欠落を検出して補完を要求したシーケンス番号
+    self.on_gap = None # 欠落を検出した場合に(開始番号, 終了番号)を渡して呼ぶ関数
+    self.fragments_enabled = False # 長いチャットを分割して送信するかどうか(サーバーがINITIAL_ACKで分割に同意したら有効にする)
+    self.message_ids = itertools.count(random.getrandbits(32)) # 分割したチャットのメッセージIDの採番(他の送信者のIDと重ならないようランダムな値から始める)
+    self.reassembler = FragmentReassembler() # 受信した断片の再構成
 
   # 役割：データの送信
   # 戻り値：無し
@@ -102,36 +235,120 @@ class UDPClient:
       except socket.error as e:
         print(f"UDP 通信エラー:{e}")
 
+  # 役割：チャットの送信
+  # サーバーが分割に同意している場合、従来の受信バッファを超えるチャットは断片に分けて送信する
+  # (断片は分割に同意していないクライアントに届かず、履歴にも残らないため、従来の受信バッファに収まるチャットは分割しない)
+  # 同意していない場合、従来のサーバーの受信バッファを超えるチャットは送信しない
+  # 戻り値：送信した場合はTrue
+  def send_chat(self, message):
+    if len(message) <= UDPProtocolHandler.LEGACY_RECEIVE_BUFFER_SIZE:
+      self.send_message(message)
+      self.sent_count += 1
+      return True
+    if not self.fragments_enabled:
+      print("メッセージが長すぎるため送信できません。")
+      return False
+
+    messages = UDPProtocolHandler.make_fragments(message, next(self.message_ids) & 0xFFFFFFFF, self.max_datagram_size)
+    if messages is None:
+      return False
+    for index, fragment in enumerate(messages):
+      if index and index % self.FRAGMENT_BURST_SIZE == 0:
+        time.sleep(self.FRAGMENT_BURST_INTERVAL)
+      self.send_message(fragment)
+    # 分割したチャットはシーケンス番号を使わないため、欠落の検出の送信数に含めない
+    if len(messages) == 1:
+      self.sent_count += 1
+    return True
+
   # 役割：メッセージ受信
   # 戻り値：無し
   def recieve_message(self):
     while not is_chat_active.is_set():
       try:
-        data, _ = self.sock.recvfrom(4096)
-        parsed_data = UDPProtocolHandler.parse_message(data)["content"]
-        # print(f"{parsed_data}を受信しました")
-
-        # 通常のチャット時
-        if parsed_data["type"] == "CHAT":
-          print(f"{parsed_data['user_name']}: {parsed_data['chat_data']}")
-        
-        # チャットルームのクローズ時
-        elif parsed_data["type"] == "CLOSE":
-          is_chat_active.set()
-          print(f"{parsed_data['chat_data']}")
-
-        # クライアントのタイムアウト時
-        elif parsed_data["type"] == "TIMEOUT":
-          is_chat_active.set()
-          print(f"{parsed_data['chat_data']}")
-
-        # システム終了時(未実装)
-        elif parsed_data["type"] == "STOP":
-          is_chat_active.set()
-          print(f"{parsed_data['chat_data']}")
+        data, _ = self.sock.recvfrom(UDPProtocolHandler.RECEIVE_BUFFER_SIZE)
+        # サーバーが複数のメッセージを1つのデータグラムにまとめている場合は分割して順番に処理する
+        try:
+          messages = UDPProtocolHandler.split_batch(data)
+        except struct.error as e:
+          print(f"パケット解析中にエラーが発生しました。:{e}")
+          continue
+        for message in messages:
+          self.handle_message(message)
       except socket.timeout:
         continue
 
+  # 役割：受信したメッセージの処理
+  # 戻り値：無し
+  def handle_message(self, message):
+    # 分割されたチャットは全ての断片が揃ってから処理する
+    if UDPProtocolHandler.is_fragment(message):
+      message = self.reassembler.add(message)
+      if message is None:
+        return
+    parsed_message = UDPProtocolHandler.parse_message(message)
+    # 解析できないメッセージは無視する(サーバーはチャットのcontentを解析せずにリレーするため)
+    if parsed_message is None:
+      return
+    parsed_data = parsed_message["content"]
+    # print(f"{parsed_data}を受信しました")
+
+    # 通常のチャット時
+    if parsed_data["type"] == "CHAT":
+      if not self.check_sequence(UDPProtocolHandler.parse_sequence(message)):
+        return
+      print(f"{parsed_data['user_name']}: {parsed_data['chat_data']}")
+    
+    # チャットルームのクローズ時
+    elif parsed_data["type"] == "CLOSE":
+      is_chat_active.set()
+      print(f"{parsed_data['chat_data']}")
+
+    # クライアントのタイムアウト時
+    elif parsed_data["type"] == "TIMEOUT":
+      is_chat_active.set()
+      print(f"{parsed_data['chat_data']}")
+
+    # システム終了時(未実装)
+    elif parsed_data["type"] == "STOP":
+      is_chat_active.set()
+      print(f"{parsed_data['chat_data']}")
+
+    # INITIALへの応答時(サーバーが同意した機能を反映する)
+    elif parsed_data["type"] == "INITIAL_ACK":
+      if UDPProtocolHandler.CAPABILITY_BINARY in parsed_data["capabilities"]:
+        self.content_format = UDPProtocolHandler.CONTENT_FORMAT_BINARY
+      if parsed_data.get("session_handle"):
+        self.session_handle = bytes.fromhex(parsed_data["session_handle"])
+      if UDPProtocolHandler.CAPABILITY_FRAGMENT in parsed_data["capabilities"]:
+        self.fragments_enabled = True
+
+  # 役割：シーケンス番号による欠落の検出と、再送されたチャットの判定
+  # 前回の番号から飛んだ数が自分の送信数より多い場合は欠落とみなし、on_gapで補完を要求する
+  # 戻り値：表示する=True、表示済み(重複)=False
+  def check_sequence(self, sequence):
+    if sequence is None:
+      return True
+    if self.last_sequence is None or sequence > self.last_sequence:
+      if self.last_sequence is not None and sequence - self.last_sequence - 1 > self.sent_count:
+        # 補完を要求するのは直近のMISSING_SEQUENCES_MAX_SIZE件まで
+        start = max(self.last_sequence + 1, sequence - self.MISSING_SEQUENCES_MAX_SIZE)
+        self.missing_sequences.update(range(start, sequence))
+        if self.on_gap:
+          self.on_gap(start, sequence - 1)
+        # 自分が送信した番号は補完されないため、古いものから忘れる
+        if len(self.missing_sequences) > self.MISSING_SEQUENCES_MAX_SIZE:
+          self.missing_sequences = {missing for missing in self.missing_sequences if missing >= sequence - self.MISSING_SEQUENCES_MAX_SIZE}
+      self.last_sequence = sequence
+      self.sent_count = 0
+      return True
+
+    # 補完を要求した番号のみ表示する
+    if sequence in self.missing_sequences:
+      self.missing_sequences.discard(sequence)
+      return True
+    return False
+
   # 役割：UDPソケットの解放
   # 戻り値：無し
   def close(self):
@@ -139,6 +356,9 @@ class UDPClient:
 
 # ユーザーインターフェースを提供し、ルームの作成、参加、チャット開始などの操作を処理。
 class ChatClient:
+  ROOM_LIST_PAGE_SIZE = 20 # ルーム一覧の1ページに表示する件数
+  HISTORY_COUNT = 20 # チャット開始時に表示する直近のチャットの件数
+
   def __init__(self, tcp_client, udp_client):
     self.tcp_client = tcp_client
     self.udp_client = udp_client
@@ -194,13 +414,23 @@ class ChatClient:
               continue
 
         elif choice == "2":
-            # ルーム一覧取得依頼
-            room_list, error_messaage = self.get_room_list_request()
-            if error_messaage:
+            # ルーム一覧を名前の前方一致で絞り込み、1ページずつ取得する
+            prefix = input("ルーム名の先頭の文字を入力してください(空の場合は全てのルーム)。").strip()
+            room_list = []
+            offset = 0
+            while offset is not None:
+              # ルーム一覧取得依頼
+              page, offset, error_messaage = self.get_room_list_page_request(prefix, offset)
+              if error_messaage:
+                break
+              for room_name in page:
+                print(room_name)
+              room_list += page
+              if offset is not None and input("続きを表示する場合はnを入力してください。").strip() != "n":
+                break
+            if not room_list:
               print(error_messaage)
               continue
-            for room_name in room_list:
-              print(room_name)
             while True:
               selected_room_name = input("参加したいルームを選択してください。").strip()
               if not selected_room_name:
@@ -257,20 +487,24 @@ class ChatClient:
       self.room_token = (room_name, response["token"])
       return response["token"], None
 
-  # 役割：ルーム一覧取得
-  # 戻り値：成功=(ルーム一覧,None), 失敗=(None,エラーメッセージ)
-  def get_room_list_request(self):
+  # 役割：ページ指定、前方一致でのルーム一覧取得
+  # 戻り値：成功=(ルーム一覧,次のページのオフセット(最後のページの場合はNone),None), 失敗=(None,None,エラーメッセージ)
+  def get_room_list_page_request(self, prefix, offset):
     # リクエストの作成
-    request = TCPProtocolHandler.make_get_room_list_request()
+    request = TCPProtocolHandler.make_get_room_list_page_request(offset, self.ROOM_LIST_PAGE_SIZE, prefix)
+    if not request:
+      return None, None, "送信できるデータサイズを超過しています。"
     # サーバーにルーム一覧取得依頼
     response = self.tcp_client.send_request(request)
 
     if response is None:
-      return None, "エラーが発生しました。"
+      return None, None, "エラーが発生しました。"
     elif response["error_message"]:
-      return None, response["error_message"]
+      return None, None, response["error_message"]
+    elif not response["room_list"]:
+      return None, None, "該当するルームが存在しません。" if prefix else "現在ルームが存在しません。"
     else:
-      return response["room_list"], None
+      return response["room_list"], response.get("next_offset"), None
 
   # 役割：ルーム参加
   # 戻り値：成功=(トークン,None)、失敗=(None,エラーメッセージ)
@@ -299,7 +533,16 @@ class ChatClient:
     recieve_message_thread.start()
 
     # tcpとudpでクライアントのポートが異なるためチャット開始時に自動的にudpメッセージをサーバーに送りアドレスを更新する
-    message = UDPProtocolHandler.make_initial_message(room_name=self.room_token[0], token=self.room_token[1], user_name=self.user_name)
+    # 同時に対応している機能をサーバーに通知する。サーバーが同意するまでは従来のJSON形式で送信する。
+    self.udp_client.content_format = UDPProtocolHandler.CONTENT_FORMAT_JSON
+    self.udp_client.session_handle = None
+    self.udp_client.fragments_enabled = False
+    self.udp_client.last_sequence = None
+    self.udp_client.sent_count = 0
+    self.udp_client.missing_sequences = set()
+    self.udp_client.on_gap = self.request_history
+    # 参加前の直近のチャットも受信する
+    message = UDPProtocolHandler.make_initial_message(room_name=self.room_token[0], token=self.room_token[1], user_name=self.user_name, capabilities=UDPProtocolHandler.CAPABILITIES, history_count=self.HISTORY_COUNT)
     self.udp_client.send_message(message)
 
     try:
@@ -309,18 +552,37 @@ class ChatClient:
         if not data:
           continue
         # メッセージの作成
-        message = UDPProtocolHandler.make_chat_message(room_name=self.room_token[0], token=self.room_token[1], user_name=self.user_name, chat_data=data)
+        room_name, token = self.get_routing()
+        message = UDPProtocolHandler.make_chat_message(room_name=room_name, token=token, user_name=self.user_name, chat_data=data, content_format=self.udp_client.content_format)
+        # サイズの超過などで作成できなかった場合(理由は作成時に表示される)
+        if message is None:
+          continue
         # メッセージの送信
-        self.udp_client.send_message(message)
+        self.udp_client.send_chat(message)
     except KeyboardInterrupt as e:
       print(e)
     finally:
       # 退出時には退出メッセージを送信
-      message = UDPProtocolHandler.make_leave_message(room_name=self.room_token[0], token=self.room_token[1], user_name=self.user_name)
+      room_name, token = self.get_routing()
+      message = UDPProtocolHandler.make_leave_message(room_name=room_name, token=token, user_name=self.user_name)
       self.udp_client.send_message(message)
       is_chat_active.set()
       recieve_message_thread.join()
 
+  # 役割：欠落したチャットの再送の要求(受信スレッドから呼ばれる)
+  # 戻り値：無し
+  def request_history(self, start, end):
+    room_name, token = self.get_routing()
+    message = UDPProtocolHandler.make_history_message(room_name=room_name, token=token, user_name=self.user_name, start=start, end=end)
+    self.udp_client.send_message(message)
+
+  # 役割：メッセージに付けるルーム名とトークンの取得
+  # 戻り値：セッションハンドルが発行されている場合は("", セッションハンドル)、それ以外は(ルーム名, トークン)
+  def get_routing(self):
+    if self.udp_client.session_handle:
+      return "", self.udp_client.session_handle
+    return self.room_token
+
 if __name__ == "__main__":
   is_chat_active = threading.Event()
 
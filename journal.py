@@ -0,0 +1,172 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# ルームとセッションの状態のジャーナル(サーバーの再起動後もトークンを使えるようにする)
+# 状態の変更をレコードとして追記専用のログ(journal-<世代>.log)にmmap経由で書き込み、
+# 一定件数ごとに状態全体のスナップショット(snapshot.json)を書いて古いログを削除する(コンパクション)。
+# 起動時はスナップショットを読み込み、その世代以降のログのレコードを順番に適用する。
+#
+# ログのレコード: [サイズ 4byte][CRC32 4byte][レコード(JSON)]
+# ファイルはFILE_GROWTH単位で拡張し、未使用の部分は0で埋まっているためサイズ0のヘッダーが終端になる。
+# レコードは本体を書いてからヘッダーを書くため、書き込み途中で停止した場合も途中のレコードは読み込まれない。
+# レコードの内容(JSONの配列)と適用はChatServerが行い、このクラスはファイルの読み書きのみ行う。
+class StateJournal:
+  RECORD_HEADER = struct.Struct(">II") # レコードのサイズ、CRC32
+  FILE_GROWTH = 16 * 1024 * 1024 # ログファイルを拡張する単位(バイト)
+  SNAPSHOT_NAME = "snapshot.json"
+  ENCODER = json.JSONEncoder(separators=(",", ":")) # 区切りの空白を省く(json.dumpsに引数を渡すと毎回エンコーダーを作成するため使い回す)
+
+  def __init__(self, directory, compact_records=100000, sync_interval=1):
+    self.directory = directory
+    self.compact_records = compact_records # ログのレコード数がこれを超えたらコンパクションする
+    self.sync_interval = sync_interval # ログをディスクに書き出す間隔(秒)
+    self.lock = threading.Lock() # ログへの書き込み用のロック
+    self.generation = 0 # 現在書き込んでいるログの世代
+    self.file = None
+    self.map = None
+    self.offset = 0 # 次のレコードを書き込む位置
+    self.record_count = 0 # 現在のログのレコード数
+    self.make_snapshot = None # 状態全体を返す関数(コンパクション時に呼ぶ)
+
+  # 役割：スナップショットとログの読み込み
+  # 戻り値：(スナップショットの状態(無い場合はNone), スナップショット以降のレコードのリスト)
+  def load(self):
+    os.makedirs(self.directory, mode=0o700, exist_ok=True)
+    state = None
+    snapshot_generation = 0
+    snapshot_path = os.path.join(self.directory, self.SNAPSHOT_NAME)
+    if os.path.exists(snapshot_path):
+      with open(snapshot_path, "rb") as file:
+        snapshot = json.loads(file.read())
+      state = snapshot["state"]
+      snapshot_generation = snapshot["generation"]
+
+    records = []
+    generations = self.list_generations()
+    for generation in generations:
+      if generation >= snapshot_generation:
+        records.extend(self.read_log(self.log_path(generation)))
+    self.generation = max(generations + [snapshot_generation])
+    return state, records
+
+  # 役割：ログの書き込みの開始(起動時に1回スナップショットを書き、定期的な書き出しとコンパクションのスレッドを起動する)
+  # make_snapshotは状態全体(JSONに変換できる値)を返す関数
+  # 戻り値：無し
+  def start(self, make_snapshot):
+    self.make_snapshot = make_snapshot
+    self.compact()
+    threading.Thread(target=self.run, daemon=True).start()
+
+  # 役割：レコードの追記
+  # 戻り値：無し
+  def append(self, record):
+    data = self.ENCODER.encode(record).encode("utf-8")
+    size = self.RECORD_HEADER.size + len(data)
+    with self.lock:
+      # 停止後の変更は記録しない
+      if self.map is None:
+        return
+      if self.offset + size + self.RECORD_HEADER.size > len(self.map):
+        self.map.resize(len(self.map) + max(self.FILE_GROWTH, size))
+      # 本体を書いてからヘッダーを書く
+      body_offset = self.offset + self.RECORD_HEADER.size
+      self.map[body_offset:body_offset + len(data)] = data
+      self.RECORD_HEADER.pack_into(self.map, self.offset, len(data), zlib.crc32(data))
+      self.offset += size
+      self.record_count += 1
+
+  # 役割：ログのディスクへの書き出しとコンパクション(定期実行)
+  # 戻り値：無し
+  def run(self):
+    while True:
+      time.sleep(self.sync_interval)
+      with self.lock:
+        if self.map is None:
+          return
+        self.map.flush()
+        should_compact = self.record_count >= self.compact_records
+      if should_compact:
+        self.compact()
+
+  # 役割：コンパクション(新しい世代のログへの切り替え、スナップショットの書き込み、古いログの削除)
+  # ログを切り替えてから状態を取得するため、切り替え前のレコードは必ずスナップショットに含まれる。
+  # 切り替え後のレコードがスナップショットにも含まれる場合があるため、レコードの適用は何度行っても同じ結果になるようにする。
+  # 戻り値：無し
+  def compact(self):
+    with self.lock:
+      old_map = self.map
+      old_file = self.file
+      self.generation += 1
+      self.file = open(self.log_path(self.generation), "w+b")
+      os.chmod(self.log_path(self.generation), 0o600)
+      self.file.truncate(self.FILE_GROWTH)
+      self.map = mmap.mmap(self.file.fileno(), self.FILE_GROWTH)
+      self.offset = 0
+      self.record_count = 0
+      generation = self.generation
+    if old_map:
+      old_map.flush()
+      old_map.close()
+      old_file.close()
+
+    # スナップショットは一時ファイルに書いてから置き換える
+    snapshot_path = os.path.join(self.directory, self.SNAPSHOT_NAME)
+    temporary_path = snapshot_path + ".tmp"
+    data = self.ENCODER.encode({"generation": generation, "state": self.make_snapshot()}).encode("utf-8")
+    with open(temporary_path, "wb") as file:
+      os.chmod(temporary_path, 0o600)
+      file.write(data)
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(temporary_path, snapshot_path)
+
+    for old_generation in self.list_generations():
+      if old_generation < generation:
+        os.remove(self.log_path(old_generation))
+
+  # 役割：ログの書き出しとファイルのクローズ(サーバーの停止時)
+  # 戻り値：無し
+  def close(self):
+    with self.lock:
+      if self.map:
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+        self.map = None
+
+  # 役割：ログのレコードの読み込み(壊れたレコードがあればそこで終了する)
+  # 戻り値：レコードのリスト
+  def read_log(self, path):
+    with open(path, "rb") as file:
+      data = file.read()
+    bodies = []
+    offset = 0
+    while offset + self.RECORD_HEADER.size <= len(data):
+      size, crc = self.RECORD_HEADER.unpack_from(data, offset)
+      body_offset = offset + self.RECORD_HEADER.size
+      body = data[body_offset:body_offset + size]
+      if size == 0 or len(body) < size or zlib.crc32(body) != crc:
+        break
+      bodies.append(body)
+      offset = body_offset + size
+    # レコード毎にデコードせず、1つのJSONの配列としてまとめてデコードする
+    return json.loads(b"[" + b",".join(bodies) + b"]")
+
+  # 役割：ログファイルのパスの取得
+  # 戻り値：パス
+  def log_path(self, generation):
+    return os.path.join(self.directory, f"journal-{generation}.log")
+
+  # 役割：存在するログの世代の取得
+  # 戻り値：世代のリスト(昇順)
+  def list_generations(self):
+    generations = []
+    for name in os.listdir(self.directory):
+      if name.startswith("journal-") and name.endswith(".log"):
+        generations.append(int(name[len("journal-"):-len(".log")]))
+    return sorted(generations)
@@ -0,0 +1,131 @@
+import atexit
+import collections
+import itertools
+import sys
+import threading
+import time
+
+# ログの非同期出力
+# ログは上限付きのキューに積み、出力スレッドが定期的にまとめて標準出力に書き込む。端末やパイプへの書き込みが遅くても
+# リクエストやメッセージを処理するスレッドは待たされない。キューが一杯の場合は破棄し、破棄数を後で出力する。
+# 文字列の整形(format % args)は出力スレッドで行うため、記録する側は整形の負荷がかからず、レベルで破棄したログは整形しない。
+#
+# メッセージ毎のイベント(UDPメッセージの受信、TCPリクエストの処理結果など)はmessageで記録し、
+# message_sample_rate件に1件だけ出力する。0の場合は記録しないため、呼び出し側は
+#   if log.message_sample_rate:
+#     log.message(...)
+# のように確認してから呼び、無効な場合は属性の確認のみで済ませる。
+class LogPipeline:
+  DEBUG = 10
+  INFO = 20
+  WARNING = 30
+  ERROR = 40
+  LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+  LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+  QUEUE_SIZE = 10000 # キューに積むログの最大件数
+  FLUSH_INTERVAL = 0.1 # 出力スレッドがキューを確認する間隔(秒)
+
+  def __init__(self, level=INFO, queue_size=QUEUE_SIZE, message_sample_rate=1):
+    self.level = level # このレベル未満のログは破棄する
+    self.queue_size = queue_size
+    self.message_sample_rate = message_sample_rate # メッセージ毎のイベントを出力する間隔(件)。0の場合は出力しない
+    # dequeのappendとpopleftはロックを取らずにスレッド間で使えるため、記録する側は通知などの待ちが発生しない
+    self.records = collections.deque() # (時刻, レベル, フォーマット, 引数)
+    self.message_counter = itertools.count() # メッセージ毎のイベントの件数(サンプリング用)
+    self.drop_count = 0 # キューが一杯で破棄したログの件数
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  # 役割：設定の変更(出力スレッドの起動前に呼ぶ)
+  # 戻り値：無し
+  def configure(self, level=INFO, queue_size=QUEUE_SIZE, message_sample_rate=1):
+    self.level = level
+    self.queue_size = queue_size
+    self.message_sample_rate = message_sample_rate
+
+  # 役割：出力スレッドの起動(起動前のログはキューに溜まり、起動後に出力される)
+  # 終了時(他のスレッドの終了後)に残っているログを出力する
+  # 戻り値：無し
+  def start(self):
+    self.stop_event.clear()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+    atexit.register(self.stop)
+
+  # 役割：キューに残っているログを出力して出力スレッドを停止する
+  # 戻り値：無し
+  def stop(self, timeout=5):
+    if self.thread is None:
+      return
+    self.stop_event.set()
+    self.thread.join(timeout)
+    self.thread = None
+
+  # 役割：ログの記録
+  # 戻り値：無し
+  def log(self, level, format, *args):
+    if level < self.level:
+      return
+    records = self.records
+    if len(records) >= self.queue_size:
+      self.drop_count += 1
+      return
+    records.append((time.time(), level, format, args))
+
+  def debug(self, format, *args):
+    self.log(self.DEBUG, format, *args)
+
+  def info(self, format, *args):
+    self.log(self.INFO, format, *args)
+
+  def warning(self, format, *args):
+    self.log(self.WARNING, format, *args)
+
+  def error(self, format, *args):
+    self.log(self.ERROR, format, *args)
+
+  # 役割：メッセージ毎のイベントの記録(message_sample_rate件に1件だけINFOで記録する)
+  # 戻り値：無し
+  def message(self, format, *args):
+    if not self.message_sample_rate or next(self.message_counter) % self.message_sample_rate:
+      return
+    self.log(self.INFO, format, *args)
+
+  # 役割：キューのログの定期的な出力(出力スレッド)
+  # 戻り値：無し
+  def run(self):
+    reported_drop_count = 0
+    while True:
+      is_stopped = self.stop_event.wait(self.FLUSH_INTERVAL)
+      reported_drop_count = self.flush(reported_drop_count)
+      if is_stopped:
+        return
+
+  # 役割：溜まっているログをまとめて1回で書き込む(前回の出力以降に破棄したログがあれば破棄数も出力する)
+  # 戻り値：出力済みの破棄数
+  def flush(self, reported_drop_count):
+    records = self.records
+    lines = [self.format_record(*records.popleft()) for _ in range(len(records))]
+    drop_count = self.drop_count
+    if drop_count != reported_drop_count:
+      lines.append(self.format_record(time.time(), self.WARNING, "ログの破棄: %d件", (drop_count - reported_drop_count,)))
+    if lines:
+      try:
+        sys.stdout.write("".join(lines))
+        sys.stdout.flush()
+      except (OSError, ValueError):
+        pass
+    return drop_count
+
+  # 役割：ログの整形
+  # 戻り値：改行付きの文字列
+  def format_record(self, created, level, format, args):
+    try:
+      message = format % args if args else str(format)
+    except (TypeError, ValueError) as e:
+      message = f"{format} {args} (ログの整形エラー: {e})"
+    return f"{time.strftime('%H:%M:%S', time.localtime(created))} {self.LEVEL_NAMES[level]} {message}\n"
+
+
+# サーバー全体で共有するログ(server.pyの起動時にconfigure、startする)
+log = LogPipeline()
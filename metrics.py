@@ -0,0 +1,252 @@
+import bisect
+import http.server
+import threading
+from log_pipeline import log
+
+bisect_left = bisect.bisect_left
+
+# サーバーのメトリクス(カウンター、ゲージ、固定バケットのヒストグラム)
+# カウンターとヒストグラムはスレッド毎の辞書に加算し、ロックを取らない。取得時に全スレッドの値を合計する。
+# (辞書のコピーはGILを持ったまま行われるため、加算中のスレッドがあっても取得できる)
+# ゲージ(ルーム数、セッション数など)は取得時にコレクター関数を呼んで値を読む。
+# 終了したスレッドの値は、スレッドの登録時にまとめて1つの辞書に合算する(接続毎のスレッドで増え続けないようにする)。
+#
+# メトリクスの名前とラベル: ("chat_tcp_requests_total", 'operation="join"') のように(名前, ラベルの文字列)をキーにする
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5) # 処理時間(秒)
+FANOUT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024) # 1件のチャットをリレーした受信者数
+
+# 名前 -> (種類, 説明, ヒストグラムのバケット)
+METRICS = {
+  "chat_tcp_requests_total": ("counter", "TCPリクエストの処理数(operation毎)", None),
+  "chat_tcp_request_seconds": ("histogram", "TCPリクエストの処理時間(バリデーションを除く)", LATENCY_BUCKETS),
+  "chat_tcp_validation_failures_total": ("counter", "TCPリクエストのバリデーションの失敗数", None),
+  "chat_password_verify_seconds": ("histogram", "パスワードの検証(bcrypt)の時間", LATENCY_BUCKETS),
+  "chat_password_verify_busy_total": ("counter", "混雑により拒否したパスワードの検証数", None),
+  "chat_credential_cache_hits_total": ("counter", "検証済みパスワードのキャッシュのヒット数", None),
+  "chat_credential_cache_misses_total": ("counter", "検証済みパスワードのキャッシュのミス数", None),
+  "chat_udp_datagrams_in_total": ("counter", "受信したUDPデータグラム数", None),
+  "chat_udp_messages_out_total": ("counter", "送信したUDPメッセージ数", None),
+  "chat_udp_datagrams_out_total": ("counter", "送信したUDPデータグラム数(まとめて送信した場合はメッセージ数より少ない)", None),
+  "chat_udp_send_drops_total": ("counter", "送信キューがあふれて破棄したメッセージ数", None),
+  "chat_udp_validation_failures_total": ("counter", "UDPメッセージのバリデーションの失敗数(reason: session_handle=不明なハンドル, token=トークンとアドレスの不一致, malformed=解析エラー、不明なトークン)", None),
+  "chat_udp_fanout_width": ("histogram", "チャット1件をリレーした受信者数", FANOUT_BUCKETS),
+  "chat_udp_fragments_total": ("counter", "リレーした分割されたチャットの断片数(受信数)", None),
+  "chat_udp_fragments_undelivered_total": ("counter", "分割に同意していないため断片を送信しなかった受信者数(断片毎)", None),
+  "chat_timeouts_total": ("counter", "タイムアウトで削除したクライアント数", None),
+  "chat_log_drops_total": ("counter", "出力待ちのキューがあふれて破棄したログの件数", None),
+  "chat_rooms": ("gauge", "現在のルーム数", None),
+  "chat_sessions": ("gauge", "現在のセッション数", None),
+  "chat_session_handles": ("gauge", "セッションハンドルを発行済みのセッション数", None),
+}
+
+
+# スレッド毎のメトリクスの値
+class MetricsShard:
+  __slots__ = ("thread", "counters", "histograms")
+
+  def __init__(self, thread):
+    self.thread = thread
+    self.counters = {} # (名前, ラベル) -> 値
+    self.histograms = {} # (名前, ラベル) -> [バケット毎の件数..., +Infの件数, 合計値]
+
+
+class MetricsRegistry:
+  def __init__(self, metrics=METRICS):
+    self.metrics = metrics
+    self.local = threading.local()
+    self.lock = threading.Lock() # shardsの追加、合算用のロック
+    self.shards = []
+    self.retired = MetricsShard(None) # 終了したスレッドの値の合計
+    self.merge_threshold = 64 # shardsがこの数に達したら終了したスレッドの値を合算する
+    self.collectors = [] # 取得時に[(名前, ラベル, 値), ...]を返す関数
+
+  # 役割：現在のスレッドの値の登録(スレッドの初回の加算時)
+  # 戻り値：MetricsShard
+  def register_shard(self):
+    shard = self.local.shard = MetricsShard(threading.current_thread())
+    with self.lock:
+      if len(self.shards) >= self.merge_threshold:
+        self.merge_retired_shards()
+        self.merge_threshold = max(64, len(self.shards) * 2)
+      self.shards.append(shard)
+    return shard
+
+  # 役割：カウンターの加算
+  # 戻り値：無し
+  def inc(self, name, value=1, labels=""):
+    try:
+      counters = self.local.shard.counters
+    except AttributeError:
+      counters = self.register_shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+  # 役割：ヒストグラムへの値の追加
+  # 戻り値：無し
+  def observe(self, name, value, labels=""):
+    try:
+      histograms = self.local.shard.histograms
+    except AttributeError:
+      histograms = self.register_shard().histograms
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+      histogram = histograms[key] = [0] * (len(self.metrics[name][2]) + 2)
+    histogram[bisect_left(self.metrics[name][2], value)] += 1
+    histogram[-1] += value
+
+  # 役割：取得時に値を読むコレクターの登録(ゲージや、既存の集計をカウンターとして公開する場合)
+  # 戻り値：無し
+  def register_collector(self, collector):
+    with self.lock:
+      self.collectors.append(collector)
+
+  # 役割：終了したスレッドの値をretiredに合算してshardsから除く(lockを取った状態で呼ぶ)
+  # 戻り値：無し
+  def merge_retired_shards(self):
+    alive_shards = []
+    for shard in self.shards:
+      if shard.thread.is_alive():
+        alive_shards.append(shard)
+      else:
+        self.merge_shard(self.retired, shard)
+    self.shards = alive_shards
+
+  # 役割：1スレッド分の値の合算
+  # 戻り値：無し
+  @staticmethod
+  def merge_shard(total, shard):
+    for key, value in dict(shard.counters).items():
+      total.counters[key] = total.counters.get(key, 0) + value
+    for key, histogram in dict(shard.histograms).items():
+      histogram = list(histogram)
+      total_histogram = total.histograms.get(key)
+      if total_histogram is None:
+        total.histograms[key] = histogram
+      else:
+        for index, value in enumerate(histogram):
+          total_histogram[index] += value
+
+  # 役割：全スレッドの値とコレクターの値の取得
+  # 戻り値：(MetricsShard(カウンターとヒストグラムの合計), {(名前, ラベル): ゲージの値})
+  def collect(self):
+    total = MetricsShard(None)
+    gauges = {}
+    with self.lock:
+      self.merge_shard(total, self.retired)
+      for shard in self.shards:
+        self.merge_shard(total, shard)
+      collectors = list(self.collectors)
+    for collector in collectors:
+      for name, labels, value in collector():
+        if self.metrics[name][0] == "gauge":
+          gauges[(name, labels)] = value
+        else:
+          total.counters[(name, labels)] = total.counters.get((name, labels), 0) + value
+    return total, gauges
+
+  # 役割：JSONに変換できる形式での取得(管理用のTCPオペレーションの応答用)
+  # 戻り値：{"counters": {"名前{ラベル}": 値}, "gauges": {...}, "histograms": {"名前{ラベル}": {"buckets": [[上限, 累積件数], ...], "count": 件数, "sum": 合計値}}}
+  def snapshot(self):
+    total, gauges = self.collect()
+    histograms = {}
+    for (name, labels), histogram in total.histograms.items():
+      cumulative_counts = self.get_cumulative_counts(histogram)
+      buckets = [[bound, count] for bound, count in zip(self.metrics[name][2], cumulative_counts)]
+      histograms[self.format_key(name, labels)] = {"buckets": buckets, "count": cumulative_counts[-1], "sum": histogram[-1]}
+    return {
+      "counters": {self.format_key(name, labels): value for (name, labels), value in sorted(total.counters.items())},
+      "gauges": {self.format_key(name, labels): value for (name, labels), value in sorted(gauges.items())},
+      "histograms": dict(sorted(histograms.items())),
+    }
+
+  # 役割：Prometheusのテキスト形式での取得
+  # 戻り値：文字列
+  def render_prometheus(self):
+    total, gauges = self.collect()
+    samples = {} # 名前 -> [(ラベル, 値, 名前の接尾辞), ...]
+    for values in (total.counters, gauges):
+      for (name, labels), value in values.items():
+        samples.setdefault(name, []).append((labels, value, ""))
+    for (name, labels), histogram in total.histograms.items():
+      cumulative_counts = self.get_cumulative_counts(histogram)
+      bounds = [str(bound) for bound in self.metrics[name][2]] + ["+Inf"]
+      histogram_samples = samples.setdefault(name, [])
+      for bound, count in zip(bounds, cumulative_counts):
+        histogram_samples.append((self.join_labels(labels, f'le="{bound}"'), count, "_bucket"))
+      histogram_samples.append((labels, histogram[-1], "_sum"))
+      histogram_samples.append((labels, cumulative_counts[-1], "_count"))
+
+    lines = []
+    for name in sorted(samples):
+      type, help, _ = self.metrics[name]
+      lines.append(f"# HELP {name} {help}")
+      lines.append(f"# TYPE {name} {type}")
+      for labels, value, suffix in samples[name]:
+        lines.append(f"{name}{suffix}{{{labels}}} {value}" if labels else f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+  # 役割：ヒストグラムのバケット毎の件数の累積(Prometheusのバケットは上限以下の件数の累積)
+  # 戻り値：累積件数のリスト(最後は+Infの件数=総件数)
+  @staticmethod
+  def get_cumulative_counts(histogram):
+    cumulative_counts = []
+    count = 0
+    for bucket_count in histogram[:-1]:
+      count += bucket_count
+      cumulative_counts.append(count)
+    return cumulative_counts
+
+  # 役割：名前とラベルの文字列化
+  # 戻り値：文字列
+  @staticmethod
+  def format_key(name, labels):
+    return f"{name}{{{labels}}}" if labels else name
+
+  # 役割：ラベルの連結
+  # 戻り値：文字列
+  @staticmethod
+  def join_labels(*labels):
+    return ",".join(label for label in labels if label)
+
+
+# Prometheusのテキスト形式でメトリクスを返すHTTPサーバー(GET /metrics)
+class MetricsHTTPServer:
+  def __init__(self, registry, host, port):
+    self.registry = registry
+    self.server_address = (host, port)
+    self.httpd = None
+
+  # 役割：HTTPサーバーの起動(デーモンスレッドで処理する)
+  # 戻り値：無し
+  def start(self):
+    registry = self.registry
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+        body = registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      # アクセスログは出力しない
+      def log_message(self, format, *args):
+        pass
+
+    self.httpd = http.server.ThreadingHTTPServer(self.server_address, MetricsRequestHandler)
+    self.httpd.daemon_threads = True
+    threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    log.info("メトリクスサーバー起動: http://%s:%d/metrics", *self.server_address)
+
+  # 役割：HTTPサーバーの停止
+  # 戻り値：無し
+  def shutdown(self):
+    if self.httpd:
+      self.httpd.shutdown()
+      self.httpd.server_close()
@@ -1,9 +1,12 @@
+import collections
 import json
+import struct
+import time
 import bcrypt
 
 # TCPデータ
 # {
-#   "operation": operation, 1:ルーム作成 2:ルーム参加
+#   "operation": operation, 1:ルーム作成 2:ルーム参加 3:管理(ローカルホストからのみ。"METRICS"=メトリクスの取得)
 #   "state": state, 0:サーバの初期化 1:リクエストの応答 2:リクエストの完了
 #   "room_name": room_name, 
 #   "operation_payload": {
@@ -11,7 +14,8 @@ import bcrypt
 #     "type": type, "GET"=ルーム一覧の取得、"JOIN"=ルームの参加
 #     "token": token,
 #     "password": password,
-#     "room_list": room_list
+#     "room_list": room_list,
+#     "request_id": request_id (省略可。指定した場合はレスポンスにも同じ値が入り、同じ接続で複数のリクエストを並行して送信できる)
 #   }
 # }
 
@@ -39,7 +43,7 @@ class TCPProtocolHandler:
 
   # データの作成。（ベースとなるメソッド）
   @staticmethod
-  def make_tcp_data(room_name, operation, state, error_message="", type="", token="", password="", room_list=None):
+  def make_tcp_data(room_name, operation, state, error_message="", type="", token="", password="", room_list=None, request_id=None, options=None):
     # オペレーションペイロードの作成
     operation_payload = {
         "error_message": error_message,
@@ -48,6 +52,11 @@ class TCPProtocolHandler:
         "password": password,
         "room_list": room_list if room_list is not None else []
     }
+    if request_id is not None:
+      operation_payload["request_id"] = request_id
+    # ルーム一覧のバージョンなど、操作毎の追加の項目
+    if options:
+      operation_payload.update(options)
 
     # データのエンコード
     room_name_bytes = room_name.encode("utf-8")
@@ -72,47 +81,88 @@ class TCPProtocolHandler:
 
   # 認証レスポンスの作成
   @staticmethod
-  def make_validate_response(error_message=""):
-    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=1, error_message=error_message)
+  def make_validate_response(error_message="", request_id=None):
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=1, error_message=error_message, request_id=request_id)
 
   # トークンレスポンスの作成
   @staticmethod
-  def make_token_response(token="", error_message=""):
-    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, token=token, error_message=error_message)
+  def make_token_response(token="", error_message="", request_id=None):
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, token=token, error_message=error_message, request_id=request_id)
 
   # ルーム一覧レスポンスの作成
+  # versionを指定した場合は一覧のバージョンを付ける(クライアントは次回の取得時に送信する)
   @staticmethod
-  def make_room_list_response(room_list, error_message=""):
-    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, room_list=room_list, error_message=error_message)
+  def make_room_list_response(room_list, error_message="", request_id=None, version=None):
+    options = {"version": version} if version is not None else None
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, room_list=room_list, error_message=error_message, request_id=request_id, options=options)
+
+  # ページ指定のルーム一覧レスポンスの作成
+  # totalは条件(前方一致)に合うルームの総数、next_offsetは次のページのオフセット(最後のページの場合はNone)
+  @staticmethod
+  def make_room_list_page_response(room_list, version, total, next_offset, request_id=None):
+    options = {"version": version, "total": total, "next_offset": next_offset}
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, room_list=room_list, request_id=request_id, options=options)
+
+  # ルーム一覧の差分レスポンスの作成
+  # 変更が無い場合はnot_modified、ある場合は追加(added)と削除(removed)されたルームを送る
+  @staticmethod
+  def make_room_list_delta_response(version, added, removed, request_id=None):
+    if not added and not removed:
+      options = {"version": version, "not_modified": True}
+    else:
+      options = {"version": version, "added": added, "removed": removed}
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, request_id=request_id, options=options)
+
+  # メトリクスレスポンスの作成
+  # metricsはformatが"json"の場合はdict、"prometheus"の場合はテキスト形式の文字列
+  @staticmethod
+  def make_metrics_response(metrics, error_message="", request_id=None):
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=10, state=2, error_message=error_message, request_id=request_id, options={"metrics": metrics})
 
   # ルーム作成依頼リクエストの作成
   @staticmethod
-  def make_create_room_request(room_name, password):
+  def make_create_room_request(room_name, password, request_id=None):
     hashed_password = CryptoHandler.encrypt_password(password).decode("utf-8")
-    return TCPProtocolHandler.make_tcp_data(room_name=room_name, password=hashed_password, operation=1, state=0)
+    return TCPProtocolHandler.make_tcp_data(room_name=room_name, password=hashed_password, operation=1, state=0, request_id=request_id)
 
   # ルーム一覧取得依頼リクエストの作成
+  # versionには前回取得した一覧のバージョンを指定する(差分のみ返ってくる)
   @staticmethod
-  def make_get_room_list_request():
-    return TCPProtocolHandler.make_tcp_data(room_name="", operation=2, state=0, type="GET")
+  def make_get_room_list_request(version=None, request_id=None):
+    options = {"version": version} if version is not None else None
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=2, state=0, type="GET", request_id=request_id, options=options)
+
+  # ページ指定、前方一致でのルーム一覧取得依頼リクエストの作成
+  # offset番目(0始まり)からlimit件、名前がprefixで始まるルームを名前順で取得する
+  @staticmethod
+  def make_get_room_list_page_request(offset=0, limit=20, prefix="", request_id=None):
+    options = {"offset": offset, "limit": limit, "prefix": prefix}
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=2, state=0, type="GET", request_id=request_id, options=options)
+
+  # メトリクス取得リクエストの作成(管理用。format="json"または"prometheus")
+  @staticmethod
+  def make_metrics_request(format="json", request_id=None):
+    return TCPProtocolHandler.make_tcp_data(room_name="", operation=3, state=0, type="METRICS", request_id=request_id, options={"format": format})
 
   # ルーム参加依頼リクエストの作成
   @staticmethod
-  def make_join_room_request(room_name, password):
-    return TCPProtocolHandler.make_tcp_data(room_name=room_name, password=password, operation=2, state=0, type="JOIN")
+  def make_join_room_request(room_name, password, request_id=None):
+    return TCPProtocolHandler.make_tcp_data(room_name=room_name, password=password, operation=2, state=0, type="JOIN", request_id=request_id)
 
   # レスポンスデータの解析。戻り値はレスポンスデータ(dict)。
+  # TCPFrameReaderのbytearrayをコピーせずにmemoryviewで解析する(bytesも解析できる)
   @staticmethod
   def parse_data(response_data):
-    header = response_data[:32]
-    room_name_size = header[0]
-    operation = header[1]
-    state = header[2]
-    operation_payload_size = int.from_bytes(header[3:32], "big")
+    view = memoryview(response_data)
+    room_name_size = view[0]
+    operation = view[1]
+    state = view[2]
+    operation_payload_size = int.from_bytes(view[3:32], "big")
 
-    body = response_data[32:]
-    room_name = body[:room_name_size].decode("utf-8")
-    operation_payload = body[room_name_size:room_name_size+operation_payload_size].decode("utf-8")
+    body_offset = TCPFrameReader.HEADER_SIZE
+    payload_offset = body_offset + room_name_size
+    room_name = str(view[body_offset:payload_offset], "utf-8")
+    operation_payload = str(view[payload_offset:payload_offset+operation_payload_size], "utf-8")
 
     # dictに変換
     return {
@@ -122,6 +172,51 @@ class TCPProtocolHandler:
       "operation_payload": json.loads(operation_payload)
     }
 
+# TCPのフレーム(32バイトのヘッダー + room_name + operation_payload)の受信
+# ヘッダーからフレームのサイズを求めてbytearrayを1回だけ確保し、recv_intoでmemoryview経由で直接書き込む
+class TCPFrameReader:
+  HEADER_SIZE = 32 # ヘッダーのバイト数
+  MAX_FRAME_SIZE = HEADER_SIZE + TCPProtocolHandler.ROOM_NAME_MAX_BYTE_SIZE + TCPProtocolHandler.OPERATION_PAYLOAD_MAX_BYTE_SIZE # プロトコル上の最大フレームサイズ
+
+  def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE):
+    self.sock = sock
+    self.max_frame_size = max_frame_size # 受信するフレームの最大バイト数(超える場合は受信せずにエラーにする)
+
+  # フレームの受信
+  # 戻り値：フレーム(bytearray)。フレームの境界で接続が閉じられた場合はNone
+  # フレームの途中で接続が閉じられた場合はConnectionError、max_frame_sizeを超える場合はValueErrorを送出する
+  def read_frame(self):
+    header = bytearray(TCPFrameReader.HEADER_SIZE)
+    if not self.read_into(memoryview(header), allow_eof=True):
+      return None
+
+    frame = bytearray(TCPFrameReader.get_frame_size(header, self.max_frame_size))
+    frame[:TCPFrameReader.HEADER_SIZE] = header
+    self.read_into(memoryview(frame)[TCPFrameReader.HEADER_SIZE:])
+    return frame
+
+  # viewが埋まるまで受信する
+  # 戻り値：受信できた=True、allow_eofで受信前に接続が閉じられた=False
+  def read_into(self, view, allow_eof=False):
+    received_size = 0
+    while received_size < len(view):
+      size = self.sock.recv_into(view[received_size:])
+      if not size:
+        if allow_eof and received_size == 0:
+          return False
+        raise ConnectionError("フレームの途中で接続が閉じられました。")
+      received_size += size
+    return True
+
+  # ヘッダーからフレームのサイズを取得
+  # 戻り値：フレームのバイト数。max_frame_sizeを超える場合はValueErrorを送出する
+  @staticmethod
+  def get_frame_size(header, max_frame_size=MAX_FRAME_SIZE):
+    frame_size = TCPFrameReader.HEADER_SIZE + header[0] + int.from_bytes(header[3:TCPFrameReader.HEADER_SIZE], "big")
+    if frame_size > max_frame_size:
+      raise ValueError(f"フレームのサイズ({frame_size}バイト)が上限({max_frame_size}バイト)を超えています。")
+    return frame_size
+
 
 
 # UDPデータ
@@ -134,29 +229,79 @@ class TCPProtocolHandler:
 #     "chat_data": chat_data
 #   }
 # }
+# contentはJSON(従来の形式)とバイナリ形式の2種類があり、先頭バイトで判別する。
+# JSON形式は必ず"{"で始まり、バイナリ形式は先頭がBINARY_CONTENT_FLAG(フォーマットのバージョン)になる。
+# バイナリ形式(v1): [フラグ 1byte][type 1byte][user_nameのサイズ 1byte][user_name][chat_dataのサイズ 2byte][chat_data]
+# バイナリ形式はINITIALで"capabilities"に"binary"を含めてサーバーが同意(INITIAL_ACK)した場合のみ使用する。
+# DATAGRAM_MAX_BYTE_SIZEを超えるチャットはcontentを断片に分け、それぞれに同じヘッダー(ルーム名、トークン)を付けて送信する。
+# 断片: [フラグ(0x03) 1byte][メッセージID 4byte][断片の番号 2byte][断片の数 2byte][contentの一部]
+# サーバーは断片を再構成せずにリレーし、受信したクライアントがメッセージID毎に再構成する(FragmentReassembler)。
+# 分割はINITIALで"capabilities"に"fragment"を含めてサーバーが同意した場合のみ使用する。
 # UDPデータの作成、パース
 class UDPProtocolHandler:
   ROOM_NAME_MAX_BYTE_SIZE = 2**8 # room_nameの最大バイト数
   TOKEN_MAX_BYTE_SIZE = 2**8 # tokenの最大バイト数
+  USER_NAME_MAX_BYTE_SIZE = 2**8 - 1 # バイナリ形式のuser_nameの最大バイト数
+  CHAT_DATA_MAX_BYTE_SIZE = 2**16 - 1 # バイナリ形式のchat_dataの最大バイト数
+
+  CONTENT_FORMAT_JSON = 0 # JSON形式
+  CONTENT_FORMAT_BINARY = 1 # バイナリ形式(v1)
+  BINARY_CONTENT_FLAG = b"\x01" # バイナリ形式(v1)のcontentの先頭バイト
+  BATCH_CONTENT_FLAG = b"\x02" # 複数のメッセージをまとめたcontentの先頭バイト
+  FRAGMENT_CONTENT_FLAG = b"\x03" # 分割したcontentの断片の先頭バイト
+
+  CAPABILITY_BINARY = "binary" # バイナリ形式のcontentを送受信できる
+  CAPABILITY_SESSION_HANDLE = "session_handle" # INITIAL以降はトークンの代わりにセッションハンドルを送信できる
+  CAPABILITY_BATCH = "batch" # 複数のメッセージをまとめたデータグラムを受信できる
+  CAPABILITY_FRAGMENT = "fragment" # 分割したチャットを送信でき、断片を受信して再構成できる(binaryと合わせて通知した場合のみ同意する)
+  CAPABILITIES = [CAPABILITY_BINARY, CAPABILITY_SESSION_HANDLE, CAPABILITY_BATCH, CAPABILITY_FRAGMENT] # この実装が対応している機能
+
+  # typeとバイナリ形式のtypeコードの対応
+  TYPE_CODES = {"INITIAL": 1, "CHAT": 2, "LEAVE": 3, "CLOSE": 4, "TIMEOUT": 5, "STOP": 6, "INITIAL_ACK": 7}
+  TYPE_NAMES = {code: type for type, code in TYPE_CODES.items()}
+
+  BINARY_CONTENT_HEADER = struct.Struct(">cBB") # フラグ、typeコード、user_nameのサイズ
+  JSON_CHAT_PREFIX = b'{"type": "CHAT"' # make_contentが作成するJSON形式のチャットのcontentの先頭
+  RELAY_HEADER = b"\x00\x00" # サーバーがリレーするメッセージのヘッダー(ルーム名、トークン無し)
+  CHAT_DATA_SIZE = struct.Struct(">H") # chat_dataのサイズ
+  BATCH_ITEM_SIZE = struct.Struct(">H") # まとめたメッセージ1件のサイズ
+  # セッションハンドル(セッションID 4バイト + MAC 4バイト)。ルーム名のサイズ0、トークンのサイズ8のメッセージはトークンの代わりにハンドルを持つ
+  SESSION_HANDLE = struct.Struct(">I4s")
+  FRAGMENT_HEADER = struct.Struct(">cIHH") # フラグ、メッセージID、断片の番号、断片の数
+
+  DATAGRAM_MAX_BYTE_SIZE = 1200 # 分割せずに送信するデータグラムの最大バイト数(IPフラグメントが発生しないMTUの予算)
+  # 分割して送信するcontentの最大バイト数(分割はbinaryと合わせてのみ同意するため、バイナリ形式のcontentの最大バイト数になる)
+  MESSAGE_MAX_BYTE_SIZE = BINARY_CONTENT_HEADER.size + USER_NAME_MAX_BYTE_SIZE + CHAT_DATA_SIZE.size + CHAT_DATA_MAX_BYTE_SIZE
+  FRAGMENT_MAX_COUNT = 4096 # 1つのメッセージの断片の最大数
+  RECEIVE_BUFFER_SIZE = 2**16 - 1 # 受信バッファのバイト数(UDPデータグラムの最大サイズ)
+  LEGACY_RECEIVE_BUFFER_SIZE = 4096 # 従来のクライアントとサーバーの受信バッファのバイト数
+
+  # エラーの出力(on_errorを指定しない場合の出力先。クライアント用)
+  # on_errorにはlog.warningなど、フォーマットと引数を受け取る関数を指定する
+  @staticmethod
+  def print_error(format, *args):
+    print(format % args if args else format)
 
   # メッセージの作成（ベースとなるメソッド）
+  # optionsはJSON形式のcontentにのみ追加される項目(INITIALでの機能のネゴシエーションなどに使う)
+  # tokenにbytesを指定した場合はセッションハンドルとしてそのまま送信する(room_nameは空にする)
+  # 作成できない場合はon_error(省略した場合は標準出力)にエラーを出力する
   @staticmethod
-  def make_udp_data(type, room_name="", token="", user_name="", chat_data=""):
+  def make_udp_data(type, room_name="", token="", user_name="", chat_data="", content_format=CONTENT_FORMAT_JSON, options=None, on_error=None):
+    on_error = on_error or UDPProtocolHandler.print_error
     # データのエンコード
     room_name_bytes = room_name.encode("utf-8")
-    token_bytes = token.encode("utf-8")
-    content_bytes = json.dumps({
-      "type": type,
-      "user_name": user_name,
-      "chat_data": chat_data
-    }).encode("utf-8")
+    token_bytes = token if isinstance(token, bytes) else token.encode("utf-8")
+    content_bytes = UDPProtocolHandler.make_content(type, user_name, chat_data, content_format, options, on_error)
+    if content_bytes is None:
+      return None
     
     # データサイズのチェック
     if len(room_name_bytes) > UDPProtocolHandler.ROOM_NAME_MAX_BYTE_SIZE:
-      print("ルーム名が最大バイトサイズを超えています。")
+      on_error("ルーム名が最大バイトサイズを超えています。")
       return None
     if len(token_bytes) > UDPProtocolHandler.TOKEN_MAX_BYTE_SIZE:
-      print("トークンが最大バイトサイズを超えています。")
+      on_error("トークンが最大バイトサイズを超えています。")
       return None
 
     # データの作成
@@ -165,26 +310,76 @@ class UDPProtocolHandler:
       len(token_bytes).to_bytes(1, "big") 
     )
     return header + room_name_bytes + token_bytes + content_bytes
+
+  # contentの作成(作成できない場合はon_errorにエラーを出力する)
+  @staticmethod
+  def make_content(type, user_name="", chat_data="", content_format=CONTENT_FORMAT_JSON, options=None, on_error=None):
+    if content_format == UDPProtocolHandler.CONTENT_FORMAT_BINARY:
+      on_error = on_error or UDPProtocolHandler.print_error
+      user_name_bytes = user_name.encode("utf-8")
+      chat_data_bytes = chat_data.encode("utf-8")
+      if len(user_name_bytes) > UDPProtocolHandler.USER_NAME_MAX_BYTE_SIZE:
+        on_error("ユーザー名が最大バイトサイズを超えています。")
+        return None
+      if len(chat_data_bytes) > UDPProtocolHandler.CHAT_DATA_MAX_BYTE_SIZE:
+        on_error("チャットメッセージが最大バイトサイズを超えています。")
+        return None
+      return (
+        UDPProtocolHandler.BINARY_CONTENT_HEADER.pack(UDPProtocolHandler.BINARY_CONTENT_FLAG, UDPProtocolHandler.TYPE_CODES[type], len(user_name_bytes)) +
+        user_name_bytes +
+        UDPProtocolHandler.CHAT_DATA_SIZE.pack(len(chat_data_bytes)) +
+        chat_data_bytes
+      )
+
+    content = {
+      "type": type,
+      "user_name": user_name,
+      "chat_data": chat_data
+    }
+    if options:
+      content.update(options)
+    return json.dumps(content).encode("utf-8")
   
   @staticmethod
   # チャット開始時に自動的にサーバーに送信されるメッセージの作成(クライアント用)
-  def make_initial_message(room_name, token, user_name):
-    return UDPProtocolHandler.make_udp_data(room_name=room_name, type="INITIAL", token=token, user_name=user_name)
+  # capabilitiesを指定すると、対応している機能をサーバーに通知する(INITIAL自体は常にJSON形式で送信する)
+  # history_countを指定すると、ルームの直近のチャットをその件数まで受信する
+  def make_initial_message(room_name, token, user_name, capabilities=None, history_count=None):
+    options = {}
+    if capabilities:
+      options["capabilities"] = capabilities
+    if history_count:
+      options["history_count"] = history_count
+    return UDPProtocolHandler.make_udp_data(room_name=room_name, type="INITIAL", token=token, user_name=user_name, options=options)
 
   # チャットメッセージの作成(クライアント用)
   @staticmethod
-  def make_chat_message(room_name, token, user_name, chat_data):
-    return UDPProtocolHandler.make_udp_data(room_name=room_name, type="CHAT", token=token, user_name=user_name, chat_data=chat_data)
+  def make_chat_message(room_name, token, user_name, chat_data, content_format=CONTENT_FORMAT_JSON):
+    return UDPProtocolHandler.make_udp_data(room_name=room_name, type="CHAT", token=token, user_name=user_name, chat_data=chat_data, content_format=content_format)
   
   # 退出メッセージの作成(クライアント用)
   @staticmethod
   def make_leave_message(room_name, token, user_name):
     return UDPProtocolHandler.make_udp_data(type="LEAVE", room_name=room_name, token=token, user_name=user_name)
   
+  # チャットの履歴の要求メッセージの作成(クライアント用)
+  # シーケンス番号がstartからendまでのチャットを、サーバーがリレーと同じ形式で再送する
+  @staticmethod
+  def make_history_message(room_name, token, user_name, start, end):
+    return UDPProtocolHandler.make_udp_data(type="HISTORY", room_name=room_name, token=token, user_name=user_name, options={"start": start, "end": end})
+
   # リレーするチャットメッセージの作成(クライアント用)
   @staticmethod
-  def make_relay_message(user_name, chat_data):
-    return UDPProtocolHandler.make_udp_data(user_name=user_name, chat_data=chat_data, type="CHAT")
+  def make_relay_message(user_name, chat_data, content_format=CONTENT_FORMAT_JSON):
+    return UDPProtocolHandler.make_udp_data(user_name=user_name, chat_data=chat_data, type="CHAT", content_format=content_format)
+
+  # INITIALへの応答メッセージの作成(サーバー用)。同意した機能と、発行したセッションハンドル(16進数の文字列)を通知する。
+  @staticmethod
+  def make_initial_ack_message(capabilities, session_handle=None):
+    options = {"capabilities": capabilities}
+    if session_handle:
+      options["session_handle"] = session_handle.hex()
+    return UDPProtocolHandler.make_udp_data(type="INITIAL_ACK", options=options)
 
   # クローズメッセージの作成(サーバー用)
   @staticmethod
@@ -200,23 +395,200 @@ class UDPProtocolHandler:
   @staticmethod
   def make_system_stop_message():
     return UDPProtocolHandler.make_udp_data(type="STOP", chat_data="システムメンテナンス中のためシステムが終了しました。")
+
+  # シーケンス番号付きのリレーのヘッダーの作成(サーバー用)
+  # シーケンス番号はトークンの位置に10進数の文字列で入れる(リレーされたメッセージのトークンを使わない従来のクライアントはそのまま無視する)
+  @staticmethod
+  def make_relay_header(sequence):
+    if sequence is None:
+      return UDPProtocolHandler.RELAY_HEADER
+    sequence_bytes = b"%d" % sequence
+    return b"\x00%c%s" % (len(sequence_bytes), sequence_bytes)
+
+  # リレーされたメッセージのシーケンス番号の解析(クライアント用)
+  # 戻り値：シーケンス番号。シーケンス番号が無いメッセージの場合はNone
+  @staticmethod
+  def parse_sequence(message_data):
+    if message_data[0] != 0 or message_data[1] == 0:
+      return None
+    sequence_bytes = bytes(message_data[2:2+message_data[1]])
+    return int(sequence_bytes) if sequence_bytes.isdigit() else None
+
+  # 複数のメッセージをまとめたデータグラムの作成(サーバー用)
+  # [RELAY_HEADER][フラグ(0x02)]に続けて、[サイズ 2byte][メッセージ]を繰り返す
+  # messagesはメッセージ毎のバッファのリストのリストで、コピーせずsendmsgに渡せるバッファのリストを返す
+  @staticmethod
+  def make_batch_parts(messages):
+    parts = [UDPProtocolHandler.RELAY_HEADER + UDPProtocolHandler.BATCH_CONTENT_FLAG]
+    for message_parts in messages:
+      parts.append(UDPProtocolHandler.BATCH_ITEM_SIZE.pack(sum(len(part) for part in message_parts)))
+      parts.extend(message_parts)
+    return parts
+
+  # まとめたデータグラムの分割(クライアント用)
+  # 戻り値：メッセージのリスト。まとめたデータグラムでない場合は[message_data]
+  @staticmethod
+  def split_batch(message_data):
+    offset = len(UDPProtocolHandler.RELAY_HEADER)
+    if message_data[:offset] != UDPProtocolHandler.RELAY_HEADER or message_data[offset:offset+1] != UDPProtocolHandler.BATCH_CONTENT_FLAG:
+      return [message_data]
+
+    messages = []
+    offset += 1
+    while offset < len(message_data):
+      (size,) = UDPProtocolHandler.BATCH_ITEM_SIZE.unpack_from(message_data, offset)
+      offset += UDPProtocolHandler.BATCH_ITEM_SIZE.size
+      messages.append(message_data[offset:offset+size])
+      offset += size
+    return messages
+
+  # 分割したチャットのデータグラムの作成(クライアント用)
+  # message_dataがmax_datagram_sizeを超える場合はcontentを断片に分け、それぞれにmessage_dataと同じヘッダーを付ける
+  # 戻り値：データグラムのリスト(超えない場合は[message_data])。分割できない場合はNone(on_errorにエラーを出力する)
+  @staticmethod
+  def make_fragments(message_data, message_id, max_datagram_size=DATAGRAM_MAX_BYTE_SIZE, on_error=None):
+    if len(message_data) <= max_datagram_size:
+      return [message_data]
+    on_error = on_error or UDPProtocolHandler.print_error
+
+    header_size = 2 + message_data[0] + message_data[1]
+    header = message_data[:header_size]
+    content = message_data[header_size:]
+    fragment_size = max_datagram_size - header_size - UDPProtocolHandler.FRAGMENT_HEADER.size
+    if len(content) > UDPProtocolHandler.MESSAGE_MAX_BYTE_SIZE:
+      on_error("チャットメッセージが分割して送信できる最大バイトサイズを超えています。")
+      return None
+    if fragment_size <= 0:
+      on_error("データグラムの最大バイトサイズが小さすぎるため分割できません。")
+      return None
+    count = -(-len(content) // fragment_size) # 切り上げ
+    if count > UDPProtocolHandler.FRAGMENT_MAX_COUNT:
+      on_error("データグラムの最大バイトサイズが小さすぎるため分割できません。")
+      return None
+
+    return [
+      header + UDPProtocolHandler.FRAGMENT_HEADER.pack(UDPProtocolHandler.FRAGMENT_CONTENT_FLAG, message_id, index, count) + content[offset:offset+fragment_size]
+      for index, offset in enumerate(range(0, len(content), fragment_size))
+    ]
+
+  # 断片のヘッダーの解析(サーバーは断片を再構成せずにリレーするため、ヘッダーの検証のみ行う)
+  # 戻り値：(メッセージID, 断片の番号, 断片の数)。断片でない場合や不正な断片の場合はNone
+  @staticmethod
+  def parse_fragment_header(content):
+    if len(content) < UDPProtocolHandler.FRAGMENT_HEADER.size or content[:1] != UDPProtocolHandler.FRAGMENT_CONTENT_FLAG:
+      return None
+    _, message_id, index, count = UDPProtocolHandler.FRAGMENT_HEADER.unpack_from(content)
+    if index >= count or count > UDPProtocolHandler.FRAGMENT_MAX_COUNT:
+      return None
+    return message_id, index, count
+
+  # 断片かどうか(クライアント用)
+  @staticmethod
+  def is_fragment(message_data):
+    content_offset = 2 + message_data[0] + message_data[1]
+    return message_data[content_offset:content_offset+1] == UDPProtocolHandler.FRAGMENT_CONTENT_FLAG
+
+  # ルーム名のみの解析(ルームの振り分け用。トークンとコンテンツは解析しない)
+  @staticmethod
+  def parse_room_name(message_data):
+    room_name_size = message_data[0]
+    return message_data[2:2+room_name_size].decode("utf-8")
+
+  # セッションハンドルを持つメッセージかどうか
+  @staticmethod
+  def has_session_handle(message_data):
+    return message_data[0] == 0 and message_data[1] == UDPProtocolHandler.SESSION_HANDLE.size
+
+  # セッションIDのみの解析(ワーカーの振り分け用)
+  # 戻り値：セッションID。セッションハンドルを持たないメッセージの場合はNone
+  @staticmethod
+  def parse_session_id(message_data):
+    if not UDPProtocolHandler.has_session_handle(message_data):
+      return None
+    session_id, _ = UDPProtocolHandler.SESSION_HANDLE.unpack_from(message_data, 2)
+    return session_id
+
+  # ヘッダー、ルーム名、トークンのみの解析(リレー用)
+  # 戻り値：(ルーム名, トークン, content)。contentはコピーせずmessage_dataのmemoryviewで返す。
+  # セッションハンドルを持つメッセージの場合は(None, セッションハンドルのbytes, content)を返す。
+  @staticmethod
+  def parse_header(message_data):
+    view = memoryview(message_data)
+    room_name_size = view[0]
+    token_size = view[1]
+    token_offset = 2 + room_name_size
+    content_offset = token_offset + token_size
+    if len(view) < content_offset:
+      raise IndexError("ヘッダーのサイズがデータのサイズを超えています。")
+
+    if UDPProtocolHandler.has_session_handle(view):
+      return None, bytes(view[token_offset:content_offset]), view[content_offset:]
+    room_name = str(view[2:token_offset], "utf-8")
+    token = str(view[token_offset:content_offset], "utf-8")
+    return room_name, token, view[content_offset:]
+
+  # contentをデコードせずにtypeを判別する(JSON形式はmake_contentが作成するチャットのみ判別できる)
+  # 戻り値：type。判別できない場合はNone
+  @staticmethod
+  def peek_content_type(content):
+    if content[:1] == UDPProtocolHandler.BINARY_CONTENT_FLAG:
+      return UDPProtocolHandler.TYPE_NAMES.get(content[1]) if len(content) > 1 else None
+    if content[:len(UDPProtocolHandler.JSON_CHAT_PREFIX)] == UDPProtocolHandler.JSON_CHAT_PREFIX:
+      return "CHAT"
+    return None
+
+  # contentの形式の判別
+  @staticmethod
+  def get_content_format(content_bytes):
+    if content_bytes[:1] == UDPProtocolHandler.BINARY_CONTENT_FLAG:
+      return UDPProtocolHandler.CONTENT_FORMAT_BINARY
+    return UDPProtocolHandler.CONTENT_FORMAT_JSON
+
+  # contentの解析(JSON形式、バイナリ形式の両方に対応。bytesとmemoryviewのどちらも解析できる)
+  @staticmethod
+  def parse_content(content_bytes):
+    if content_bytes[:1] != UDPProtocolHandler.BINARY_CONTENT_FLAG:
+      return json.loads(str(content_bytes, "utf-8"))
+
+    _, type_code, user_name_size = UDPProtocolHandler.BINARY_CONTENT_HEADER.unpack_from(content_bytes)
+    offset = UDPProtocolHandler.BINARY_CONTENT_HEADER.size
+    user_name = str(content_bytes[offset:offset+user_name_size], "utf-8")
+    offset += user_name_size
+    (chat_data_size,) = UDPProtocolHandler.CHAT_DATA_SIZE.unpack_from(content_bytes, offset)
+    offset += UDPProtocolHandler.CHAT_DATA_SIZE.size
+    chat_data = str(content_bytes[offset:offset+chat_data_size], "utf-8")
+    return {
+      "type": UDPProtocolHandler.TYPE_NAMES[type_code],
+      "user_name": user_name,
+      "chat_data": chat_data
+    }
     
   # メッセージの解析 
+  # セッションハンドルを持つメッセージの場合、room_nameはNone、tokenはセッションハンドルのbytesになる
+  # 解析できない場合はNoneを返し、on_error(省略した場合は標準出力)にエラーを出力する
   @staticmethod
-  def parse_message(message_data):
+  def parse_message(message_data, on_error=None):
+    on_error = on_error or UDPProtocolHandler.print_error
     try:
       header = message_data[:2]
       room_name_size = header[0]
       token_size = header[1]
 
       body = message_data[2:]
-      room_name = body[:room_name_size].decode("utf-8")
-      token = body[room_name_size:room_name_size+token_size].decode("utf-8")
+      if UDPProtocolHandler.has_session_handle(header):
+        room_name = None
+        token = body[:token_size]
+      else:
+        room_name = body[:room_name_size].decode("utf-8")
+        token = body[room_name_size:room_name_size+token_size].decode("utf-8")
 
       try:
-        content = json.loads(body[room_name_size+token_size:].decode("utf-8"))
+        content = UDPProtocolHandler.parse_content(body[room_name_size+token_size:])
       except json.JSONDecodeError as e:
-          print(f"JSONデコードエラー:{e}")
+          on_error("JSONデコードエラー:%s", e)
+          return None
+      except (struct.error, KeyError) as e:
+          on_error("バイナリデコードエラー:%s", e)
           return None
 
       return {
@@ -226,5 +598,78 @@ class UDPProtocolHandler:
       }
 
     except IndexError as e:
-      print(f"パケット解析中にエラーが発生しました。:{e}")
+      on_error("パケット解析中にエラーが発生しました。:%s", e)
       return None
+
+
+# 分割されたチャットの再構成(クライアント用)
+# 断片をメッセージID毎に溜め、全ての断片が揃ったら1つのメッセージに戻す。
+# 溜めるメッセージ数(max_messages)と1メッセージのバイト数(max_message_bytes)に上限を設け、上限を超えた場合は古いメッセージから破棄する。
+# timeout秒以内に揃わなかったメッセージ(断片が欠落したもの)も破棄する。
+class FragmentReassembler:
+  def __init__(self, max_messages=64, max_message_bytes=UDPProtocolHandler.MESSAGE_MAX_BYTE_SIZE, timeout=5):
+    self.max_messages = max_messages
+    self.max_message_bytes = max_message_bytes
+    self.timeout = timeout
+    self.pending = collections.OrderedDict() # メッセージID -> [期限, 断片のリスト, 受信した断片数, 受信したバイト数](受信順)
+    self.drop_count = 0 # 破棄したメッセージ(上限を超えるメッセージは断片)の数
+
+  # 役割：断片の追加
+  # 戻り値：全ての断片が揃った場合は、断片のヘッダーと再構成したcontentのメッセージ。揃っていない場合や不正な断片の場合はNone
+  def add(self, message_data, now=None):
+    header_size = 2 + message_data[0] + message_data[1]
+    content = message_data[header_size:]
+    fragment_header = UDPProtocolHandler.parse_fragment_header(content)
+    if fragment_header is None:
+      return None
+    message_id, index, count = fragment_header
+    now = time.monotonic() if now is None else now
+    self.discard_expired(now)
+
+    fragment = bytes(content[UDPProtocolHandler.FRAGMENT_HEADER.size:])
+    # 最後以外の断片は同じサイズのため、全体が上限を超えるメッセージの断片は溜めずに破棄する
+    if index < count - 1 and len(fragment) * (count - 1) > self.max_message_bytes:
+      self.drop_count += 1
+      return None
+
+    entry = self.pending.get(message_id)
+    if entry is None:
+      if len(self.pending) >= self.max_messages:
+        self.pending.popitem(last=False)
+        self.drop_count += 1
+      entry = self.pending[message_id] = [now + self.timeout, [None] * count, 0, 0]
+    fragments = entry[1]
+    # 同じメッセージIDで断片の数が異なる場合(別の送信者のIDとの衝突)は破棄する
+    if len(fragments) != count:
+      self.discard(message_id)
+      return None
+    # 重複して受信した断片は無視する
+    if fragments[index] is not None:
+      return None
+
+    entry[3] += len(fragment)
+    if entry[3] > self.max_message_bytes:
+      self.discard(message_id)
+      return None
+    fragments[index] = fragment
+    entry[2] += 1
+    if entry[2] < count:
+      return None
+
+    del self.pending[message_id]
+    return bytes(message_data[:header_size]) + b"".join(fragments)
+
+  # 役割：期限を過ぎたメッセージの破棄(期限は受信順に並んでいるため先頭から確認する)
+  # 戻り値：無し
+  def discard_expired(self, now):
+    while self.pending:
+      message_id, entry = next(iter(self.pending.items()))
+      if entry[0] > now:
+        return
+      self.discard(message_id)
+
+  # 役割：メッセージの破棄
+  # 戻り値：無し
+  def discard(self, message_id):
+    del self.pending[message_id]
+    self.drop_count += 1
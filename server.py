@@ -1,25 +1,43 @@
 import socket
 import threading
-from modules import TCPProtocolHandler,UDPProtocolHandler,CryptoHandler
+import asyncio
+import argparse
+import resource
+import collections
+import multiprocessing
+import select
+import tempfile
+import shutil
+import zlib
+import struct
+import json
+import os
+from modules import TCPProtocolHandler,TCPFrameReader,UDPProtocolHandler,CryptoHandler
+from journal import StateJournal
+from metrics import MetricsRegistry, MetricsHTTPServer
+from log_pipeline import log, LogPipeline
 import time
-import datetime
+import heapq
+import concurrent.futures
+import hmac
+import hashlib
 import secrets
 import base64
+import itertools
+import bisect
+import ipaddress
 
 # 扱うデータ
 # rooms_info {
-#    room_name: {
-#       "members": {token: address},
-#       "password": password
-#    }
+#    room_name: Room(name, password, members={token: Session}, recipients, lock, is_closed, history=MessageHistory)
 # }
 
 # tokens_info {
-#    token: {
-#       "room_name": room_name,
-#       "last_access": datetime,
-#       "is_host": bool
-#    }
+#    token: Session(token, room, address, last_access, is_host, content_format, handle)
+# }
+
+# handles_info {
+#    session_id: Session
 # }
 
 # ★クラス毎の役割と連携イメージ
@@ -32,26 +50,38 @@ import base64
 # 【連携】
 # TCP/UDPServerでデータ受信→TCP/UDPProtocolHandlerでデータ解析→解析結果を基にChatServerでデータ処理→処理結果を基にTCP/UDPProtocolHandlerでデータ作成→TCP/UDPServerでデータ送信
 
+is_system_active = threading.Event()
+
 # TCP通信でのデータの送受信
 class TCPServer:
-   def __init__(self, server_ip, tcp_port, chat_server):
+   PIPELINE_WORKERS = 32 # request_id付きのリクエストを並行して処理するスレッド数
+   PIPELINE_MAX_IN_FLIGHT = 64 # 1接続で同時に処理するrequest_id付きのリクエストの最大数(超える場合は完了するまで次のリクエストを受信しない)
+
+   def __init__(self, server_ip, tcp_port, chat_server, max_frame_size=TCPFrameReader.MAX_FRAME_SIZE):
       self.server_address = (server_ip, tcp_port)
       self.chat_server = chat_server
+      self.max_frame_size = max_frame_size # 受信するリクエストの最大バイト数
+      self.pipeline_executor = None # request_id付きのリクエストを処理するスレッドプール(スレッド版のrunで作成する)
+      self.room_list_cache = None # (バージョン, レスポンスデータ, エラーメッセージ)。request_id無しのルーム一覧レスポンスをバージョン毎に使い回す
+      self.metrics = chat_server.metrics
 
    # 役割：クライアントからの接続の受信
    # 戻り値：無し
    def run(self):
+      self.pipeline_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.PIPELINE_WORKERS) # スレッドは最初のリクエスト時に起動する
       try:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind(self.server_address)
         self.sock.settimeout(3)
         self.sock.listen(5)
-        print(f"TCPサーバー起動: {self.server_address}")
+        log.info("TCPサーバー起動: %s", self.server_address)
 
         while not is_system_active.is_set():
             try:
                connection, client_address = self.sock.accept()
-               print(f"TCP接続受信: {client_address}")
+               # バリデートレスポンスと完了レスポンスの2回の送信が遅延確認応答で待たされないようにする(asyncioと同じ設定)
+               connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+               log.message("TCP接続受信: %s", client_address)
             except socket.timeout as e:
                continue
 
@@ -59,115 +89,593 @@ class TCPServer:
             handle_request.start()
 
       except KeyboardInterrupt as e:
-         print(e)
+         log.info("%r", e)
       finally:
           self.sock.close()
-          print("TCP 接続を閉じました。")
+          log.info("TCP 接続を閉じました。")
 
    # 役割：クライアントからのリクエストの処理
+   # request_id付きのリクエストは完了を待たずに次のリクエストを受信し、並行して処理する(レスポンスの順序は不定)
+   # 処理中のリクエストがPIPELINE_MAX_IN_FLIGHTに達した場合は、1件完了するまで次のリクエストを受信しない(TCPのフロー制御で送信側を待たせる)
    # 戻り値：無し
    def handle_request(self, connection, client_address):
+      send_lock = threading.Lock() # 並行して処理したリクエストのレスポンスが混ざらないようにするロック
+      in_flight = threading.BoundedSemaphore(self.PIPELINE_MAX_IN_FLIGHT) # 処理中のrequest_id付きのリクエストの枠
+      pending_futures = []
       try:
          while True:
             # リクエストの取得
             request = self.recieve_request(connection)
    
             if not request:
-               print(f"{client_address}とのTCP接続を終了します。")
+               log.message("%sとのTCP接続を終了します。", client_address)
                break
 
             # リクエストの解析
             parsed_request = TCPProtocolHandler.parse_data(request)
+            if "request_id" in parsed_request["operation_payload"]:
+               in_flight.acquire()
+               pending_futures = [future for future in pending_futures if not future.done()]
+               future = self.pipeline_executor.submit(self.handle_pipelined_request, connection, send_lock, parsed_request, client_address)
+               future.add_done_callback(lambda _: in_flight.release())
+               pending_futures.append(future)
+               continue
+
             # リクエストのバリデーション。エラーが無ければ空文字が返ってくる
-            error_message = self.chat_server.validate_request(parsed_request)
+            error_message = self.validate_request(parsed_request, client_address)
             if error_message:
-               print(error_message)
+               log.message("%s", error_message)
             else:
-               print("バリデーションに成功しました。")
+               log.message("バリデーションに成功しました。")
             # バリデートレスポンスの作成
             response = TCPProtocolHandler.make_validate_response(error_message)
             # バリデートレスポンスの送信
-            connection.send(response)
+            with send_lock:
+               connection.sendall(response)
 
             # バリデートに失敗している場合は処理を終える
             if error_message:
                return
             
             # リクエストの処理
-            operation = parsed_request["operation"]
-            operation_payload = parsed_request["operation_payload"]
-            type = operation_payload["type"]
-
-            if operation == 1:
-               # ルームの作成。成功すればトークンが返ってくる。
-               token, error_message = self.chat_server.create_room(parsed_request, client_address)
-               # レスポンスの作成
-               response = TCPProtocolHandler.make_token_response(token, error_message)
-               if error_message:
-                  print(error_message)
-               else:
-                  print("ルームの作成に成功しました。")
-            elif operation == 2 and type == "GET":
-               # ルーム一覧の作成。成功すれば一覧がリストで返ってくる。
-               room_list, error_message = self.chat_server.get_room_list()
-               # レスポンスの作成
-               response = TCPProtocolHandler.make_room_list_response(room_list, error_message)
-               if error_message:
-                  print(error_message)
-               else:
-                  print("ルーム一覧の取得に成功しました。")
-            elif operation == 2 and type == "JOIN":
-               # ルームへ追加。成功すればトークンが返ってくる。
-               token, error_message = self.chat_server.join_room(parsed_request, client_address)
-               # レスポンスの作成
-               response = TCPProtocolHandler.make_token_response(token, error_message)
-               if error_message:
-                  print(error_message)
-               else:
-                  print("ルームの参加に成功しました。")
+            response = self.process_request(parsed_request, client_address)
             # レスポンスの送信(共通のため最後処理する)
-            connection.sendall(response)
-            print("レスポンスを送信しました。")
+            with send_lock:
+               connection.sendall(response)
+            log.message("レスポンスを送信しました。")
       except OSError as e:
-         print(e)
+         log.warning("%s", e)
       except KeyboardInterrupt as e:
-         print(e)
+         log.info("%r", e)
       finally:
+         # 処理中のrequest_id付きのリクエストのレスポンスを送信してから閉じる
+         concurrent.futures.wait(pending_futures)
          connection.close()
 
+   # 役割：request_id付きのリクエストの処理
+   # バリデーションに失敗しても接続は閉じず、バリデートレスポンスと完了レスポンスをまとめて送信する
+   # 戻り値：無し
+   def handle_pipelined_request(self, connection, send_lock, parsed_request, client_address):
+      try:
+         try:
+            response = self.make_pipelined_response(parsed_request, client_address, self.validate_request(parsed_request, client_address))
+         except Exception as e:
+            # 処理中の例外でもrequest_idに応答し、クライアントが結果を待ち続けないようにする
+            response = self.make_pipelined_error_response(parsed_request, e)
+         with send_lock:
+            connection.sendall(response)
+      except OSError as e:
+         log.warning("%s", e)
+
+   # 役割：request_id付きのリクエストの処理中に例外が発生した場合のレスポンスの作成
+   # 戻り値：エラーメッセージ付きのバリデートレスポンス
+   def make_pipelined_error_response(self, parsed_request, error):
+      log.error("リクエストの処理中にエラーが発生しました: %r", error)
+      request_id = parsed_request["operation_payload"]["request_id"]
+      return TCPProtocolHandler.make_validate_response("サーバーでエラーが発生しました。", request_id)
+
+   # 役割：request_id付きのリクエストのレスポンスの作成
+   # 戻り値：バリデートレスポンス(失敗した場合はこれのみ)と完了レスポンスを連結したデータ
+   def make_pipelined_response(self, parsed_request, client_address, error_message):
+      request_id = parsed_request["operation_payload"]["request_id"]
+      response = TCPProtocolHandler.make_validate_response(error_message, request_id)
+      if error_message:
+         log.message("%s", error_message)
+         return response
+      return response + self.process_request(parsed_request, client_address)
+
+   # 役割：リクエストのバリデーション(管理操作は送信元がローカルホストかどうかも確認する)
+   # 戻り値：成功=None、失敗=エラーメッセージ
+   def validate_request(self, parsed_request, client_address):
+      error_message, password_check = self.check_request(parsed_request, client_address)
+      if password_check is not None:
+         error_message = self.chat_server.verify_password(password_check)
+      if error_message:
+         self.metrics.inc("chat_tcp_validation_failures_total")
+      return error_message
+
+   # 役割：パスワードの検証(bcrypt)以外のバリデーション(process_requestで処理できない操作も拒否する)
+   # 戻り値：(エラーメッセージ(成功=None), パスワードの検証が必要な場合はChatServer.prepare_password_checkの戻り値、不要な場合はNone)
+   def check_request(self, parsed_request, client_address):
+      operation = parsed_request["operation"]
+      type = parsed_request["operation_payload"].get("type")
+      if operation not in (1, 2, 3) or (operation == 2 and type not in ("GET", "JOIN")):
+         return "不明な操作です。", None
+      if operation == 3:
+         if not ipaddress.ip_address(client_address[0]).is_loopback:
+            return "管理操作はローカルホストからのみ実行できます。", None
+         elif parsed_request["operation_payload"]["type"] != "METRICS":
+            return "不明な管理操作です。", None
+         return None, None
+      return self.chat_server.prepare_password_check(parsed_request)
+
+   # 役割：バリデーション済みリクエストの処理(ルームの作成、一覧取得、参加、メトリクスの取得)
+   # 戻り値：レスポンスデータ
+   def process_request(self, parsed_request, client_address):
+      start = time.perf_counter()
+      operation = parsed_request["operation"]
+      operation_payload = parsed_request["operation_payload"]
+      type = operation_payload["type"]
+      request_id = operation_payload.get("request_id")
+
+      if operation == 1:
+         labels = 'operation="create"'
+         # ルームの作成。成功すればトークンが返ってくる。
+         token, error_message = self.chat_server.create_room(parsed_request, client_address)
+         # レスポンスの作成
+         response = TCPProtocolHandler.make_token_response(token, error_message, request_id)
+         if error_message:
+            log.message("%s", error_message)
+         else:
+            log.message("ルームの作成に成功しました。")
+      elif operation == 2 and type == "GET" and self.is_room_list_page_request(operation_payload):
+         labels = 'operation="get_page"'
+         # ページ指定、前方一致でのルーム一覧の取得
+         version, room_list, total, next_offset = self.chat_server.get_room_list_page(
+            operation_payload.get("offset", 0),
+            operation_payload.get("limit", ChatServer.ROOM_LIST_PAGE_MAX_SIZE),
+            operation_payload.get("prefix", "")
+         )
+         # レスポンスの作成
+         response = TCPProtocolHandler.make_room_list_page_response(room_list, version, total, next_offset, request_id)
+         log.message("ルーム一覧の取得に成功しました。")
+      elif operation == 2 and type == "GET":
+         # クライアントが前回のバージョンを送ってきた場合は差分(変更が無ければnot_modified)を返す
+         version = operation_payload.get("version")
+         delta = self.chat_server.get_room_list_delta(version) if isinstance(version, int) else None
+         labels = 'operation="get_delta"' if delta else 'operation="get"'
+         if delta:
+            response = TCPProtocolHandler.make_room_list_delta_response(*delta, request_id)
+            log.message("ルーム一覧の差分の取得に成功しました。")
+         else:
+            # ルーム一覧の作成。成功すれば一覧がリストで返ってくる。
+            response, error_message = self.make_room_list_response(request_id)
+            if error_message:
+               log.message("%s", error_message)
+            else:
+               log.message("ルーム一覧の取得に成功しました。")
+      elif operation == 2 and type == "JOIN":
+         labels = 'operation="join"'
+         # ルームへ追加。成功すればトークンが返ってくる。
+         token, error_message = self.chat_server.join_room(parsed_request, client_address)
+         # レスポンスの作成
+         response = TCPProtocolHandler.make_token_response(token, error_message, request_id)
+         if error_message:
+            log.message("%s", error_message)
+         else:
+            log.message("ルームの参加に成功しました。")
+      elif operation == 3 and type == "METRICS":
+         labels = 'operation="metrics"'
+         if operation_payload.get("format") == "prometheus":
+            metrics = self.metrics.render_prometheus()
+         else:
+            metrics = self.metrics.snapshot()
+         response = TCPProtocolHandler.make_metrics_response(metrics, request_id=request_id)
+
+      self.metrics.inc("chat_tcp_requests_total", labels=labels)
+      self.metrics.observe("chat_tcp_request_seconds", time.perf_counter() - start, labels)
+      return response
+
+   # 役割：ページ指定、前方一致でのルーム一覧取得リクエストかどうかの判定(値の型が不正な場合は通常の一覧取得として扱う)
+   # 戻り値：真偽値
+   @staticmethod
+   def is_room_list_page_request(operation_payload):
+      if not any(key in operation_payload for key in ("offset", "limit", "prefix")):
+         return False
+      return (
+         isinstance(operation_payload.get("offset", 0), int) and
+         isinstance(operation_payload.get("limit", 0), int) and
+         isinstance(operation_payload.get("prefix", ""), str)
+      )
+
+   # 役割：ルーム一覧レスポンスの作成
+   # request_idが無い場合はエンコード済みのレスポンスをバージョン毎にキャッシュし、一覧が変わるまで使い回す
+   # 戻り値：(レスポンスデータ, エラーメッセージ)
+   def make_room_list_response(self, request_id):
+      cache = self.room_list_cache
+      if request_id is None and cache and cache[0] == self.chat_server.directory_version:
+         return cache[1], cache[2]
+
+      version, room_list, error_message = self.chat_server.get_versioned_room_list()
+      response = TCPProtocolHandler.make_room_list_response(room_list, error_message, request_id, version)
+      if request_id is None:
+         self.room_list_cache = (version, response, error_message)
+      return response, error_message
+
    # 役割：クライアントからのリクエストデータの取得
-   # 戻り値：リクエストデータ
+   # 戻り値：リクエストデータ(bytearray)。接続が閉じられた場合やエラーの場合はNone
    def recieve_request(self, connection):
       try:
-         recieved_header_data = b""
-         while len(recieved_header_data) < 32:
-            chunk = connection.recv(32 - len(recieved_header_data))
-            if not chunk:
-               return ""
-            recieved_header_data += chunk
-
-         room_name_size = recieved_header_data[0]
-         operation_payload_size = int.from_bytes(recieved_header_data[3:], "big")
-         total_body_size = room_name_size + operation_payload_size
-         
-         recieved_body_data = b""
-         while len(recieved_body_data) < total_body_size:
-            chunk = connection.recv(total_body_size - len(recieved_body_data))
-            recieved_body_data += chunk
-         
-         request = recieved_header_data + recieved_body_data
-         return request
+         return TCPFrameReader(connection, self.max_frame_size).read_frame()
       except socket.timeout as e:
-         print(e)
+         log.warning("%s", e)
       except socket.error as e:
-         print(e)
+         log.warning("%s", e)
+      except ValueError as e:
+         log.warning("%s", e)
+
+
+# asyncioを使ったTCP通信でのデータの送受信
+# 接続毎にスレッドを作成せず、1つのイベントループで全ての接続を処理する。
+# アイドル状態の接続はソケットとコルーチン分のメモリしか消費しないため、数万接続を保持できる。
+class AsyncTCPServer(TCPServer):
+   BACKLOG = 4096 # 接続待ちキューの長さ(再接続が集中した場合に備えて大きめに設定)
+   MAX_OPEN_FILES = 1048576 # ファイルディスクリプタ数のソフトリミットの引き上げ先の上限
+
+   # 役割：イベントループの起動
+   # 戻り値：無し
+   def run(self):
+      # 数万の接続を保持できるようにファイルディスクリプタ数の上限を引き上げる
+      # ハードリミットが無制限の場合はMAX_OPEN_FILESまでにする(無制限のソフトリミットは設定できない)
+      try:
+         soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+         target_limit = self.MAX_OPEN_FILES if hard_limit == resource.RLIM_INFINITY else min(hard_limit, self.MAX_OPEN_FILES)
+         if soft_limit != resource.RLIM_INFINITY and soft_limit < target_limit:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target_limit, hard_limit))
+      except (ValueError, OSError) as e:
+         log.warning("ファイルディスクリプタ数の上限を引き上げられませんでした: %s", e)
+
+      try:
+         asyncio.run(self.serve())
+      except KeyboardInterrupt as e:
+         log.info("%r", e)
+      finally:
+         log.info("TCP 接続を閉じました。")
+
+   # 役割：クライアントからの接続の受信
+   # 戻り値：無し
+   async def serve(self):
+      server = await asyncio.start_server(self.handle_request, self.server_address[0], self.server_address[1], backlog=self.BACKLOG)
+      log.info("TCPサーバー起動(asyncio): %s", self.server_address)
+
+      async with server:
+         # システム終了のフラグを監視する
+         while not is_system_active.is_set():
+            await asyncio.sleep(1)
+
+   # 役割：クライアントからのリクエストの処理
+   # 処理中のrequest_id付きのリクエストがPIPELINE_MAX_IN_FLIGHTに達した場合は、1件完了するまで次のリクエストを受信しない
+   # 戻り値：無し
+   async def handle_request(self, reader, writer):
+      client_address = writer.get_extra_info("peername")
+      log.message("TCP接続受信: %s", client_address)
+      loop = asyncio.get_running_loop()
+      in_flight = asyncio.Semaphore(self.PIPELINE_MAX_IN_FLIGHT) # 処理中のrequest_id付きのリクエストの枠
+      pending_tasks = set()
+
+      try:
+         while True:
+            # リクエストの取得
+            request = await self.recieve_request(reader)
+
+            if not request:
+               log.message("%sとのTCP接続を終了します。", client_address)
+               break
+
+            # リクエストの解析
+            parsed_request = TCPProtocolHandler.parse_data(request)
+            # request_id付きのリクエストは完了を待たずに次のリクエストを受信する
+            if "request_id" in parsed_request["operation_payload"]:
+               await in_flight.acquire()
+               task = asyncio.create_task(self.handle_pipelined_request(writer, parsed_request, client_address))
+               pending_tasks.add(task)
+               task.add_done_callback(pending_tasks.discard)
+               task.add_done_callback(lambda _: in_flight.release())
+               continue
+
+            # リクエストのバリデーション。bcryptの検証でイベントループを止めないようにプロセスプール(またはスレッドプール)で実行する
+            error_message = await self.validate_request_async(parsed_request, client_address)
+            if error_message:
+               log.message("%s", error_message)
+            else:
+               log.message("バリデーションに成功しました。")
+            # バリデートレスポンスの送信
+            writer.write(TCPProtocolHandler.make_validate_response(error_message))
+
+            # バリデートに失敗している場合は処理を終える
+            if error_message:
+               await writer.drain()
+               return
+
+            # リクエストの処理とレスポンスの送信
+            writer.write(await self.call_request_handler(parsed_request, self.process_request, client_address))
+            await writer.drain()
+            log.message("レスポンスを送信しました。")
+      except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+         log.warning("%s", e)
+      finally:
+         # 処理中のrequest_id付きのリクエストのレスポンスを送信してから閉じる
+         if pending_tasks:
+            await asyncio.gather(*pending_tasks, return_exceptions=True)
+         writer.close()
+
+   # 役割：request_id付きのリクエストの処理
+   # 戻り値：無し
+   async def handle_pipelined_request(self, writer, parsed_request, client_address):
+      try:
+         try:
+            error_message = await self.validate_request_async(parsed_request, client_address)
+            response = await self.call_request_handler(parsed_request, self.make_pipelined_response, client_address, error_message)
+         except Exception as e:
+            # 処理中の例外でもrequest_idに応答し、クライアントが結果を待ち続けないようにする
+            response = self.make_pipelined_error_response(parsed_request, e)
+         writer.write(response)
+         await writer.drain()
+      except OSError as e:
+         log.warning("%s", e)
+
+   # 役割：リクエストのバリデーション(イベントループ用)
+   # パスワードの検証以外はイベントループで行い、検証はPasswordVerifierのプロセスプールへ直接送って完了を待つ。
+   # 実行中と待機中の検証が上限に達している場合は、スレッドプールで順番を待たずに混雑として即座に拒否する
+   # 戻り値：成功=None、失敗=エラーメッセージ
+   async def validate_request_async(self, parsed_request, client_address):
+      error_message, password_check = self.check_request(parsed_request, client_address)
+      if password_check is not None:
+         _, hashed_password, password = password_check
+         start = time.perf_counter()
+         password_verifier = self.chat_server.password_verifier
+         if password_verifier:
+            future = password_verifier.submit(password, hashed_password)
+            is_valid = await asyncio.wrap_future(future) if future is not None else None
+         else:
+            is_valid = await asyncio.get_running_loop().run_in_executor(None, CryptoHandler.verify_password, password, hashed_password)
+         error_message = self.chat_server.finish_password_check(password_check, is_valid, start)
+      if error_message:
+         self.metrics.inc("chat_tcp_validation_failures_total")
+      return error_message
+
+   # 役割：リクエストを処理する関数の実行(イベントループ用)
+   # multiprocessモードのルームの作成と参加はワーカーの起動待ちと登録の送信で待つことがあるため、イベントループを止めないようにスレッドプールで実行する
+   # 戻り値：関数の戻り値
+   async def call_request_handler(self, parsed_request, handler, *args):
+      if isinstance(self.chat_server, ShardedChatServer) and (parsed_request["operation"] == 1 or parsed_request["operation_payload"]["type"] == "JOIN"):
+         return await asyncio.get_running_loop().run_in_executor(None, handler, parsed_request, *args)
+      return handler(parsed_request, *args)
+
+   # 役割：クライアントからのリクエストデータの取得
+   # 戻り値：リクエストデータ(接続が閉じられた場合は空のバイト列)。max_frame_sizeを超える場合はValueErrorを送出する
+   async def recieve_request(self, reader):
+      try:
+         recieved_header_data = await reader.readexactly(TCPFrameReader.HEADER_SIZE)
+      except asyncio.IncompleteReadError:
+         return b""
+
+      frame_size = TCPFrameReader.get_frame_size(recieved_header_data, self.max_frame_size)
+      recieved_body_data = await reader.readexactly(frame_size - TCPFrameReader.HEADER_SIZE)
+      return recieved_header_data + recieved_body_data
+
+
+# UDPリレーのスループット(1秒あたりの受信・送信メッセージ数)の計測
+class ThroughputMeter:
+   def __init__(self):
+      self.messages_in = 0 # 受信したメッセージの累計
+      self.messages_out = 0 # 送信したメッセージの累計
+      self.packets_out = 0 # 送信したデータグラムの累計(複数のメッセージをまとめた場合はメッセージ数より少なくなる)
+      self.last_report = (time.monotonic(), 0, 0, 0) # 前回計測時の(時刻, 受信累計, 送信累計, 送信データグラム累計)
+
+   # 役割：受信メッセージ数の加算
+   # 戻り値：無し
+   def count_in(self, count=1):
+      self.messages_in += count
+
+   # 役割：送信メッセージ数の加算(packetsを省略した場合はメッセージ毎に1データグラムとする)
+   # 戻り値：無し
+   def count_out(self, count=1, packets=None):
+      self.messages_out += count
+      self.packets_out += count if packets is None else packets
+
+   # 役割：前回計測時からのスループットの計算
+   # 戻り値：(受信メッセージ数/秒, 送信メッセージ数/秒, 送信データグラム数/秒)
+   def measure(self):
+      now = time.monotonic()
+      last_time, last_in, last_out, last_packets_out = self.last_report
+      self.last_report = (now, self.messages_in, self.messages_out, self.packets_out)
+      elapsed = max(now - last_time, 1e-9)
+      return (self.messages_in - last_in) / elapsed, (self.messages_out - last_out) / elapsed, (self.packets_out - last_packets_out) / elapsed
+
+
+# 受信者毎の送信キューと送信専用スレッドによるUDPの送信
+# 受信者(アドレス)毎に上限付きのキューを持ち、送信スレッドはキューにデータのある受信者を順番に1件ずつ送信する。
+# 送信バッファが一杯の受信者がいても、受信・リレーの処理や他の受信者への送信は止まらない。
+# キューが上限に達した場合はdrop_policyに従って古いデータ(oldest)または新しいデータ(newest)を破棄する。
+# coalesce_windowを指定した場合、まとめたデータグラムを受信できる受信者へはcoalesce_window秒待つかcoalesce_bytesに達するまで
+# メッセージを溜め、1つのデータグラムにまとめて送信する。
+class OutboundSender:
+   DROP_OLDEST = "oldest"
+   DROP_NEWEST = "newest"
+   RETRY_INTERVAL = 0.001 # 送信バッファが一杯の場合に同じ受信者への送信を再開するまでの時間(秒)
+
+   def __init__(self, thread_count, queue_size, drop_policy=DROP_OLDEST, coalesce_window=0, coalesce_bytes=1200):
+      self.thread_count = thread_count
+      self.queue_size = queue_size # 受信者毎のキューの上限
+      self.drop_policy = drop_policy
+      self.coalesce_window = coalesce_window # メッセージを溜める時間(秒)。0の場合はまとめない
+      self.coalesce_bytes = coalesce_bytes # まとめたデータグラムの最大バイト数
+      self.sock = None
+      self.meter = None
+      self.queues = {} # アドレス -> 送信待ちのバッファのリストのキュー(送信待ちが無くなったら削除する)
+      self.ready = collections.deque() # 送信待ちがあり、送信中でない受信者のアドレス(ラウンドロビン)
+      self.waiting = {} # メッセージを溜めている受信者のアドレス -> 溜まったバイト数
+      self.deadlines = [] # (送信期限, アドレス)の最小ヒープ(waitingに無いアドレスは無視する)
+      self.condition = threading.Condition()
+      self.tokens = {} # アドレス -> トークン(破棄数の集計用)
+      self.batch_addresses = set() # まとめたデータグラムを受信できる受信者のアドレス
+      self.drop_counts = collections.Counter() # トークン(不明な場合はアドレス) -> 破棄数(削除したクライアントの分は除く)
+      self.drop_total = 0 # 破棄数の合計
+
+   # 役割：送信スレッドの起動
+   # 受信用のソケットはタイムアウト付きのため、送信にはノンブロッキングに設定した複製を使う
+   # (タイムアウト付きのソケットは送信バッファが一杯の場合に空くまで待つため、他の受信者への送信も止まる)
+   # 戻り値：無し
+   def start(self, sock, meter):
+      self.sock = sock.dup()
+      self.sock.setblocking(False)
+      self.meter = meter
+      for _ in range(self.thread_count):
+         threading.Thread(target=self.run, daemon=True).start()
+
+   # 役割：受信者のトークンと、まとめたデータグラムを受信できるかの登録(INITIAL時)
+   # 戻り値：無し
+   def register(self, address, token, accepts_batch=False):
+      with self.condition:
+         self.tokens[address] = token
+         if accepts_batch and self.coalesce_window > 0:
+            self.batch_addresses.add(address)
+         else:
+            self.batch_addresses.discard(address)
+
+   # 役割：受信者のトークンの登録解除(削除時)
+   # 戻り値：無し
+   def unregister(self, address):
+      with self.condition:
+         token = self.tokens.pop(address, None)
+         self.batch_addresses.discard(address)
+         self.drop_counts.pop(address if token is None else token, None)
+
+   # 役割：複数のアドレスへの同一メッセージ(バッファのリスト)をキューに積む
+   # 戻り値：無し
+   def enqueue(self, parts, addresses, exclude_address=None):
+      size = None
+      with self.condition:
+         for address in addresses:
+            if address == exclude_address:
+               continue
+            queue = self.queues.get(address)
+            if queue is None:
+               self.queues[address] = collections.deque((parts,))
+               # まとめて送信する受信者は送信期限まで溜める
+               if address in self.batch_addresses:
+                  size = size or sum(len(part) for part in parts)
+                  self.waiting[address] = size
+                  heapq.heappush(self.deadlines, (time.monotonic() + self.coalesce_window, address))
+               else:
+                  self.ready.append(address)
+               self.condition.notify()
+               continue
+            if len(queue) >= self.queue_size:
+               self.drop_counts[self.tokens.get(address, address)] += 1
+               self.drop_total += 1
+               if self.drop_policy == self.DROP_NEWEST:
+                  continue
+               queue.popleft()
+            queue.append(parts)
+            # 溜めている受信者がcoalesce_bytesに達したら期限を待たずに送信する
+            if address in self.waiting:
+               size = size or sum(len(part) for part in parts)
+               self.waiting[address] += size
+               if self.waiting[address] >= self.coalesce_bytes:
+                  del self.waiting[address]
+                  self.ready.append(address)
+                  self.condition.notify()
+
+   # 役割：送信期限を過ぎた受信者を送信待ちにする(conditionを取った状態で呼ぶ)
+   # 戻り値：無し
+   def release_due(self):
+      now = time.monotonic()
+      while self.deadlines and self.deadlines[0][0] <= now:
+         _, address = heapq.heappop(self.deadlines)
+         if self.waiting.pop(address, None) is not None:
+            self.ready.append(address)
+
+   # 役割：送信するメッセージの取り出し(conditionを取った状態で呼ぶ)
+   # まとめて送信する受信者はcoalesce_bytesに収まるだけ取り出す(1件目は大きさに関わらず取り出す)
+   # 戻り値：メッセージ毎のバッファのリストのリスト
+   def pop_messages(self, address):
+      queue = self.queues[address]
+      messages = [queue.popleft()]
+      if address not in self.batch_addresses:
+         return messages
+
+      size = len(UDPProtocolHandler.RELAY_HEADER + UDPProtocolHandler.BATCH_CONTENT_FLAG) + UDPProtocolHandler.BATCH_ITEM_SIZE.size + sum(len(part) for part in messages[0])
+      while queue:
+         message_size = UDPProtocolHandler.BATCH_ITEM_SIZE.size + sum(len(part) for part in queue[0])
+         if size + message_size > self.coalesce_bytes:
+            break
+         size += message_size
+         messages.append(queue.popleft())
+      return messages
+
+   # 役割：送信スレッドの処理。受信者を1件ずつ順番に送信し、同じ受信者を複数のスレッドが同時に送信することは無い
+   # 戻り値：無し
+   def run(self):
+      while True:
+         with self.condition:
+            while True:
+               self.release_due()
+               if self.ready:
+                  break
+               timeout = self.deadlines[0][0] - time.monotonic() if self.deadlines else None
+               self.condition.wait(timeout)
+            address = self.ready.popleft()
+            messages = self.pop_messages(address)
+
+         is_blocked = False
+         try:
+            if len(messages) == 1:
+               self.sock.sendmsg(messages[0], (), 0, address)
+            else:
+               self.sock.sendmsg(UDPProtocolHandler.make_batch_parts(messages), (), 0, address)
+            self.meter.count_out(len(messages), 1)
+         except BlockingIOError:
+            is_blocked = True
+         except OSError as e:
+            log.warning("UDP 送信エラー:%s", e)
+
+         with self.condition:
+            # 送信バッファが一杯の場合はメッセージをキューの先頭に戻し、少し待ってから再送する(待つ間は他の受信者へ送信する)
+            if is_blocked:
+               self.queues[address].extendleft(reversed(messages))
+               self.waiting[address] = 0
+               heapq.heappush(self.deadlines, (time.monotonic() + self.RETRY_INTERVAL, address))
+               self.condition.notify()
+            elif self.queues[address]:
+               self.ready.append(address)
+               self.condition.notify()
+            else:
+               del self.queues[address]
+
+   # 役割：破棄数の取得
+   # 戻り値：(破棄数の合計, 破棄数の多い順の(トークン, 破棄数)のリスト)
+   def drop_stats(self, top=3):
+      with self.condition:
+         return self.drop_total, self.drop_counts.most_common(top)
 
 
 # UDP通信でのデータの送受信
 class UDPServer:
-   def __init__(self, server_ip, udp_port, chat_server):
+   UNACTIVE_CHECK_INTERVAL = 5 # 非アクティブクライアントの確認間隔(秒)
+   THROUGHPUT_REPORT_INTERVAL = 10 # スループットの出力間隔(秒)
+
+   def __init__(self, server_ip, udp_port, chat_server, sender=None):
       self.server_address = (server_ip, udp_port)
       self.chat_server = chat_server
+      self.meter = ThroughputMeter()
+      self.sender = sender # OutboundSender(Noneの場合は受信したスレッドで送信する)
+      self.metrics = None
+      # ワーカープロセスではChatServerShardをrunで作成するため、その時に設定する
+      if chat_server:
+         self.metrics = chat_server.metrics
+         self.metrics.register_collector(self.collect_metrics)
    
    # 役割：クライアントからのメッセージの受信
    # 戻り値：無し
@@ -176,52 +684,96 @@ class UDPServer:
           self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
           self.sock.bind(self.server_address)
           self.sock.settimeout(3)
+          if self.sender:
+             self.sender.start(self.sock, self.meter)
           threading.Thread(target=self.handle_unactive_client, daemon=True).start()
+          threading.Thread(target=self.handle_throughput_report, daemon=True).start()
 
-          print(f"UDPサーバー起動: {self.server_address}")
+          log.info("UDPサーバー起動: %s", self.server_address)
 
           while not is_system_active.is_set():
             try:
-               message, client_address = self.sock.recvfrom(4096)
+               message, client_address = self.sock.recvfrom(UDPProtocolHandler.RECEIVE_BUFFER_SIZE)
+               self.meter.count_in()
                self.handle_message(message, client_address)
             except socket.timeout as e:
                continue
 
       except KeyboardInterrupt as e:
-         print(e)
+         log.info("%r", e)
       except Exception as e:
-          print(e)
+          log.warning("%s", e)
       finally:
           self.sock.close()
-          print("UDP 接続を閉じました。")
+          log.info("UDP 接続を閉じました。")
+
+   # 役割：1件のメッセージの送信
+   # 戻り値：無し
+   def send(self, message, address):
+      if self.sender:
+         self.sender.enqueue((message,), (address,))
+         return
+      self.sock.sendto(message, address)
+      self.meter.count_out()
+
+   # 役割：複数のアドレスへの同一メッセージの送信
+   # 戻り値：無し
+   def relay(self, message, addresses):
+      if self.sender:
+         self.sender.enqueue((message,), addresses)
+         return
+      for address in addresses:
+         self.sock.sendto(message, address)
+      self.meter.count_out(len(addresses))
+
+   # 役割：複数のアドレスへの同一メッセージの送信(バッファのリストをコピーせずにまとめて送信する)
+   # exclude_addressを指定した場合はそのアドレス(送信者)には送信しない
+   # 戻り値：無し
+   def relay_parts(self, parts, addresses, exclude_address=None):
+      if self.sender:
+         self.sender.enqueue(parts, addresses, exclude_address)
+         return
+      sent_count = 0
+      for address in addresses:
+         if address != exclude_address:
+            self.sock.sendmsg(parts, (), 0, address)
+            sent_count += 1
+      self.meter.count_out(sent_count)
 
    # 役割：メッセージの処理
    # 戻り値：無し
    def handle_message(self, message, client_address):
       try:
-         parsed_message = UDPProtocolHandler.parse_message(message)
+         # 通常のチャットはヘッダー、ルーム名、トークンのみ解析し、contentはデコードせずにそのままリレーする
+         room_name, token, content = UDPProtocolHandler.parse_header(message)
+         # セッションハンドルの場合はルーム名とトークンに解決する
+         if room_name is None:
+            routing = self.chat_server.resolve_session_handle(token)
+            if routing is None:
+               self.metrics.inc("chat_udp_validation_failures_total", labels='reason="session_handle"')
+               return
+            room_name, token = routing
+         if UDPProtocolHandler.peek_content_type(content) == "CHAT":
+            self.relay_chat({"room_name": room_name, "token": token}, content, client_address)
+            return
+         if content[:1] == UDPProtocolHandler.FRAGMENT_CONTENT_FLAG:
+            self.relay_fragment({"room_name": room_name, "token": token}, content, client_address)
+            return
+
+         parsed_message = UDPProtocolHandler.parse_message(message, log.warning)
+         if parsed_message is None:
+            self.metrics.inc("chat_udp_validation_failures_total", labels='reason="malformed"')
+            return
+         parsed_message["room_name"] = room_name
+         parsed_message["token"] = token
          content = parsed_message["content"]
-         print(f"{content['user_name']}から{content['type']}:{content['chat_data']}を受信しました。")
+         if log.message_sample_rate:
+            log.message("%sから%s:%sを受信しました。", content["user_name"], content["type"], content["chat_data"])
          
-         # 通常のチャット時
+         # 通常のチャット時(make_contentで作成されていないJSON形式のチャット)
          if content["type"] == "CHAT":
-            # 最終接続時刻の更新
-            self.chat_server.update_last_access(parsed_message)
-            # メッセージのバリデーション
-            is_valid = self.chat_server.validate_message(parsed_message, client_address)
-            if not is_valid:
-               return
-            # メッセージの作成
-            message = UDPProtocolHandler.make_relay_message(content["user_name"], content["chat_data"])
-            # アドレスリストの取得
-            members_list = self.chat_server.get_members_list(parsed_message["room_name"])
-            if members_list is None:
-               return
-            # メッセージのリレー
-            for _, address in members_list:
-               if address != client_address:
-                  self.sock.sendto(message, address)
-                  # print(f"{message}を{address}に送信しました。")
+            relay_content = UDPProtocolHandler.make_content("CHAT", content["user_name"], content["chat_data"], on_error=log.warning)
+            self.relay_chat(parsed_message, relay_content, client_address)
          
          # チャット退出時
          elif content["type"] == "LEAVE":
@@ -235,44 +787,151 @@ class UDPServer:
             if is_host:
                # ルームメンバー(ゲスト全員)の情報の取得
                members_list = self.chat_server.get_members_list(parsed_message["room_name"])
-               # ルームメンバーへクローズメッセージの送信
                # ルームメンバー情報の削除
-               message = UDPProtocolHandler.make_close_message()
                for token, address in members_list:
-                  self.chat_server.delete_client(token)
-                  self.sock.sendto(message, address)
+                  self.delete_client(token, address)
+               # ルームメンバーへクローズメッセージの送信
+               message = UDPProtocolHandler.make_close_message()
+               self.relay(message, [address for _, address in members_list])
             else:
                # 退出者情報のみ削除
-               self.chat_server.delete_client(parsed_message["token"])
+               self.delete_client(parsed_message["token"], client_address)
             
          # チャット開始時
          elif content["type"] == "INITIAL":
-            self.chat_server.initial(parsed_message, client_address)
+            capabilities = self.chat_server.initial(parsed_message, client_address)
+            if self.sender and self.chat_server.validate_message(parsed_message, client_address):
+               accepts_batch = capabilities is not None and UDPProtocolHandler.CAPABILITY_BATCH in capabilities
+               self.sender.register(client_address, parsed_message["token"], accepts_batch)
+            # 機能が通知された場合は同意した機能を応答する(通知しない従来のクライアントには応答しない)
+            if capabilities is not None:
+               session_handle = self.chat_server.get_session_handle(parsed_message["token"])
+               self.send(UDPProtocolHandler.make_initial_ack_message(capabilities, session_handle), client_address)
+            # 参加前のチャットを要求された場合は直近の履歴を送信する
+            history_count = content.get("history_count")
+            if isinstance(history_count, int) and history_count > 0 and self.chat_server.validate_message(parsed_message, client_address):
+               history = self.chat_server.get_history(parsed_message["room_name"], count=history_count)
+               self.send_history(history, parsed_message["token"], client_address)
+
+         # チャットの欠落の補完時
+         elif content["type"] == "HISTORY":
+            start = content.get("start")
+            end = content.get("end")
+            if not isinstance(start, int) or not isinstance(end, int):
+               return
+            if not self.chat_server.validate_message(parsed_message, client_address):
+               return
+            history = self.chat_server.get_history(parsed_message["room_name"], start, end, exclude_token=parsed_message["token"])
+            self.send_history(history, parsed_message["token"], client_address)
       except Exception as e:
-         print(e)
+         # 解析できないメッセージや、存在しないトークンのメッセージ
+         self.metrics.inc("chat_udp_validation_failures_total", labels='reason="malformed"')
+         log.warning("%s", e)
 
-   # 役割：非アクティブクライアントの削除
+   # 役割：チャットメッセージのリレー
+   # 受信したcontentはmemoryviewのままRELAY_HEADERと合わせてsendmsgで送信し、受信者の形式と異なる場合のみ変換する
+   # (バイナリ形式のcontentをJSON形式しか受信できない従来のクライアントへリレーする場合)
+   # 受信者はルーム毎に作成済みのタプルをロックを取らずにそのまま使う
+   # 戻り値：無し
+   def relay_chat(self, routing, content, client_address):
+      # 最終接続時刻の更新
+      self.chat_server.update_last_access(routing)
+      # メッセージのバリデーション
+      is_valid = self.chat_server.validate_message(routing, client_address)
+      if not is_valid:
+         self.metrics.inc("chat_udp_validation_failures_total", labels='reason="token"')
+         return
+
+      content_format = UDPProtocolHandler.get_content_format(content)
+      # 履歴に記録し、ルーム毎のシーケンス番号をヘッダーに付ける
+      sequence = self.chat_server.record_message(routing["room_name"], routing["token"], content_format, content)
+      relay_header = UDPProtocolHandler.make_relay_header(sequence)
+      fanout_width = -1 # 送信者を除く
+      for recipient_format, addresses in self.chat_server.get_recipients(routing["room_name"]):
+         relay_content = self.convert_content(content, content_format, recipient_format)
+         self.relay_parts((relay_header, relay_content), addresses, client_address)
+         fanout_width += len(addresses)
+      self.metrics.observe("chat_udp_fanout_width", fanout_width)
+
+   # 役割：分割されたチャットの断片のリレー
+   # 断片は再構成せずにそのまま、分割に同意したクライアントにのみリレーする(履歴には記録せず、シーケンス番号も付けない)
+   # 戻り値：無し
+   def relay_fragment(self, routing, content, client_address):
+      if UDPProtocolHandler.parse_fragment_header(content) is None:
+         self.metrics.inc("chat_udp_validation_failures_total", labels='reason="malformed"')
+         return
+      # 最終接続時刻の更新
+      self.chat_server.update_last_access(routing)
+      # メッセージのバリデーション
+      if not self.chat_server.validate_message(routing, client_address):
+         self.metrics.inc("chat_udp_validation_failures_total", labels='reason="token"')
+         return
+
+      fragment_recipients = self.chat_server.get_fragment_recipients(routing["room_name"])
+      self.relay_parts((UDPProtocolHandler.RELAY_HEADER, content), fragment_recipients, client_address)
+      self.metrics.inc("chat_udp_fragments_total")
+      # 分割に同意していないクライアントには形式を変換できないため送信しない(送信しなかった受信者数を数える)
+      undelivered = sum(len(addresses) for _, addresses in self.chat_server.get_recipients(routing["room_name"])) - len(fragment_recipients)
+      if undelivered > 0:
+         self.metrics.inc("chat_udp_fragments_undelivered_total", undelivered)
+
+   # 役割：チャットのcontentを受信者が受信できる形式に変換
+   # バイナリ形式を受信できるクライアントはJSON形式も受信できるため、変換が必要なのは従来のクライアントのみ
+   # 戻り値：content(変換が不要な場合はそのまま返す)
+   def convert_content(self, content, content_format, recipient_format):
+      if recipient_format == UDPProtocolHandler.CONTENT_FORMAT_BINARY or content_format == recipient_format:
+         return content
+      parsed_content = UDPProtocolHandler.parse_content(content)
+      return UDPProtocolHandler.make_content("CHAT", parsed_content["user_name"], parsed_content["chat_data"], recipient_format, on_error=log.warning)
+
+   # 役割：チャットの履歴の送信(リレーと同じシーケンス番号付きのメッセージとして送信する)
+   # 戻り値：無し
+   def send_history(self, history, token, address):
+      recipient_format = self.chat_server.get_content_format(token)
+      for sequence, content_format, content in history:
+         relay_content = self.convert_content(content, content_format, recipient_format)
+         self.relay_parts((UDPProtocolHandler.make_relay_header(sequence), relay_content), (address,))
+
+   # 役割：クライアントの削除
+   # 戻り値：無し
+   def delete_client(self, token, address):
+      self.chat_server.delete_client(token)
+      if self.sender:
+         self.sender.unregister(address)
+
+   # 役割：非アクティブクライアントの削除(定期実行)
    # 戻り値：無し
    def handle_unactive_client(self):
       while True:
-         time.sleep(5)
+         time.sleep(self.UNACTIVE_CHECK_INTERVAL)
+         self.delete_unactive_client()
 
-         # 非アクティブクライアントのリストを取得。(token, address)のリスト。
-         unactive_members_list = self.chat_server.detect_unactive_address_list()
+   # 役割：非アクティブクライアントの削除
+   # 戻り値：無し
+   def delete_unactive_client(self):
+      # 非アクティブクライアントのリストを取得。(token, address)のリスト。
+      unactive_members_list = self.chat_server.detect_unactive_address_list()
+      if unactive_members_list:
+         self.metrics.inc("chat_timeouts_total", len(unactive_members_list))
+      try:
          # タイムアウトメッセージの作成
          time_out_message = UDPProtocolHandler.make_timeout_message()
          # 非アクティブクライアントがホストだった場合に取得するゲストリストの変数
          guests_members_list = []
 
          for token, address in unactive_members_list:
-            is_host = self.chat_server.is_host(token)
-            if is_host:
-               # ホストだったらゲスト情報を取得。(token, address)のリスト
-               room_name = self.chat_server.get_client_room_name(token)
-               guests_members_list.extend(self.chat_server.get_members_list(room_name))
-            # 非アクティブクライアントを削除しメッセージを送信
-            self.chat_server.delete_client(token)
-            self.sock.sendto(time_out_message, address)
+            try:
+               is_host = self.chat_server.is_host(token)
+               if is_host:
+                  # ホストだったらゲスト情報を取得。(token, address)のリスト
+                  room_name = self.chat_server.get_client_room_name(token)
+                  guests_members_list.extend(self.chat_server.get_members_list(room_name))
+               # 非アクティブクライアントを削除しメッセージを送信
+               self.delete_client(token, address)
+            except KeyError:
+               # 取得後にLEAVEなどで削除されたクライアント
+               continue
+            self.send(time_out_message, address)
 
          # アクティブなゲストリスト情報を取得。
          active_members_list = list(set(guests_members_list) - set(unactive_members_list))
@@ -280,68 +939,782 @@ class UDPServer:
          close_message = UDPProtocolHandler.make_close_message()
          # アクティブなゲストを削除しメッセージを送信
          for token, address in active_members_list:
-            self.chat_server.delete_client(token)
-            self.sock.sendto(close_message, address)
+            try:
+               self.delete_client(token, address)
+            except KeyError:
+               continue
+            self.send(close_message, address)
+      finally:
+         # 削除されなかったクライアント(途中で例外が発生した場合など)は期限を入れ直し、次回の確認で再度判定する
+         self.chat_server.requeue_expiry(token for token, _ in unactive_members_list)
+
+   # 役割：チャットに参加しているクライアント全員へシステム停止メッセージを送信
+   # 戻り値：無し
+   def send_system_stop_message(self):
+      message = UDPProtocolHandler.make_system_stop_message()
+      all_addresses = self.chat_server.get_all_addresses()
+      for address in all_addresses:
+         self.sock.sendto(message, address)
+
+   # 役割：送受信数と送信キューの破棄数の取得(メトリクスのコレクター)
+   # 戻り値：[(名前, ラベル, 値), ...]
+   def collect_metrics(self):
+      metrics = [
+         ("chat_udp_datagrams_in_total", "", self.meter.messages_in),
+         ("chat_udp_messages_out_total", "", self.meter.messages_out),
+         ("chat_udp_datagrams_out_total", "", self.meter.packets_out),
+      ]
+      if self.sender:
+         metrics.append(("chat_udp_send_drops_total", "", self.sender.drop_stats(top=0)[0]))
+      return metrics
+
+   # 役割：スループットの出力(定期実行)
+   # 戻り値：無し
+   def handle_throughput_report(self):
+      while True:
+         time.sleep(self.THROUGHPUT_REPORT_INTERVAL)
+         self.report_throughput()
+
+   # 役割：スループットの出力
+   # 戻り値：無し
+   def report_throughput(self):
+      messages_in_per_sec, messages_out_per_sec, packets_out_per_sec = self.meter.measure()
+      log.info("UDPスループット: 受信 %.1f msg/s, 送信 %.1f msg/s (%.1f pkt/s)", messages_in_per_sec, messages_out_per_sec, packets_out_per_sec)
+      self.report_drops()
+
+   # 役割：送信キューの破棄数の出力(破棄があった場合のみ)
+   # 戻り値：無し
+   def report_drops(self):
+      if not self.sender:
+         return
+      drop_count, top_drops = self.sender.drop_stats()
+      if drop_count:
+         details = ", ".join(f"{str(token)[:8]}: {count}" for token, count in top_drops)
+         log.warning("送信キューの破棄: 合計 %d (%s)", drop_count, details)
+
+
+# asyncioのDatagramProtocolでUDPServerのイベントを受け取るプロトコル
+class UDPRelayProtocol(asyncio.DatagramProtocol):
+   def __init__(self, udp_server):
+      self.udp_server = udp_server
+
+   def datagram_received(self, data, addr):
+      self.udp_server.meter.count_in()
+      self.udp_server.handle_message(data, addr)
+
+   def error_received(self, exc):
+      log.warning("UDP 通信エラー:%s", exc)
+
+
+# asyncioを使ったUDP通信でのデータの送受信
+# メッセージの処理はUDPServerと共通。リレーの送信はキューに積み、一定件数ずつイベントループに戻りながら送信するため、
+# 大きなルームへのファンアウト中も他のルームのメッセージの受信が止まらない。
+class AsyncUDPServer(UDPServer):
+   FANOUT_BATCH_SIZE = 64 # イベントループに制御を戻すまでに送信する最大件数
+
+   def __init__(self, server_ip, udp_port, chat_server):
+      super().__init__(server_ip, udp_port, chat_server)
+      self.transport = None
+      self.fanout_queue = collections.deque() # (バッファのリスト, 未送信アドレスのイテレータ, 除外するアドレス)のキュー
+      self.is_fanout_scheduled = False
+
+   # 役割：イベントループの起動
+   # 戻り値：無し
+   def run(self):
+      try:
+         asyncio.run(self.serve())
+      except KeyboardInterrupt as e:
+         log.info("%r", e)
+      except Exception as e:
+         log.warning("%s", e)
+      finally:
+         self.sock.close()
+         log.info("UDP 接続を閉じました。")
+
+   # 役割：クライアントからのメッセージの受信
+   # 戻り値：無し
+   async def serve(self):
+      loop = asyncio.get_running_loop()
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.sock.bind(self.server_address)
+      self.sock.setblocking(False)
+      self.transport, _ = await loop.create_datagram_endpoint(lambda: UDPRelayProtocol(self), sock=self.sock)
+      log.info("UDPサーバー起動(asyncio): %s", self.server_address)
+
+      next_unactive_check = loop.time() + self.UNACTIVE_CHECK_INTERVAL
+      next_throughput_report = loop.time() + self.THROUGHPUT_REPORT_INTERVAL
+      try:
+         # システム終了のフラグを監視しながら定期処理を行う
+         while not is_system_active.is_set():
+            await asyncio.sleep(1)
+            if loop.time() >= next_unactive_check:
+               next_unactive_check += self.UNACTIVE_CHECK_INTERVAL
+               self.delete_unactive_client()
+            if loop.time() >= next_throughput_report:
+               next_throughput_report += self.THROUGHPUT_REPORT_INTERVAL
+               self.report_throughput()
+      finally:
+         self.transport.close()
+
+   # 役割：1件のメッセージの送信(送信できない場合はトランスポートがバッファリングする)
+   # 戻り値：無し
+   def send(self, message, address):
+      self.transport.sendto(message, address)
+      self.meter.count_out()
+
+   # 役割：複数のアドレスへの同一メッセージの送信をキューに積む
+   # 戻り値：無し
+   def relay(self, message, addresses):
+      self.relay_parts((message,), addresses)
+
+   # 役割：複数のアドレスへの同一メッセージ(バッファのリスト)の送信をキューに積む
+   # exclude_addressを指定した場合はそのアドレス(送信者)には送信しない
+   # 戻り値：無し
+   def relay_parts(self, parts, addresses, exclude_address=None):
+      self.fanout_queue.append((parts, iter(addresses), exclude_address))
+      if not self.is_fanout_scheduled:
+         self.is_fanout_scheduled = True
+         asyncio.get_running_loop().call_soon(self.flush_fanout)
+
+   # 役割：キューに積まれたリレーをFANOUT_BATCH_SIZE件まで送信し、残りがあれば次のループで続きを送信する
+   # 戻り値：無し
+   def flush_fanout(self):
+      sent_count = 0
+      while self.fanout_queue and sent_count < self.FANOUT_BATCH_SIZE:
+         parts, addresses, exclude_address = self.fanout_queue[0]
+         for address in addresses:
+            if address == exclude_address:
+               continue
+            self.send_parts(parts, address)
+            sent_count += 1
+            if sent_count >= self.FANOUT_BATCH_SIZE:
+               break
+         else:
+            self.fanout_queue.popleft()
+      self.meter.count_out(sent_count)
+
+      if self.fanout_queue:
+         asyncio.get_running_loop().call_soon(self.flush_fanout)
+      else:
+         self.is_fanout_scheduled = False
+
+   # 役割：バッファのリストをコピーせずに送信する
+   # トランスポートに送信待ちのデータがある場合や送信バッファが一杯の場合は、結合してトランスポートに任せる
+   # 戻り値：無し
+   def send_parts(self, parts, address):
+      if not self.transport.get_write_buffer_size():
+         try:
+            self.sock.sendmsg(parts, (), 0, address)
+            return
+         except BlockingIOError:
+            pass
+      self.transport.sendto(b"".join(parts), address)
+
+
+# メインプロセスとUDPワーカープロセス間のUNIXドメインソケット(データグラム)による通信
+class ShardChannel:
+   CONTROL = b"C" # メインプロセス→ワーカー：セッションの登録
+   EVENT = b"E" # ワーカー→メインプロセス：起動完了、セッションの削除
+   FORWARD = b"F" # ワーカー→ワーカー：担当外のルーム宛てデータグラムの転送
+   MAX_DATAGRAM_SIZE = 2**16
+
+   def __init__(self, ipc_dir, name):
+      self.ipc_dir = ipc_dir
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self.sock.bind(self.path(name))
+      self.forward_drop_count = 0 # 転送先のバッファが一杯で破棄したデータグラム数
+
+   # 役割：チャネル名からソケットのパスを取得
+   # 戻り値：パス
+   def path(self, name):
+      return os.path.join(self.ipc_dir, f"{name}.sock")
+
+   # 役割：ワーカーへの制御メッセージの送信
+   # 戻り値：無し
+   def send_control(self, worker_id, data):
+      self.sock.sendto(self.CONTROL + json.dumps(data).encode("utf-8"), self.path(f"worker-{worker_id}"))
+
+   # 役割：メインプロセスへのイベントの送信
+   # 戻り値：無し
+   def send_event(self, data):
+      self.sock.sendto(self.EVENT + json.dumps(data).encode("utf-8"), self.path("main"))
+
+   # 役割：担当ワーカーへのデータグラムの転送
+   # ワーカー同士が互いの転送でブロックしないよう、転送先のバッファが一杯の場合は破棄する(UDPと同じ扱い)
+   # 戻り値：無し
+   def forward(self, worker_id, message, address):
+      ip_bytes = address[0].encode("utf-8")
+      data = self.FORWARD + len(ip_bytes).to_bytes(1, "big") + ip_bytes + address[1].to_bytes(2, "big") + message
+      try:
+         self.sock.sendto(data, socket.MSG_DONTWAIT, self.path(f"worker-{worker_id}"))
+      except BlockingIOError:
+         self.forward_drop_count += 1
+
+   # 役割：メッセージの受信
+   # 戻り値：(種別, 内容)。内容は転送データグラムの場合は(データグラム, 送信元アドレス)、それ以外はdict
+   def recv(self, flags=0):
+      data = self.sock.recv(self.MAX_DATAGRAM_SIZE, flags)
+      kind = data[:1]
+      if kind == self.FORWARD:
+         ip_size = data[1]
+         ip = data[2:2+ip_size].decode("utf-8")
+         port = int.from_bytes(data[2+ip_size:4+ip_size], "big")
+         return kind, (data[4+ip_size:], (ip, port))
+      return kind, json.loads(data[1:].decode("utf-8"))
+
+   # 役割：ソケットの解放
+   # 戻り値：無し
+   def close(self):
+      self.sock.close()
+
+
+# UDPのリレーをルーム毎に複数のワーカープロセスへ分散するサーバー(メインプロセス側)
+# 各ワーカーはSO_REUSEPORTで同じポートにバインドし、ルーム名のハッシュで決まる担当ルームの情報のみを保持する。
+# メインプロセスはワーカーを起動し、ワーカーからのイベント(セッションの削除)をTCP側のChatServerに反映する。
+class ShardedUDPServer(UDPServer):
+   def __init__(self, server_ip, udp_port, chat_server, worker_count, sender_config=None, history_config=None, log_config=None):
+      super().__init__(server_ip, udp_port, chat_server)
+      self.worker_count = worker_count
+      self.sender_config = sender_config # ワーカー毎に作成するOutboundSenderの引数(Noneの場合は受信したスレッドで送信する)
+      self.history_config = history_config # ワーカーのチャットの履歴の(最大件数, 最大バイト数)(Noneの場合は既定値)
+      self.log_config = log_config # ワーカーのログの(レベル, キューの上限, メッセージ毎のイベントの出力間隔)(Noneの場合は既定値)
+
+   # 役割：送受信数の取得(メトリクスのコレクター)
+   # メインプロセスはデータグラムを送受信せず、ワーカーの送受信数は取得できないため、0ではなく値無しとする
+   # 戻り値：空のリスト
+   def collect_metrics(self):
+      return []
+
+   # 役割：ルーム名から担当ワーカーの番号を取得(プロセス間で一致するようにcrc32を使う)
+   # 戻り値：ワーカー番号
+   @staticmethod
+   def shard_of(room_name, worker_count):
+      return zlib.crc32(room_name.encode("utf-8")) % worker_count
+
+   # 役割：ワーカーの起動とワーカーからのイベントの処理
+   # 戻り値：無し
+   def run(self):
+      ipc_dir = tempfile.mkdtemp(prefix="chat-shard-")
+      channel = ShardChannel(ipc_dir, "main")
+      channel.sock.settimeout(1)
+      self.chat_server.channel = channel
+
+      # ワーカーはスレッドを持たない状態から起動するためspawnを使う
+      context = multiprocessing.get_context("spawn")
+      stop_event = context.Event()
+      workers = [
+         context.Process(target=run_shard_worker, args=(worker_id, self.worker_count, self.server_address, ipc_dir, stop_event, self.sender_config, self.history_config, self.log_config), daemon=True)
+         for worker_id in range(self.worker_count)
+      ]
+      for worker in workers:
+         worker.start()
+      self.chat_server.workers = workers
+
+      try:
+         ready_count = 0
+         while not is_system_active.is_set():
+            try:
+               _, event = channel.recv()
+            except socket.timeout:
+               continue
+
+            if event["op"] == "ready":
+               ready_count += 1
+               if ready_count == self.worker_count:
+                  self.chat_server.is_shard_ready.set()
+                  log.info("UDPサーバー起動(multiprocess, %dワーカー): %s", self.worker_count, self.server_address)
+            elif event["op"] == "delete":
+               self.chat_server.delete_client(event["token"])
+      except KeyboardInterrupt as e:
+         log.info("%r", e)
+      finally:
+         # ワーカーは停止時に担当ルームのクライアントへシステム停止メッセージを送信する
+         stop_event.set()
+         for worker in workers:
+            worker.join(timeout=5)
+         channel.close()
+         shutil.rmtree(ipc_dir, ignore_errors=True)
+         log.info("UDP 接続を閉じました。")
+
+   # 役割：システム停止メッセージの送信(各ワーカーが停止時に送信するためメインプロセスでは何もしない)
+   # 戻り値：無し
+   def send_system_stop_message(self):
+      pass
+
+
+# ワーカープロセスでのUDP通信でのデータの送受信
+# 受信したデータグラムのルームが担当外の場合は、ShardChannelで担当ワーカーへ転送する。
+class ShardWorkerUDPServer(UDPServer):
+   RECV_BATCH_SIZE = 64 # 制御メッセージの確認までに受信する最大データグラム数
+
+   def __init__(self, server_ip, udp_port, worker_id, worker_count, ipc_dir, stop_event, sender=None, history_config=None):
+      super().__init__(server_ip, udp_port, None, sender)
+      self.worker_id = worker_id
+      self.worker_count = worker_count
+      self.ipc_dir = ipc_dir
+      self.stop_event = stop_event
+      self.history_config = history_config
+
+   # 役割：クライアントからのデータグラムと他プロセスからのメッセージの受信
+   # 戻り値：無し
+   def run(self):
+      self.channel = ShardChannel(self.ipc_dir, f"worker-{self.worker_id}")
+      self.chat_server = ChatServerShard(self.channel, self.worker_id, self.worker_count, *(self.history_config or ()))
+      # ワーカーのメトリクスはワーカー内で集計する(メインプロセスの管理操作、HTTPサーバーからは取得できない)
+      self.metrics = self.chat_server.metrics
+      self.metrics.register_collector(self.collect_metrics)
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      self.sock.bind(self.server_address)
+      if self.sender:
+         self.sender.start(self.sock, self.meter)
+      self.channel.send_event({"op": "ready", "worker_id": self.worker_id})
+
+      next_unactive_check = time.monotonic() + self.UNACTIVE_CHECK_INTERVAL
+      next_throughput_report = time.monotonic() + self.THROUGHPUT_REPORT_INTERVAL
+      try:
+         while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.channel.sock, self.sock], [], [], 1)
+            # セッションの登録がクライアントのデータグラムより先に反映されるよう、制御メッセージを先に処理する
+            if self.channel.sock in readable:
+               self.handle_channel_message()
+            if self.sock in readable:
+               self.handle_datagrams()
+
+            now = time.monotonic()
+            if now >= next_unactive_check:
+               next_unactive_check += self.UNACTIVE_CHECK_INTERVAL
+               self.delete_unactive_client()
+            if now >= next_throughput_report:
+               next_throughput_report += self.THROUGHPUT_REPORT_INTERVAL
+               self.report_throughput()
+      except KeyboardInterrupt:
+         pass
+      finally:
+         self.send_system_stop_message()
+         self.sock.close()
+         self.channel.close()
+
+   # 役割：クライアントからのデータグラムの受信と振り分け
+   # 戻り値：無し
+   def handle_datagrams(self):
+      for _ in range(self.RECV_BATCH_SIZE):
+         try:
+            message, client_address = self.sock.recvfrom(UDPProtocolHandler.RECEIVE_BUFFER_SIZE, socket.MSG_DONTWAIT)
+         except BlockingIOError:
+            return
+         self.meter.count_in()
+
+         # セッションハンドルの場合はセッションIDから、それ以外はルーム名から担当ワーカーを決める
+         try:
+            session_id = UDPProtocolHandler.parse_session_id(message)
+            if session_id is None:
+               worker_id = ShardedUDPServer.shard_of(UDPProtocolHandler.parse_room_name(message), self.worker_count)
+            else:
+               worker_id = session_id % self.worker_count
+         except (IndexError, UnicodeDecodeError, struct.error) as e:
+            log.warning("パケット解析中にエラーが発生しました。:%s", e)
+            continue
+
+         if worker_id == self.worker_id:
+            self.handle_message(message, client_address)
+         else:
+            self.channel.forward(worker_id, message, client_address)
+
+   # 役割：他プロセスからのメッセージの処理
+   # 戻り値：無し
+   def handle_channel_message(self):
+      while True:
+         try:
+            kind, data = self.channel.recv(socket.MSG_DONTWAIT)
+         except BlockingIOError:
+            return
+
+         if kind == ShardChannel.FORWARD:
+            message, client_address = data
+            self.handle_message(message, client_address)
+         elif kind == ShardChannel.CONTROL and data["op"] == "register":
+            self.chat_server.register_client(data["room_name"], data["token"], tuple(data["address"]), data["is_host"])
+
+   # 役割：スループットの出力
+   # 戻り値：無し
+   def report_throughput(self):
+      messages_in_per_sec, messages_out_per_sec, packets_out_per_sec = self.meter.measure()
+      log.info("UDPスループット(ワーカー%d): 受信 %.1f msg/s, 送信 %.1f msg/s (%.1f pkt/s), 転送破棄 %d", self.worker_id, messages_in_per_sec, messages_out_per_sec, packets_out_per_sec, self.channel.forward_drop_count)
+      self.report_drops()
+
+
+# bcryptによるパスワードの検証をプロセスプールで実行する
+# 実行中と待機中の検証の合計がqueue_depthに達している場合は、待たせずに混雑として即座に拒否する
+class PasswordVerifier:
+   def __init__(self, worker_count, queue_depth):
+      # プールのプロセスはスレッドを持たない状態から起動するためspawnを使う
+      self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker_count, mp_context=multiprocessing.get_context("spawn"))
+      self.slots = threading.BoundedSemaphore(queue_depth)
+
+   # 役割：パスワードの検証
+   # 戻り値：一致=True、不一致=False、混雑=None
+   def verify(self, password, hashed_password):
+      future = self.submit(password, hashed_password)
+      return future.result() if future is not None else None
+
+   # 役割：パスワードの検証の依頼(完了を待たない。枠は検証の完了時に解放する)
+   # 戻り値：結果(一致=True、不一致=False)のFuture。混雑=None
+   def submit(self, password, hashed_password):
+      if not self.slots.acquire(blocking=False):
+         return None
+      try:
+         future = self.executor.submit(CryptoHandler.verify_password, password, hashed_password)
+      except Exception:
+         self.slots.release()
+         raise
+      future.add_done_callback(lambda _: self.slots.release())
+      return future
+
+   # 役割：プロセスプールの停止
+   # 戻り値：無し
+   def shutdown(self):
+      self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 検証済みのパスワードのキャッシュ(LRU + 有効期限)
+# キーはルーム名と、ルームのパスワードハッシュと送信されたパスワードのHMACで、平文のパスワードは保持しない
+class CredentialCache:
+   def __init__(self, max_size, ttl):
+      self.max_size = max_size # 保持する最大件数
+      self.ttl = ttl # 有効期限(秒)
+      self.hmac_key = secrets.token_bytes(32) # プロセス毎に生成するHMACの鍵
+      self.entries = collections.OrderedDict() # (ルーム名, HMAC) -> 有効期限。末尾ほど最近使われたもの
+      self.room_keys = {} # ルーム名 -> そのルームのキーの集合(ルーム削除時の無効化用)
+      self.lock = threading.Lock()
+      self.hit_count = 0
+      self.miss_count = 0
+
+   # 役割：キャッシュのキーの作成
+   # 戻り値：(ルーム名, HMAC)
+   def make_key(self, room_name, hashed_password, password):
+      message = hashed_password.encode("utf-8") + b"\x00" + password.encode("utf-8")
+      return room_name, hmac.new(self.hmac_key, message, hashlib.sha256).digest()
+
+   # 役割：検証済みかどうかの確認
+   # 戻り値：真偽値
+   def contains(self, room_name, hashed_password, password):
+      key = self.make_key(room_name, hashed_password, password)
+      with self.lock:
+         expires_at = self.entries.get(key)
+         if expires_at is None or expires_at < time.monotonic():
+            # 期限切れのエントリは枠を占有し続けないように削除する
+            if expires_at is not None:
+               del self.entries[key]
+               self.discard_room_key(key)
+            self.miss_count += 1
+            return False
+         self.entries.move_to_end(key)
+         self.hit_count += 1
+         return True
+
+   # 役割：検証済みのパスワードの追加
+   # 戻り値：無し
+   def add(self, room_name, hashed_password, password):
+      key = self.make_key(room_name, hashed_password, password)
+      with self.lock:
+         self.entries[key] = time.monotonic() + self.ttl
+         self.entries.move_to_end(key)
+         self.room_keys.setdefault(room_name, set()).add(key)
+
+         # 上限を超えたら最も長く使われていないものから削除する
+         while len(self.entries) > self.max_size:
+            old_key, _ = self.entries.popitem(last=False)
+            self.discard_room_key(old_key)
+
+   # 役割：ルームのキャッシュの無効化(ルーム削除時)
+   # 戻り値：無し
+   def invalidate_room(self, room_name):
+      with self.lock:
+         for key in self.room_keys.pop(room_name, ()):
+            self.entries.pop(key, None)
+
+   # 役割：ルーム毎のキーの集合からのキーの削除
+   # 戻り値：無し
+   def discard_room_key(self, key):
+      keys = self.room_keys.get(key[0])
+      if keys is not None:
+         keys.discard(key)
+         if not keys:
+            del self.room_keys[key[0]]
+
+   # 役割：ヒット数、ミス数の取得
+   # 戻り値：統計情報(dict)
+   def stats(self):
+      return {"hits": self.hit_count, "misses": self.miss_count, "size": len(self.entries)}
+
+
+# ルーム毎のチャットの履歴(シーケンス番号付きのリングバッファ)
+# シーケンス番号を容量で割った余りの位置に格納するため、番号からの参照は添字アクセス1回で済む。
+# 件数(capacity)とcontentの合計バイト数(max_bytes)の上限を超えた場合は古いものから破棄する。
+# ルームのUDPメッセージを処理するスレッド(ルーム毎に1つ)からのみ呼ぶためロックは取らない。
+class MessageHistory:
+   __slots__ = ("entries", "capacity", "max_bytes", "size_bytes", "first_sequence", "next_sequence")
+
+   def __init__(self, capacity, max_bytes):
+      self.entries = [None] * capacity # (シーケンス番号, 送信者のトークン, contentの形式, content)
+      self.capacity = capacity
+      self.max_bytes = max_bytes
+      self.size_bytes = 0 # 保持しているcontentの合計バイト数
+      self.first_sequence = 1 # 保持している最も古いシーケンス番号
+      self.next_sequence = 1 # 次に採番するシーケンス番号
+
+   # 役割：メッセージの追加(シーケンス番号の採番)
+   # 戻り値：シーケンス番号
+   def append(self, token, content_format, content):
+      sequence = self.next_sequence
+      self.next_sequence += 1
+      # 容量が0(履歴無し)の場合やcontentが上限を超える場合は記録せず、番号のみ採番する
+      if not self.capacity or len(content) > self.max_bytes:
+         return sequence
+
+      # 同じ位置の古いメッセージ(capacity件前)を上書きする
+      self.evict(sequence - self.capacity + 1)
+      self.entries[sequence % self.capacity] = (sequence, token, content_format, bytes(content))
+      self.size_bytes += len(content)
+      while self.size_bytes > self.max_bytes:
+         self.evict(self.first_sequence + 1)
+      return sequence
+
+   # 役割：first_sequenceより前のメッセージの破棄
+   # 戻り値：無し
+   def evict(self, first_sequence):
+      while self.first_sequence < first_sequence:
+         slot = self.first_sequence % self.capacity
+         entry = self.entries[slot]
+         if entry is not None and entry[0] == self.first_sequence:
+            self.size_bytes -= len(entry[3])
+            self.entries[slot] = None
+         self.first_sequence += 1
+
+   # 役割：シーケンス番号の範囲のメッセージの取得(破棄済みの番号は含まない)
+   # exclude_tokenを指定した場合はそのクライアントが送信したメッセージを含めない
+   # 戻り値：[(シーケンス番号, contentの形式, content), ...]
+   def get_range(self, start, end, exclude_token=None):
+      if not self.capacity:
+         return []
+      start = max(start, self.first_sequence)
+      end = min(end, self.next_sequence - 1)
+      entries = []
+      for sequence in range(start, end + 1):
+         entry = self.entries[sequence % self.capacity]
+         # 記録しなかった番号の位置には古いメッセージが残っている場合がある
+         if entry is not None and entry[0] == sequence and entry[1] != exclude_token:
+            entries.append((entry[0], entry[2], entry[3]))
+      return entries
+
+
+# ルームの情報
+# 参加しているクライアントのSessionを直接参照する
+class Room:
+   __slots__ = ("name", "password", "members", "recipients", "fragment_recipients", "lock", "is_closed", "history")
+
+   def __init__(self, name, password):
+      self.name = name
+      self.password = password # パスワードのハッシュ
+      self.members = {} # トークン -> Session
+      self.recipients = () # リレー先の((contentの形式, アドレスのタプル), ...)。変更せず、作り直して差し替える
+      self.fragment_recipients = () # 分割されたチャットの断片のリレー先のアドレスのタプル
+      self.lock = threading.Lock() # membersの更新用のロック
+      self.is_closed = False # 削除済みかどうか
+      self.history = None # チャットの履歴(MessageHistory)。最初のチャットで作成する
+
+   # 役割：リレー先のタプルの作り直し(参加、INITIAL、削除時にlockを取った状態で呼ぶ)
+   # 戻り値：無し
+   def rebuild_recipients(self):
+      addresses_by_format = {}
+      for session in self.members.values():
+         addresses_by_format.setdefault(session.content_format, []).append(session.address)
+      self.recipients = tuple((content_format, tuple(addresses)) for content_format, addresses in addresses_by_format.items())
+      self.fragment_recipients = tuple(session.address for session in self.members.values() if session.accepts_fragments)
+
+
+# クライアント(トークン)毎のセッションの情報
+# 参加しているRoomを直接参照する
+class Session:
+   __slots__ = ("token", "room", "address", "last_access", "is_host", "content_format", "handle", "accepts_fragments")
+
+   def __init__(self, token, room, address, last_access, is_host):
+      self.token = token
+      self.room = room
+      self.address = address # クライアントのアドレス(INITIALでUDPのアドレスに更新される)
+      self.last_access = last_access # 最終接続時刻(time.monotonic())
+      self.is_host = is_host
+      self.content_format = UDPProtocolHandler.CONTENT_FORMAT_JSON # UDPのcontentの形式(INITIALでネゴシエーション)
+      self.handle = None # セッションハンドル(INITIALでネゴシエーション)
+      self.accepts_fragments = False # 分割されたチャットの断片を受信できるかどうか(INITIALでネゴシエーション)
+
 
 # 全てのルームやクライアント情報の管理
 class ChatServer:
-   def __init__(self):
-      self.rooms_info = {}
-      self.tokens_info = {}
+   DIRECTORY_CHANGES_SIZE = 1024 # 差分を返すために保持するルームの作成、削除の履歴の件数
+   ROOM_LIST_PAGE_MAX_SIZE = 1000 # ページ指定のルーム一覧取得で1回に返す最大件数
+   HISTORY_SIZE = 256 # ルーム毎に保持するチャットの履歴の最大件数
+   HISTORY_BYTES = 64 * 1024 # ルーム毎に保持するチャットの履歴の最大バイト数
+   BUSY_MESSAGE = "サーバーが混雑しています。しばらくしてから再度お試しください。"
+   SESSION_ID_LIMIT = 2**32 # セッションIDの上限(セッションハンドルに4バイトで格納するため、超えたら0から採番し直す)
+
+   def __init__(self, password_verifier=None, credential_cache=None, history_size=HISTORY_SIZE, history_bytes=HISTORY_BYTES, journal=None):
+      self.rooms_info = {} # ルーム名 -> Room
+      self.tokens_info = {} # トークン -> Session
+      self.handles_info = {} # セッションID -> Session(セッションハンドルを発行したもののみ)
+      self.session_ids = itertools.count() # セッションIDの採番(next_session_idで上限内のIDに変換する)
+      self.session_id_offset = 0 # 最初のセッションID
+      self.session_id_step = 1 # セッションIDの間隔
+      self.handle_key = secrets.token_bytes(32) # セッションハンドルのMACの鍵
       self.TIMEOUT = 15 # 最終接続からTIMEOUT秒経つとクライアントは自動的に削除される。
+      self.expiry_heap = [] # (期限, トークン)の最小ヒープ。期限は作成時または前回確認時の最終接続時刻+TIMEOUT
+      self.password_verifier = password_verifier # Noneの場合はパスワードの検証をリクエストを処理するスレッドで行う
+      self.credential_cache = credential_cache # 検証済みのパスワードのキャッシュ(Noneの場合は毎回検証する)
+      # ロックの取得順序は directory_lock → ルームのロック とする
+      self.directory_lock = threading.Lock() # ルームの作成、削除用のロック
+      self.expiry_lock = threading.Lock() # 期限のヒープ用のロック
+      # ルーム一覧のバージョン。ルームの作成、削除毎に1増やす(directory_lockを取って更新する)
+      # 再起動前のバージョンを持つクライアントに誤った差分を返さないよう、起動時刻(マイクロ秒)から始める
+      self.directory_version = time.time_ns() // 1000
+      self.directory_changes = collections.deque(maxlen=self.DIRECTORY_CHANGES_SIZE) # (バージョン, ルーム名, 作成=True/削除=False)
+      self.history_size = history_size # ルーム毎のチャットの履歴の最大件数(0の場合は履歴を保持せず、シーケンス番号のみ付ける)
+      self.history_bytes = history_bytes # ルーム毎のチャットの履歴の最大バイト数
+      self.journal = journal # ルームとセッションの変更を記録するStateJournal(Noneの場合は記録しない)
+      self.room_index = [] # ルーム名のソート済みリスト(ページ指定、前方一致での一覧取得用)。ルームの作成、削除時に二分探索で挿入、削除する
+      self.metrics = MetricsRegistry() # TCPServer、UDPServerと共有するメトリクス
+      self.metrics.register_collector(self.collect_metrics)
 
    # 役割：リクエストのバリデーション。現在はルーム参加時のみ行っているが今後変更する可能性あり。
    # 戻り値：成功=None、失敗=エラーメッセージ
    def validate_request(self, parsed_request):
+      error_message, password_check = self.prepare_password_check(parsed_request)
+      if password_check is not None:
+         return self.verify_password(password_check)
+      return error_message
+
+   # 役割：パスワードの検証(bcrypt)の前のバリデーション(ルームの存在と検証済みのパスワードのキャッシュの確認)
+   # 戻り値：(エラーメッセージ(成功=None), 検証が必要な場合は(ルーム名, ハッシュ化されたパスワード, パスワード)、不要な場合はNone)
+   def prepare_password_check(self, parsed_request):
       operation = parsed_request["operation"]
       type = parsed_request["operation_payload"]["type"]
       room_name = parsed_request["room_name"]
       password = parsed_request["operation_payload"]["password"]
 
       if operation == 2 and type == "JOIN":
-         is_valid = CryptoHandler.verify_password(password, self.rooms_info[room_name]["password"])
-         if not is_valid:
-            return "パスワードに誤りがあります。"
-      
+         room = self.rooms_info.get(room_name)
+         if room is None:
+            return "ルームが存在しません。", None
+
+         # 再接続時などで検証済みのパスワードはbcryptの検証を省略する
+         if self.credential_cache and self.credential_cache.contains(room_name, room.password, password):
+            return None, None
+         return None, (room_name, room.password, password)
+
+      return None, None
+
+   # 役割：パスワードの検証(password_verifierが無い場合は呼び出したスレッドで検証する)
+   # 戻り値：成功=None、失敗=エラーメッセージ
+   def verify_password(self, password_check):
+      _, hashed_password, password = password_check
+      start = time.perf_counter()
+      if self.password_verifier:
+         is_valid = self.password_verifier.verify(password, hashed_password)
+      else:
+         is_valid = CryptoHandler.verify_password(password, hashed_password)
+      return self.finish_password_check(password_check, is_valid, start)
+
+   # 役割：パスワードの検証結果の反映(メトリクスの記録と検証済みのパスワードのキャッシュへの追加)
+   # 戻り値：成功=None、失敗=エラーメッセージ
+   def finish_password_check(self, password_check, is_valid, start):
+      room_name, hashed_password, password = password_check
+      if is_valid is None:
+         self.metrics.inc("chat_password_verify_busy_total")
+         return self.BUSY_MESSAGE
+      self.metrics.observe("chat_password_verify_seconds", time.perf_counter() - start)
+      if not is_valid:
+         return "パスワードに誤りがあります。"
+
+      if self.credential_cache:
+         self.credential_cache.add(room_name, hashed_password, password)
       return None
 
+   # 役割：ルーム数、セッション数と認証キャッシュのヒット数の取得(メトリクスのコレクター)
+   # 戻り値：[(名前, ラベル, 値), ...]
+   def collect_metrics(self):
+      metrics = [
+         ("chat_rooms", "", len(self.rooms_info)),
+         ("chat_sessions", "", len(self.tokens_info)),
+         ("chat_session_handles", "", len(self.handles_info)),
+      ]
+      if self.credential_cache:
+         stats = self.credential_cache.stats()
+         metrics.append(("chat_credential_cache_hits_total", "", stats["hits"]))
+         metrics.append(("chat_credential_cache_misses_total", "", stats["misses"]))
+      return metrics
+
    # 役割：ルームの作成
    # 戻り値：成功=(トークン,None)、失敗=(None、エラーメッセージ)
    def create_room(self, parsed_request, client_address):
       room_name = parsed_request["room_name"]
 
-      with lock:
+      with self.directory_lock:
          if room_name in self.rooms_info:
             return None, "ルームは既に存在します。"
          else:
-            token = self.generate_token()
-            self.rooms_info[room_name] = {
-               "members": {token: client_address},
-               "password": parsed_request["operation_payload"]["password"]
-            }
-            self.tokens_info[token] = {
-               "room_name": room_name,
-               "last_access": datetime.datetime.now(),
-               "is_host": True
-            }
-         return token, None
+            room = Room(room_name, parsed_request["operation_payload"]["password"])
+            session = Session(self.generate_token(), room, client_address, time.monotonic(), True)
+            room.members[session.token] = session
+            room.rebuild_recipients()
+            self.rooms_info[room_name] = room
+            self.tokens_info[session.token] = session
+            self.record_directory_change(room_name, True)
+            self.record_journal("room", room_name, room.password)
+            self.record_journal("join", session.token, room_name, client_address, True)
+      self.push_expiry(session)
+      return session.token, None
       
    # 役割：ルームにクライアントを追加（ルームへの参加）
    # 戻り値：成功=(トークン、None), 失敗=(None、エラーメッセージ)
    def join_room(self, parsed_request, client_address):
-      room_name = parsed_request["room_name"]
-      with lock:
-         if room_name not in self.rooms_info:
+      room = self.rooms_info.get(parsed_request["room_name"])
+      if room is None:
+         return None, "ルームが存在しません。"
+
+      with room.lock:
+         # 削除中のルームには参加できない
+         if room.is_closed:
             return None, "ルームが存在しません。"
-         else:
-            token = self.generate_token()
-            self.rooms_info[room_name]["members"][token] = client_address
-            self.tokens_info[token] = {
-               "room_name": room_name,
-               "last_access": datetime.datetime.now(),
-               "is_host": False
-            }
-      return token, None
+         session = Session(self.generate_token(), room, client_address, time.monotonic(), False)
+         room.members[session.token] = session
+         room.rebuild_recipients()
+         self.tokens_info[session.token] = session
+         self.record_journal("join", session.token, room.name, client_address, False)
+      self.push_expiry(session)
+      return session.token, None
+
+   # 役割：発行済みトークンのクライアントをルームに登録(ルームが存在しなければ作成する)
+   # 戻り値：無し
+   def register_client(self, room_name, token, client_address, is_host, password=""):
+      with self.directory_lock:
+         room = self.rooms_info.get(room_name)
+         if room is None:
+            room = self.rooms_info[room_name] = Room(room_name, password)
+            self.record_directory_change(room_name, True)
+            self.record_journal("room", room_name, password)
+         with room.lock:
+            session = Session(token, room, client_address, time.monotonic(), is_host)
+            room.members[token] = session
+            room.rebuild_recipients()
+            self.tokens_info[token] = session
+            self.record_journal("join", token, room_name, client_address, is_host)
+      self.push_expiry(session)
+
+   # 役割：期限のヒープへの追加
+   # 戻り値：無し
+   def push_expiry(self, session):
+      with self.expiry_lock:
+         heapq.heappush(self.expiry_heap, (session.last_access + self.TIMEOUT, session.token))
 
    # 役割：ルーム一覧の取得
    # 戻り値：成功=(ルーム一覧リスト,None), 失敗=(None,エラーメッセージ)
@@ -351,6 +1724,80 @@ class ChatServer:
       else:
          return list(self.rooms_info.keys()), None
 
+   # 役割：バージョン付きのルーム一覧の取得
+   # 戻り値：(バージョン, ルーム一覧リスト, エラーメッセージ)。ルーム一覧リストとエラーメッセージはget_room_listと同じ
+   def get_versioned_room_list(self):
+      with self.directory_lock:
+         room_list, error_message = self.get_room_list()
+         return self.directory_version, room_list, error_message
+
+   # 役割：クライアントが持つバージョンからのルーム一覧の差分の取得
+   # 戻り値：成功=(現在のバージョン, 追加されたルームのリスト, 削除されたルームのリスト)
+   #         履歴に含まれないバージョン(古すぎる、再起動前など)の場合はNone
+   def get_room_list_delta(self, version):
+      with self.directory_lock:
+         current_version = self.directory_version
+         if version == current_version:
+            return current_version, [], []
+         # 履歴のバージョンは連続しているため、最も古い変更の直前のバージョンまでは差分を求められる
+         if version > current_version or not self.directory_changes or version < self.directory_changes[0][0] - 1:
+            return None
+         # 新しい変更から遡って集める(一覧の取得間隔が短ければ数件で済む)
+         changes = []
+         for change in reversed(self.directory_changes):
+            if change[0] <= version:
+               break
+            changes.append(change)
+         changes.reverse()
+
+      # ルーム毎に最初と最後の変更を比べる(最初が削除なら元々存在し、最後が作成なら現在存在する)
+      first_changes = {}
+      last_changes = {}
+      for _, room_name, is_created in changes:
+         first_changes.setdefault(room_name, is_created)
+         last_changes[room_name] = is_created
+      added = [room_name for room_name, is_created in last_changes.items() if is_created and first_changes[room_name]]
+      removed = [room_name for room_name, is_created in last_changes.items() if not is_created and not first_changes[room_name]]
+      return current_version, added, removed
+
+   # 役割：ページ指定、前方一致でのルーム一覧の取得
+   # ソート済みの索引を二分探索するため、ルーム数に関わらず返す件数分の処理で済む
+   # 戻り値：(バージョン, ルーム一覧リスト, 前方一致するルームの総数, 次のページのオフセット(最後のページの場合はNone))
+   def get_room_list_page(self, offset=0, limit=ROOM_LIST_PAGE_MAX_SIZE, prefix=""):
+      limit = max(0, min(limit, self.ROOM_LIST_PAGE_MAX_SIZE))
+      offset = max(0, offset)
+      with self.directory_lock:
+         # prefixで始まる名前は[prefix, prefixの次の文字列)の範囲に並ぶ
+         start = bisect.bisect_left(self.room_index, prefix)
+         upper_bound = self.get_prefix_upper_bound(prefix)
+         end = bisect.bisect_left(self.room_index, upper_bound, start) if upper_bound is not None else len(self.room_index)
+         room_list = self.room_index[start + offset:min(start + offset + limit, end)]
+         version = self.directory_version
+
+      total = end - start
+      next_offset = offset + len(room_list) if offset + len(room_list) < total and room_list else None
+      return version, room_list, total, next_offset
+
+   # 役割：前方一致の範囲の上限の取得(prefixで始まる全ての文字列より大きい最小の文字列)
+   # 最後の文字のコードポイントを1増やす。最大のコードポイントの文字は取り除いてその前の文字を増やす
+   # 戻り値：上限の文字列。上限が無い場合(prefixが空、または最大のコードポイントの文字のみの場合)はNone
+   @staticmethod
+   def get_prefix_upper_bound(prefix):
+      prefix = prefix.rstrip("\U0010ffff")
+      if not prefix:
+         return None
+      return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+   # 役割：ルームの作成、削除の記録(バージョン、変更履歴、索引の更新。directory_lockを取った状態で呼ぶ)
+   # 戻り値：無し
+   def record_directory_change(self, room_name, is_created):
+      self.directory_version += 1
+      self.directory_changes.append((self.directory_version, room_name, is_created))
+      if is_created:
+         bisect.insort(self.room_index, room_name)
+      else:
+         del self.room_index[bisect.bisect_left(self.room_index, room_name)]
+
    # 役割：トークンの生成
    # 戻り値：トークン
    def generate_token(self):
@@ -361,21 +1808,122 @@ class ChatServer:
         # トークンサイズを超えないようにトリミング
         return token[:UDPProtocolHandler.TOKEN_MAX_BYTE_SIZE]
 
-   # 役割：アドレスの更新(TCP接続とUDP接続でポートが異なるためチャット開始時に更新)
-   # 戻り値：無し
+   # 役割：アドレスの更新(TCP接続とUDP接続でポートが異なるためチャット開始時に更新)と機能のネゴシエーション
+   # 戻り値：機能が通知された場合は同意した機能のリスト、通知されていない場合はNone
    def initial(self, parsed_message, client_address):
-      with lock:
-         room_name = parsed_message["room_name"]
-         token = parsed_message["token"]
-         self.rooms_info[room_name]["members"][token] = client_address
+      capabilities = parsed_message["content"].get("capabilities")
+
+      # ルームに参加していないトークンは無視する
+      session = self.tokens_info.get(parsed_message["token"])
+      if session is None or session.room.name != parsed_message["room_name"]:
+         return None
+
+      accepted_capabilities = None
+      with session.room.lock:
+         session.address = client_address
+
+         if capabilities is not None:
+            accepted_capabilities = [capability for capability in capabilities if capability in UDPProtocolHandler.CAPABILITIES]
+            if UDPProtocolHandler.CAPABILITY_BINARY in accepted_capabilities:
+               session.content_format = UDPProtocolHandler.CONTENT_FORMAT_BINARY
+            # 断片は形式を変換せずにリレーするため、どちらの形式も受信できる(binaryに同意した)クライアントにのみ同意する
+            elif UDPProtocolHandler.CAPABILITY_FRAGMENT in accepted_capabilities:
+               accepted_capabilities.remove(UDPProtocolHandler.CAPABILITY_FRAGMENT)
+            session.accepts_fragments = UDPProtocolHandler.CAPABILITY_FRAGMENT in accepted_capabilities
+            # INITIALが再送された場合は発行済みのハンドルを使う
+            if UDPProtocolHandler.CAPABILITY_SESSION_HANDLE in accepted_capabilities and session.handle is None:
+               self.issue_session_handle(session, self.next_session_id())
+
+         # アドレスと形式が変わるためリレー先を作り直す
+         session.room.rebuild_recipients()
+         self.record_journal("initial", session.token, client_address, session.content_format, session.handle.hex() if session.handle else None, session.accepts_fragments)
+      return accepted_capabilities
+
+   # 役割：セッションハンドルの発行(セッションIDとトークンのMACから作成する)
+   # 戻り値：無し
+   def issue_session_handle(self, session, session_id):
+      mac = hmac.new(self.handle_key, session_id.to_bytes(4, "big") + session.token.encode("utf-8"), hashlib.sha256).digest()
+      session.handle = UDPProtocolHandler.SESSION_HANDLE.pack(session_id, mac[:4])
+      self.handles_info[session_id] = session
+
+   # 役割：セッションIDの採番
+   # session_id_offsetからsession_id_step毎のIDを順番に使い、SESSION_ID_LIMITを超えたらsession_id_offsetに戻る
+   # (間隔を保つため、ワーカーが採番したIDは一周した後も同じワーカーの担当になる)。使用中のIDは飛ばす
+   # 戻り値：セッションID
+   def next_session_id(self):
+      id_count = (self.SESSION_ID_LIMIT - 1 - self.session_id_offset) // self.session_id_step + 1
+      while True:
+         session_id = self.session_id_offset + self.session_id_step * (next(self.session_ids) % id_count)
+         if session_id not in self.handles_info:
+            return session_id
+
+   # 役割：セッションIDの取得
+   # 戻り値：セッションID。セッションハンドルを発行していない場合はNone
+   def get_session_id(self, session):
+      return UDPProtocolHandler.SESSION_HANDLE.unpack(session.handle)[0] if session.handle else None
+
+   # 役割：セッションハンドルの取得
+   # 戻り値：セッションハンドル。発行していない場合はNone
+   def get_session_handle(self, token):
+      session = self.tokens_info.get(token)
+      return session.handle if session else None
+
+   # 役割：セッションハンドルからルーム名とトークンを取得
+   # 戻り値：(ルーム名, トークン)。存在しないセッションIDやMACが一致しない場合はNone
+   def resolve_session_handle(self, handle):
+      session_id, _ = UDPProtocolHandler.SESSION_HANDLE.unpack(handle)
+      session = self.handles_info.get(session_id)
+      if session is None or not hmac.compare_digest(session.handle, handle):
+         return None
+      return session.room.name, session.token
+
+   # 役割：ルームのリレー先の取得(ロックを取らずに作成済みのタプルを返す)
+   # 戻り値：((contentの形式, アドレスのタプル), ...)。ルームが存在しない場合は空のタプル
+   def get_recipients(self, room_name):
+      room = self.rooms_info.get(room_name)
+      return room.recipients if room else ()
+
+   # 役割：ルームの分割されたチャットの断片のリレー先の取得
+   # 戻り値：アドレスのタプル。ルームが存在しない場合は空のタプル
+   def get_fragment_recipients(self, room_name):
+      room = self.rooms_info.get(room_name)
+      return room.fragment_recipients if room else ()
+
+   # 役割：チャットの履歴への記録とシーケンス番号の採番
+   # 戻り値：シーケンス番号。ルームが存在しない場合はNone
+   def record_message(self, room_name, token, content_format, content):
+      room = self.rooms_info.get(room_name)
+      if room is None:
+         return None
+      if room.history is None:
+         room.history = MessageHistory(self.history_size, self.history_bytes)
+      return room.history.append(token, content_format, content)
+
+   # 役割：チャットの履歴の取得(startからendまでのシーケンス番号。countを指定した場合は最新のcount件)
+   # 欠落の補完時は、要求したクライアント自身が送信したメッセージを除く(送信者にはリレーしていないため)
+   # 戻り値：[(シーケンス番号, contentの形式, content), ...]
+   def get_history(self, room_name, start=0, end=0, count=None, exclude_token=None):
+      room = self.rooms_info.get(room_name)
+      if room is None or room.history is None:
+         return []
+      if count is not None:
+         end = room.history.next_sequence - 1
+         start = end - count + 1
+      return room.history.get_range(start, end, exclude_token)
+
+   # 役割：クライアントが受信できるcontentの形式の取得
+   # 戻り値：contentの形式
+   def get_content_format(self, token):
+      return self.tokens_info[token].content_format
          
    # 役割：メッセージのバリデーション(トークンとアドレスが一致するかどうか)
    # 戻り値：真偽値
    def validate_message(self, parsed_message, client_address):
-      if not self.rooms_info:
+      session = self.tokens_info.get(parsed_message["token"])
+      if session is None:
          return False
       
-      if self.rooms_info[parsed_message["room_name"]]["members"][parsed_message["token"]] != client_address:
+      if session.room.name != parsed_message["room_name"] or session.address != client_address:
          return False
       
       return True
@@ -383,103 +1931,399 @@ class ChatServer:
    # 役割：ルーム名からルームメンバー情報を取得
    # 戻り値：ルームメンバーのトークンとアドレスのタプルのリスト
    def get_members_list(self, room_name):
-      members_list = []
-
-      for token, address in self.rooms_info[room_name]["members"].items():
-         members_list.append((token, address))
-      
-      return members_list
+      room = self.rooms_info[room_name]
+      with room.lock:
+         return [(token, session.address) for token, session in room.members.items()]
    
    # 役割：トークンからアドレスを取得
    # 戻り値：アドレス
    def get_client_room_name(self, token):
-      return self.tokens_info[token]["room_name"]
+      return self.tokens_info[token].room.name
    
    # 役割：クライアント全員のアドレスを取得
    # 戻り値：クライアント全員のアドレス
    def get_all_addresses(self):
       all_addresses = []
 
-      for room_name, room_info in self.rooms_info.items():
-         for token, address in room_info["members"].items():
-            all_addresses.append(address)
+      with self.directory_lock:
+         rooms = list(self.rooms_info.values())
+      for room in rooms:
+         with room.lock:
+            all_addresses.extend(session.address for session in room.members.values())
       
       return all_addresses
 
    # 役割：ホストかどうか確認
    # 戻り値：真偽値
    def is_host(self, token):
-      if self.tokens_info[token]["is_host"]:
+      if self.tokens_info[token].is_host:
          return True
       else:
          return False
 
    # 役割：非アクティブクライアント情報の取得
+   # 取り出したエントリはヒープから除くため、呼び出し側は削除しなかったクライアントをrequeue_expiryで入れ直す
    # 戻り値：非アクティブユーザーのトークンとアドレスのタプルのリスト
    def detect_unactive_address_list(self):
-      timeout = datetime.timedelta(seconds=self.TIMEOUT)
-      now = datetime.datetime.now()
+      now = time.monotonic()
 
       members_list = []
-      for token, members_info in self.tokens_info.items():
-         last_access = members_info["last_access"]
+      with self.expiry_lock:
+         # 期限を過ぎたエントリのみ取り出す。最終接続時刻が更新されていれば新しい期限で入れ直し、削除済みのトークンは捨てる
+         while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, token = heapq.heappop(self.expiry_heap)
+            session = self.tokens_info.get(token)
+            if session is None:
+               continue
+
+            deadline = session.last_access + self.TIMEOUT
+            if deadline > now:
+               heapq.heappush(self.expiry_heap, (deadline, token))
+               continue
 
-         if now - last_access > timeout:
-            room_name = members_info["room_name"]
-            address = self.rooms_info[room_name]["members"][token]
-            members_list.append((token, address))
+            members_list.append((token, session.address))
 
       return members_list
    
-   # 役割：最終接続時刻の更新
+   # 役割：期限切れとして取り出したクライアントのうち、削除されなかったものの期限の入れ直し
+   # 戻り値：無し
+   def requeue_expiry(self, tokens):
+      for token in tokens:
+         session = self.tokens_info.get(token)
+         if session is not None:
+            self.push_expiry(session)
+
+   # 役割：最終接続時刻の更新(期限のヒープは更新せず、期限切れの確認時に反映する)
+   # 値の代入のみのためロックは取らない
    # 戻り値：無し
    def update_last_access(self, parsed_message):
-      token = parsed_message["token"]
-      with lock:
-         self.tokens_info[token]["last_access"] = datetime.datetime.now()
+      self.tokens_info[parsed_message["token"]].last_access = time.monotonic()
 
    # 役割：ユーザーの削除
    # 戻り値：無し
    def delete_client(self, token):
-      room_name = self.tokens_info[token]["room_name"]
-      with lock:
+      session = self.tokens_info[token]
+      room = session.room
+      with room.lock:
          del self.tokens_info[token]
-         del self.rooms_info[room_name]["members"][token]
+         del room.members[token]
+         room.rebuild_recipients()
+         if session.handle:
+            del self.handles_info[self.get_session_id(session)]
+         is_empty = not room.members
+         self.record_journal("delete", token)
+
+      if not is_empty:
+         return
+      # ルームが空になった場合はディレクトリのロックを取り直して削除する(取り直す間に参加したクライアントがいれば削除しない)
+      with self.directory_lock:
+         with room.lock:
+            if room.members or self.rooms_info.get(room.name) is not room:
+               return
+            room.is_closed = True
+            del self.rooms_info[room.name]
+            self.record_directory_change(room.name, False)
+      if self.credential_cache:
+         self.credential_cache.invalidate_room(room.name)
+
+   # 役割：状態の変更のジャーナルへの記録(ジャーナルが無い場合は何もしない)
+   # 変更と記録の順序が入れ替わらないよう、変更時のロックを取った状態で呼ぶ
+   # 戻り値：無し
+   def record_journal(self, *record):
+      if self.journal:
+         self.journal.append(record)
+
+   # 役割：ジャーナルからの状態の復元と記録の開始(起動時、リクエストの受信前に呼ぶ)
+   # 最終接続時刻は復元時刻にする(再起動中に通信できなかったクライアントがすぐにタイムアウトしないように)
+   # セッションハンドルは発行済みのものをそのまま復元するため、MACの鍵は保存せず起動毎に作り直す
+   # 戻り値：復元したセッション数
+   def recover(self):
+      state, records = self.journal.load()
+      if state:
+         for room_name, password, sessions in state["rooms"]:
+            self.apply_journal_record(("room", room_name, password))
+            for token, address, is_host, content_format, handle, *accepts_fragments in sessions:
+               self.apply_journal_record(("join", token, room_name, address, is_host))
+               self.apply_journal_record(("initial", token, address, content_format, handle, *accepts_fragments))
+      for record in records:
+         self.apply_journal_record(record)
+
+      for room in self.rooms_info.values():
+         room.rebuild_recipients()
+      for session in self.tokens_info.values():
+         self.push_expiry(session)
+      # 復元したセッションIDと重ならないように採番を続ける
+      self.session_ids = itertools.count(max(self.handles_info, default=-1) + 1)
+      self.journal.start(self.make_snapshot)
+      return len(self.tokens_info)
+
+   # 役割：ジャーナルのレコードの適用(同じレコードを複数回適用しても結果は変わらない)
+   # 戻り値：無し
+   def apply_journal_record(self, record):
+      operation = record[0]
+      if operation == "room":
+         _, room_name, password = record
+         if room_name not in self.rooms_info:
+            self.rooms_info[room_name] = Room(room_name, password)
+            self.record_directory_change(room_name, True)
+      elif operation == "join":
+         _, token, room_name, address, is_host = record
+         room = self.rooms_info.get(room_name)
+         if room is not None and token not in self.tokens_info:
+            session = Session(token, room, tuple(address), time.monotonic(), is_host)
+            room.members[token] = session
+            self.tokens_info[token] = session
+      elif operation == "initial":
+         # 断片の受信可否を含まない(以前の形式の)レコードは受信できないものとして扱う
+         _, token, address, content_format, handle, *accepts_fragments = record
+         session = self.tokens_info.get(token)
+         if session is not None:
+            session.address = tuple(address)
+            session.content_format = content_format
+            session.accepts_fragments = bool(accepts_fragments and accepts_fragments[0])
+            if handle is not None and session.handle is None:
+               session.handle = bytes.fromhex(handle)
+               self.handles_info[self.get_session_id(session)] = session
+      elif operation == "delete":
+         session = self.tokens_info.pop(record[1], None)
+         if session is None:
+            return
+         room = session.room
+         del room.members[session.token]
+         if session.handle:
+            del self.handles_info[self.get_session_id(session)]
+         if not room.members and self.rooms_info.get(room.name) is room:
+            room.is_closed = True
+            del self.rooms_info[room.name]
+            self.record_directory_change(room.name, False)
+
+   # 役割：状態全体のスナップショットの作成(ジャーナルのコンパクション時に呼ばれる)
+   # ルーム毎にロックを取って読み取るため、作成中の変更が含まれる場合もある(ジャーナルのレコードの適用で補われる)
+   # 戻り値：JSONに変換できる状態
+   def make_snapshot(self):
+      with self.directory_lock:
+         rooms = list(self.rooms_info.values())
+      room_states = []
+      for room in rooms:
+         with room.lock:
+            if room.is_closed:
+               continue
+            sessions = [
+               (session.token, session.address, session.is_host, session.content_format, session.handle.hex() if session.handle else None, session.accepts_fragments)
+               for session in room.members.values()
+            ]
+         room_states.append((room.name, room.password, sessions))
+      return {"rooms": room_states}
 
-         if not self.rooms_info[room_name]["members"]:
-            del self.rooms_info[room_name]
 
+# UDPワーカープロセスが担当するルームの情報の管理
+# クライアントの削除はメインプロセスのChatServerにも反映させる。
+class ChatServerShard(ChatServer):
+   def __init__(self, channel, worker_id, worker_count, history_size=ChatServer.HISTORY_SIZE, history_bytes=ChatServer.HISTORY_BYTES):
+      super().__init__(history_size=history_size, history_bytes=history_bytes)
+      self.channel = channel
+      # セッションIDをワーカー数で割った余りが担当ワーカーになるよう採番する
+      self.session_id_offset = worker_id
+      self.session_id_step = worker_count
+
+   # 役割：ユーザーの削除
+   # 戻り値：無し
+   def delete_client(self, token):
+      super().delete_client(token)
+      self.channel.send_event({"op": "delete", "token": token})
+
+
+# UDPをワーカープロセスに分散する場合のメインプロセスでのルームやクライアント情報の管理
+# TCPで作成・参加したクライアントを担当ワーカーへ登録する。
+class ShardedChatServer(ChatServer):
+   SHARD_READY_TIMEOUT = 5 # ワーカーの起動を待つ最大秒数(超えた場合は混雑として拒否する)
+
+   def __init__(self, worker_count, password_verifier=None, credential_cache=None):
+      super().__init__(password_verifier, credential_cache)
+      self.worker_count = worker_count
+      self.channel = None
+      self.workers = [] # ワーカープロセス(ShardedUDPServerが起動時に設定する)
+      self.is_shard_ready = threading.Event() # 全てのワーカーが起動したか
+
+   # 役割：ルームの作成
+   # 戻り値：成功=(トークン,None)、失敗=(None、エラーメッセージ)
+   def create_room(self, parsed_request, client_address):
+      token, error_message = super().create_room(parsed_request, client_address)
+      if token:
+         error_message = self.register_to_shard(parsed_request["room_name"], token, client_address, True)
+         if error_message:
+            self.delete_client(token)
+            return None, error_message
+      return token, error_message
+
+   # 役割：ルームにクライアントを追加（ルームへの参加）
+   # 戻り値：成功=(トークン、None), 失敗=(None、エラーメッセージ)
+   def join_room(self, parsed_request, client_address):
+      token, error_message = super().join_room(parsed_request, client_address)
+      if token:
+         error_message = self.register_to_shard(parsed_request["room_name"], token, client_address, False)
+         if error_message:
+            self.delete_client(token)
+            return None, error_message
+      return token, error_message
+
+   # 役割：担当ワーカーへのクライアントの登録
+   # トークンのレスポンスより先に送信するため、クライアントのINITIALより先にワーカーへ届く
+   # ワーカーが起動していない場合や停止している場合、登録を送信できなかった場合は混雑として拒否する
+   # 戻り値：成功=None、失敗=エラーメッセージ
+   def register_to_shard(self, room_name, token, client_address, is_host):
+      if not self.is_shard_ready.wait(self.SHARD_READY_TIMEOUT):
+         log.warning("UDPワーカーの起動を待てませんでした。")
+         return self.BUSY_MESSAGE
+      worker_id = ShardedUDPServer.shard_of(room_name, self.worker_count)
+      if not self.workers[worker_id].is_alive():
+         log.warning("UDPワーカー%dが停止しています。", worker_id)
+         return self.BUSY_MESSAGE
+      try:
+         self.channel.send_control(worker_id, {
+            "op": "register",
+            "room_name": room_name,
+            "token": token,
+            "address": client_address,
+            "is_host": is_host
+         })
+      except OSError as e:
+         log.warning("UDPワーカー%dへ登録を送信できませんでした: %s", worker_id, e)
+         return self.BUSY_MESSAGE
+      return None
+
+   # 役割：期限のヒープへの追加(タイムアウトの判定は担当ワーカーが行い、削除はイベントで反映するため何もしない)
+   # 戻り値：無し
+   def push_expiry(self, session):
+      pass
+
+   # 役割：ユーザーの削除(ワーカーで削除されたクライアントを反映する)
+   # 戻り値：無し
+   def delete_client(self, token):
+      if token in self.tokens_info:
+         super().delete_client(token)
+
+
+# 役割：UDPワーカープロセスのエントリーポイント
+# 戻り値：無し
+def run_shard_worker(worker_id, worker_count, server_address, ipc_dir, stop_event, sender_config=None, history_config=None, log_config=None):
+   # spawnで起動したプロセスではログの設定が引き継がれないため、メインプロセスと同じ設定で出力スレッドを起動する
+   if log_config:
+      log.configure(*log_config)
+   log.start()
+   sender = OutboundSender(*sender_config) if sender_config else None
+   udp_server = ShardWorkerUDPServer(server_address[0], server_address[1], worker_id, worker_count, ipc_dir, stop_event, sender, history_config)
+   try:
+      udp_server.run()
+   finally:
+      log.stop()
 
 
 if __name__ == "__main__":
-   lock = threading.Lock()
-   is_system_active = threading.Event()
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--host", default="0.0.0.0", help="TCPサーバーとUDPサーバーがバインドするアドレス")
+   parser.add_argument("--tcp-port", type=int, default=6058, help="TCPサーバーのポート番号")
+   parser.add_argument("--udp-port", type=int, default=7018, help="UDPサーバーのポート番号")
+   parser.add_argument("--tcp-mode", choices=["thread", "asyncio"], default="thread", help="TCPサーバーの実行モード(thread: 接続毎にスレッド, asyncio: イベントループ)")
+   parser.add_argument("--udp-mode", choices=["thread", "asyncio", "multiprocess"], default="thread", help="UDPサーバーの実行モード(thread: recvfromのループ, asyncio: DatagramProtocol, multiprocess: ルーム毎に複数プロセスへ分散)")
+   parser.add_argument("--udp-workers", type=int, default=os.cpu_count(), help="multiprocessモードのワーカープロセス数")
+   parser.add_argument("--tcp-max-frame-size", type=int, default=2**20, help="受信するTCPリクエストの最大バイト数(超える場合は接続を閉じる)")
+   parser.add_argument("--verify-workers", type=int, default=os.cpu_count(), help="パスワード検証(bcrypt)のプロセス数(0の場合はリクエストを処理するスレッドで検証する)")
+   parser.add_argument("--verify-queue-depth", type=int, default=64, help="実行中と待機中のパスワード検証の上限(超えた場合は混雑として拒否する)")
+   parser.add_argument("--credential-cache-size", type=int, default=10000, help="検証済みパスワードのキャッシュの最大件数(0の場合はキャッシュしない)")
+   parser.add_argument("--credential-cache-ttl", type=float, default=300, help="検証済みパスワードのキャッシュの有効期限(秒)")
+   parser.add_argument("--sender-threads", type=int, default=1, help="thread、multiprocessモードのUDP送信スレッド数(0の場合は受信したスレッドで送信する)")
+   parser.add_argument("--sender-queue-size", type=int, default=256, help="受信者毎の送信キューの上限")
+   parser.add_argument("--sender-drop-policy", choices=[OutboundSender.DROP_OLDEST, OutboundSender.DROP_NEWEST], default=OutboundSender.DROP_OLDEST, help="送信キューが上限に達した場合に破棄するデータ(oldest: 古いもの, newest: 新しいもの)")
+   parser.add_argument("--coalesce-window-ms", type=float, default=0, help="複数のメッセージを1つのデータグラムにまとめるために待つ時間(ミリ秒)。0の場合はまとめない")
+   parser.add_argument("--coalesce-bytes", type=int, default=1200, help="まとめたデータグラムの最大バイト数")
+   parser.add_argument("--history-size", type=int, default=ChatServer.HISTORY_SIZE, help="ルーム毎に保持するチャットの履歴の最大件数(0の場合は保持しない)")
+   parser.add_argument("--history-bytes", type=int, default=ChatServer.HISTORY_BYTES, help="ルーム毎に保持するチャットの履歴の最大バイト数")
+   parser.add_argument("--journal-dir", default=None, help="ルームとセッションの状態を記録するディレクトリ(指定した場合は起動時に復元し、停止時にクライアントへシステム停止メッセージを送信しない)")
+   parser.add_argument("--journal-compact-records", type=int, default=100000, help="ジャーナルのログがこの件数を超えたらスナップショットを書いてログを切り替える")
+   parser.add_argument("--metrics-port", type=int, default=0, help="Prometheusのテキスト形式でメトリクスを返すHTTPサーバーのポート番号(127.0.0.1にバインドする。0の場合は起動しない)")
+   parser.add_argument("--log-level", choices=list(LogPipeline.LEVELS), default="info", help="出力するログの最低レベル")
+   parser.add_argument("--log-queue-size", type=int, default=LogPipeline.QUEUE_SIZE, help="出力待ちのログの上限(超えた場合は破棄して破棄数を出力する)")
+   parser.add_argument("--log-message-sample", type=int, default=1, help="メッセージ毎のイベント(UDPメッセージの受信、TCPリクエストの処理結果など)をこの件数に1件だけ出力する(0の場合は出力しない)")
+   args = parser.parse_args()
+   # まとめたデータグラムはクライアントの受信バッファ(4096バイト)に収める
+   if args.coalesce_bytes > 4096:
+      parser.error("--coalesce-bytesは4096以下で指定してください。")
+   # multiprocessモードはINITIALと削除をワーカーで処理するため、メインプロセスのジャーナルでは復元できない
+   if args.journal_dir and args.udp_mode == "multiprocess":
+      parser.error("--journal-dirはmultiprocessモードでは使用できません。")
 
-   server_ip = "0.0.0.0"
-   tcp_port = 6058
-   udp_port = 7018
+   log_config = (LogPipeline.LEVELS[args.log_level], args.log_queue_size, args.log_message_sample)
+   log.configure(*log_config)
+   log.start()
+
+   server_ip = args.host
+   tcp_port = args.tcp_port
+   udp_port = args.udp_port
   
+   password_verifier = None
+   if args.verify_workers > 0:
+      password_verifier = PasswordVerifier(args.verify_workers, args.verify_queue_depth)
+   credential_cache = None
+   if args.credential_cache_size > 0:
+      credential_cache = CredentialCache(args.credential_cache_size, args.credential_cache_ttl)
+   sender_config = None
+   if args.sender_threads > 0:
+      sender_config = (args.sender_threads, args.sender_queue_size, args.sender_drop_policy, args.coalesce_window_ms / 1000, args.coalesce_bytes)
+
+   metrics_server = None
    try:
-      chat_server = ChatServer()
+      if args.udp_mode == "multiprocess":
+         chat_server = ShardedChatServer(args.udp_workers, password_verifier, credential_cache)
+      else:
+         journal = StateJournal(args.journal_dir, args.journal_compact_records) if args.journal_dir else None
+         chat_server = ChatServer(password_verifier, credential_cache, args.history_size, args.history_bytes, journal)
+         if journal:
+            start = time.perf_counter()
+            session_count = chat_server.recover()
+            log.info("ジャーナルから%dルーム、%dセッションを復元しました(%.2f秒)。", len(chat_server.rooms_info), session_count, time.perf_counter() - start)
 
-      tcp_server = TCPServer(server_ip=server_ip, tcp_port=tcp_port, chat_server=chat_server)
+      chat_server.metrics.register_collector(lambda: [("chat_log_drops_total", "", log.drop_count)])
+      if args.metrics_port:
+         metrics_server = MetricsHTTPServer(chat_server.metrics, "127.0.0.1", args.metrics_port)
+         metrics_server.start()
+
+      if args.tcp_mode == "asyncio":
+         tcp_server = AsyncTCPServer(server_ip=server_ip, tcp_port=tcp_port, chat_server=chat_server, max_frame_size=args.tcp_max_frame_size)
+      else:
+         tcp_server = TCPServer(server_ip=server_ip, tcp_port=tcp_port, chat_server=chat_server, max_frame_size=args.tcp_max_frame_size)
       tcp_server_thread = threading.Thread(target=tcp_server.run)
       tcp_server_thread.start()
 
-      udp_server = UDPServer(server_ip=server_ip, udp_port=udp_port, chat_server=chat_server)
+      if args.udp_mode == "asyncio":
+         udp_server = AsyncUDPServer(server_ip=server_ip, udp_port=udp_port, chat_server=chat_server)
+      elif args.udp_mode == "multiprocess":
+         udp_server = ShardedUDPServer(server_ip=server_ip, udp_port=udp_port, chat_server=chat_server, worker_count=args.udp_workers, sender_config=sender_config, history_config=(args.history_size, args.history_bytes), log_config=log_config)
+      else:
+         sender = OutboundSender(*sender_config) if sender_config else None
+         udp_server = UDPServer(server_ip=server_ip, udp_port=udp_port, chat_server=chat_server, sender=sender)
       udp_server_thread = threading.Thread(target=udp_server.run)
       udp_server_thread.start()
 
       tcp_server_thread.join()
       udp_server_thread.join()
    except KeyboardInterrupt as e:
-      print(e)
+      log.info("%r", e)
    except Exception as e:
-      print(e)
+      log.warning("%s", e)
    finally:
       is_system_active.set()
 
-      message = UDPProtocolHandler.make_system_stop_message()
-      all_addresses = chat_server.get_all_addresses()
-      for address in all_addresses:
-         udp_server.sock.sendto(message, address)
\ No newline at end of file
+      # ジャーナルを記録している場合は再起動後もセッションを使えるため、クライアントのチャットを終了させない
+      if args.journal_dir:
+         chat_server.journal.close()
+         log.info("ルームとセッションの状態をジャーナルに保存しました。")
+      else:
+         udp_server.send_system_stop_message()
+      if metrics_server:
+         metrics_server.shutdown()
+      if password_verifier:
+         password_verifier.shutdown()
+      if credential_cache:
+         stats = credential_cache.stats()
+         log.info("認証キャッシュ: ヒット %d, ミス %d", stats["hits"], stats["misses"])